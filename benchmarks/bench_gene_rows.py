@@ -0,0 +1,85 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Benchmark gene track row packing on synthetic gene dense regions, against
+### the original row-by-row greedy scan it replaces
+###
+### python benchmarks/bench_gene_rows.py [n_genes ...]
+
+
+
+import sys
+import time
+
+import locuszoom_plot as lzp
+
+from synthetic import synthetic_gene_region
+
+
+################################################################################
+
+WINDOW_SIZE = 5000000
+
+GENE_COUNTS = [100, 300, 1000, 3000]
+
+
+################################################################################
+
+
+def legacy_sort_gene_locations(gene_frame, position_min, position_max):
+    """The greedy packer sort_gene_locations used before, one pass over the remaining genes per row"""
+    records = gene_frame.to_dict('records')
+    for gene in records:
+        gene['exonStarts'] = lzp.parse_exon_positions(gene['exonStarts'])
+        gene['exonEnds'] = lzp.parse_exon_positions(gene['exonEnds'])
+
+    rows = []
+    while len(records) > 0:
+        current_row = []
+        last_item = None
+        remainder = []
+        for r in records:
+            if None == last_item:
+                current_row.append(r)
+                last_item = r
+            elif lzp.overlap_region(last_item, r):
+                remainder.append(r)
+            elif lzp.overlap_text(last_item, r, position_min, position_max):
+                remainder.append(r)
+            else:
+                current_row.append(r)
+                last_item = r
+        rows.append(current_row)
+        records = remainder
+    return rows
+
+
+def row_names(rows):
+    return [ [ gene['geneName'] for gene in row] for row in rows]
+
+
+def time_call(f, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if None == best else min(best, elapsed)
+    return best, result
+
+
+def main(gene_counts):
+    position_min = 10000000
+    position_max = position_min + WINDOW_SIZE
+    print("{:>8} {:>6} {:>12} {:>12} {:>8}".format("genes", "rows", "legacy_s", "packer_s", "speedup"))
+    for n_genes in gene_counts:
+        frame = synthetic_gene_region(n_genes, position_min, position_max, seed=n_genes)
+        legacy_seconds, legacy_rows = time_call(legacy_sort_gene_locations, frame, position_min, position_max)
+        packer_seconds, rows = time_call(lzp.sort_gene_locations, frame, position_min, position_max)
+        if row_names(rows) != row_names(legacy_rows):
+            raise Exception("ERROR row assignment differs from the legacy packer for {n} genes".format(n=n_genes))
+        print("{:>8} {:>6} {:>12.4f} {:>12.4f} {:>8.1f}".format(n_genes, len(rows), legacy_seconds, packer_seconds,
+                                                               legacy_seconds / packer_seconds))
+
+
+if __name__ == "__main__":
+    main([ int(n) for n in sys.argv[1:]] or GENE_COUNTS)
@@ -0,0 +1,82 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Benchmark import time of the package, and check that importing it, or
+### only the LD and data loading parts, does not pull in heavy dependencies
+###
+### python benchmarks/bench_import.py [--repeat N] [--max-seconds S]
+###
+### Exits non-zero when a scenario imports a forbidden module or, with
+### --max-seconds, takes longer than that (best of N fresh interpreters).
+
+
+
+import argparse
+import json
+import subprocess
+import sys
+
+
+################################################################################
+
+# (name, statement, modules that must not be imported by it)
+SCENARIOS = [ ("package", "import locuszoom_plot",
+               ["matplotlib", "pandas", "numpy", "sqlite3"]),
+              ("plink_ld", "from locuszoom_plot import generate_plink_ld_file",
+               ["matplotlib", "pandas", "numpy"]),
+              ("ld_cache", "from locuszoom_plot import LDCache",
+               ["matplotlib"]),
+              ("pvalue_store", "from locuszoom_plot import PvalueStore",
+               ["matplotlib"]),
+              ("plotting", "from locuszoom_plot import basic_locuszoom",
+               []) ]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{ 'seconds': elapsed, 'modules': sorted(set(m.split('.')[0] for m in sys.modules)) }}))
+"""
+
+
+################################################################################
+
+
+def probe(statement):
+    """Run statement in a fresh interpreter, return (seconds, top level modules loaded)"""
+    output = subprocess.run([sys.executable, "-c", _PROBE.format(statement=statement)],
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result['seconds'], set(result['modules'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="fail when the package import alone takes longer than this")
+    args = parser.parse_args()
+
+    failed = False
+    print("{:<14} {:>10}  {}".format("scenario", "best_s", "heavy modules loaded"))
+    for name, statement, forbidden in SCENARIOS:
+        best = None
+        for _ in range(args.repeat):
+            seconds, modules = probe(statement)
+            best = seconds if None == best else min(best, seconds)
+        heavy = [ m for m in ["matplotlib", "pandas", "numpy", "sqlite3"] if m in modules]
+        print("{:<14} {:>10.4f}  {}".format(name, best, ", ".join(heavy) or "-"))
+
+        unexpected = [ m for m in forbidden if m in modules]
+        if len(unexpected) > 0:
+            print("  FAIL {n} imported {m}".format(n=name, m=", ".join(unexpected)))
+            failed = True
+        if "package" == name and None != args.max_seconds and best > args.max_seconds:
+            print("  FAIL import took {b:.4f}s, limit {l}s".format(b=best, l=args.max_seconds))
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
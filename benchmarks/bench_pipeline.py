@@ -0,0 +1,240 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Time each stage of a basic_locuszoom plot on synthetic data (see
+### synthetic.py) across variant densities and window sizes, and save the
+### timings as JSON so runs on different commits can be compared offline
+###
+### python benchmarks/bench_pipeline.py [--densities 2000 10000] [--windows 250000 1000000]
+###                                     [--repeat 5] [--output bench_pipeline.json]
+###                                     [--compare previous.json] [--data-dir DIR]
+
+
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import matplotlib
+import numpy as np
+import pandas as pd
+
+import locuszoom_plot as lzp
+
+from synthetic import synthetic_locus
+
+
+################################################################################
+
+DENSITIES = [1000, 5000, 20000]  # variants per Mb
+
+WINDOWS = [100000, 500000, 1000000]  # bases either side of the lead variant
+
+FORMAT_VERSION = 1
+
+
+################################################################################
+
+
+def time_stage(f, repeat, setup=None, teardown=None):
+    """Call f repeat times, each on fresh arguments from setup(), return (seconds per call, last result)"""
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        args = setup() if None != setup else ()
+        start = time.perf_counter()
+        result = f(*args)
+        seconds.append(time.perf_counter() - start)
+        if None != teardown:
+            teardown(*args)
+    return seconds, result
+
+
+def locus_figure(n_gene_rows):
+    figure = lzp.new_figure(figsize=(8,6), dpi=150)
+    r2_axes, gene_axes = figure.subplots(2,1, gridspec_kw={'height_ratios': [10, n_gene_rows]})
+    return figure, r2_axes, gene_axes
+
+
+def release(figure, *axes):
+    lzp.release_figure(figure)
+
+
+def bench_locus(locus, repeat):
+    """Time the stages of one locus, returning a list of stage records"""
+    target_variant = locus['target_variant']
+    target_pos = locus['target_pos']
+    window_size = locus['target_window_size']
+    chromosome = target_variant.split(":")[0]
+    position_min = target_pos - window_size
+    position_max = target_pos + window_size
+    gene_db = locus['locuszoom_gene_db']
+    stages = []
+
+    def record(stage, seconds, rows=None):
+        stages.append({ 'stage': stage,
+                        'seconds': seconds,
+                        'best': min(seconds),
+                        'median': statistics.median(seconds),
+                        'rows': rows })
+
+    # the first lookup builds the R-tree index next to the database
+    seconds, region_info = time_stage(lambda: lzp.load_gene_region_info(chromosome, position_min, position_max, gene_db), 1)
+    record("gene_index_build", seconds, len(region_info))
+
+    seconds, region_info = time_stage(lambda: lzp.load_gene_region_info(chromosome, position_min, position_max, gene_db),
+                                      repeat)
+    record("load_gene_region_info", seconds, len(region_info))
+
+    seconds, gene_rows = time_stage(lambda: lzp.sort_gene_locations(region_info, position_min, position_max), repeat)
+    record("sort_gene_locations", seconds, len(gene_rows))
+
+    seconds, ld_frame = time_stage(lambda: lzp.load_plink_r2_results_file(locus['plink_file'], target_variant,
+                                                                          position_min, position_max), repeat)
+    record("load_plink_r2_results_file", seconds, len(ld_frame))
+
+    if None != locus['locuszoom_template']:
+        prefix = lzp.plink_bed_file_prefix_for(locus['locuszoom_template'], locus['ancestry'], chromosome)
+        window_kb = lzp.window_kb_for(window_size)
+        seconds, bed_ld_frame = time_stage(lambda: lzp.plink_bed_ld_frame(prefix, target_variant, window_kb), repeat)
+        record("plink_bed_ld_frame", seconds, len(bed_ld_frame))
+
+    seconds, pvalue_frame = time_stage(lambda: lzp.select_pvalue_region(locus['pvalue_frame'], chromosome,
+                                                                        position_min, position_max), repeat)
+    record("select_pvalue_region", seconds, len(pvalue_frame))
+
+    seconds, pvalue_ld_frame = time_stage(lambda: lzp.merge_pvalue_ld(pvalue_frame, ld_frame), repeat)
+    record("merge_pvalue_ld", seconds, len(pvalue_ld_frame))
+
+    n_gene_rows = len(gene_rows)
+    seconds, _ = time_stage(lambda figure, r2_axes, gene_axes:
+                                lzp.plot_r2_region_worker(r2_axes, pvalue_ld_frame, target_variant, position_min,
+                                                          position_max, target_variant),
+                            repeat, setup=lambda: locus_figure(n_gene_rows), teardown=release)
+    record("plot_r2_region_worker", seconds, len(pvalue_ld_frame))
+
+    seconds, _ = time_stage(lambda figure, r2_axes, gene_axes:
+                                lzp.plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max),
+                            repeat, setup=lambda: locus_figure(n_gene_rows), teardown=release)
+    record("plot_gene_region_worker", seconds, len(region_info))
+
+    def drawn_figure():
+        figure, r2_axes, gene_axes = locus_figure(n_gene_rows)
+        lzp.plot_r2_region_worker(r2_axes, pvalue_ld_frame, target_variant, position_min, position_max, target_variant)
+        lzp.plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max)
+        lzp.colorbar_magic(figure, 1)
+        return figure, io.BytesIO()
+
+    seconds, _ = time_stage(lambda figure, png: lzp.save_figure(figure, png), repeat, setup=drawn_figure,
+                            teardown=lambda figure, png: lzp.release_figure(figure))
+    record("savefig", seconds)
+
+    seconds, point_counts = time_stage(lambda: lzp.basic_locuszoom(locus['pvalue_frame'], locus['plink_file'],
+                                                                   target_variant, target_pos, target_variant,
+                                                                   target_window_size=window_size,
+                                                                   output_plot=io.BytesIO(),
+                                                                   locuszoom_gene_db=gene_db), repeat)
+    record("basic_locuszoom", seconds, point_counts[1])
+    return stages
+
+
+def git_commit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    return output.stdout.strip() or None
+
+
+def environment():
+    return { 'git_commit': git_commit(),
+             'python': platform.python_version(),
+             'platform': platform.platform(),
+             'cpu_count': os.cpu_count(),
+             'numpy': np.__version__,
+             'pandas': pd.__version__,
+             'matplotlib': matplotlib.__version__ }
+
+
+def compare(results, previous_file):
+    """Print best times of results against those of the same cases in previous_file"""
+    with open(previous_file) as f:
+        previous = json.load(f)
+    before = { (r['variants_per_mb'], r['window_size'], r['stage']): r['best'] for r in previous['results']}
+
+    print("\ncompared with {f} ({c})".format(f=previous_file, c=(previous['environment']['git_commit'] or "?")[:12]))
+    print("{:>8} {:>8} {:<28} {:>10} {:>10} {:>7}".format("per_mb", "window", "stage", "before_s", "after_s", "ratio"))
+    for r in results:
+        old = before.get((r['variants_per_mb'], r['window_size'], r['stage']))
+        if None == old:
+            continue
+        print("{:>8} {:>8} {:<28} {:>10.4f} {:>10.4f} {:>7.2f}".format(r['variants_per_mb'], r['window_size'],
+                                                                        r['stage'], old, r['best'], r['best'] / old))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time basic_locuszoom stages on synthetic data")
+    parser.add_argument("--densities", type=int, nargs="+", default=DENSITIES, help="variants per Mb")
+    parser.add_argument("--windows", type=int, nargs="+", default=WINDOWS,
+                        help="target_window_size, bases either side of the lead variant")
+    parser.add_argument("--genes-per-mb", type=float, default=10)
+    parser.add_argument("--samples", type=int, default=503, help="reference panel samples")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--compare", default=None, help="earlier JSON output to compare against")
+    parser.add_argument("--data-dir", default=None, help="keep the synthetic inputs here instead of a temporary directory")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir
+    scratch = None
+    if None == data_dir:
+        scratch = tempfile.TemporaryDirectory(prefix="locuszoom_bench_")
+        data_dir = scratch.name
+
+    results = []
+    print("{:>8} {:>8} {:<28} {:>10} {:>10} {:>8}".format("per_mb", "window", "stage", "best_s", "median_s", "rows"))
+    try:
+        for variants_per_mb in args.densities:
+            for window_size in args.windows:
+                directory = os.path.join(data_dir, "d{d}_w{w}".format(d=variants_per_mb, w=window_size))
+                locus = synthetic_locus(directory, variants_per_mb, window_size, genes_per_mb=args.genes_per_mb,
+                                        n_samples=args.samples, seed=args.seed)
+                for stage in bench_locus(locus, args.repeat):
+                    stage.update({ 'variants_per_mb': variants_per_mb,
+                                   'window_size': window_size,
+                                   'n_variants': locus['n_variants'],
+                                   'n_ld_rows': locus['n_ld_rows'],
+                                   'n_genes': locus['n_genes'] })
+                    results.append(stage)
+                    print("{:>8} {:>8} {:<28} {:>10.4f} {:>10.4f} {:>8}".format(
+                        variants_per_mb, window_size, stage['stage'], stage['best'], stage['median'],
+                        "" if None == stage['rows'] else stage['rows']))
+                lzp.close_gene_db_connections()
+    finally:
+        if None != scratch:
+            scratch.cleanup()
+
+    report = { 'benchmark': 'bench_pipeline',
+               'format_version': FORMAT_VERSION,
+               'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+               'environment': environment(),
+               'parameters': vars(args),
+               'results': results }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("\nwrote {f}".format(f=args.output))
+
+    if None != args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Synthetic inputs for the benchmarks, so they run without the LocusZoom 1.4
+### data or PLINK: summary statistics, PLINK --r2 .ld files, .bed/.bim/.fam
+### reference panels and a refFlat SQLite database shaped like locuszoom_hg19.db
+###
+### Everything is generated from a seed, so runs on different commits see the
+### same data.
+
+
+
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+
+################################################################################
+
+REFFLAT_COLUMNS = ["geneName", "name", "chrom", "strand", "txStart", "txEnd", "cdsStart", "cdsEnd", "exonCount",
+                   "exonStarts", "exonEnds"]
+
+# .bed 2-bit code for A1 dosage 0, 1, 2 and missing (-1, the last entry)
+DOSAGE_BED_CODE = np.array([3, 2, 0, 1], dtype=np.uint8)
+
+
+################################################################################
+
+
+def variant_positions(position_min, position_max, variants_per_mb, seed=0):
+    """Sorted distinct positions at about variants_per_mb per megabase"""
+    rng = np.random.default_rng(seed)
+    span = position_max - position_min + 1
+    n_variants = min(span, max(1, int(round(span * variants_per_mb / 1e6))))
+    return np.sort(rng.choice(span, size=n_variants, replace=False)) + position_min
+
+
+def synthetic_pvalue_frame(chrom, positions, lead_position, peak_log_pvalue=30, peak_scale=50000, seed=0):
+    """Frame like load_custom_pvalue_file output (chrom, position, pvalue, variant) with a signal at lead_position"""
+    rng = np.random.default_rng(seed)
+    positions = np.asarray(positions, dtype=np.int64)
+    signal = peak_log_pvalue * np.exp(-np.abs(positions - lead_position) / peak_scale) * rng.uniform(size=len(positions))
+    log_pvalue = signal + rng.exponential(1 / np.log(10), size=len(positions))
+    log_pvalue[positions == lead_position] = peak_log_pvalue
+    return pd.DataFrame({ 'chrom': chrom,
+                          'position': positions,
+                          'pvalue': 10 ** -log_pvalue,
+                          'variant': [ "chr{c}:{p}".format(c=chrom, p=p) for p in positions] })
+
+
+def write_pvalue_csv(filename, pvalue_frame):
+    """Write pvalue_frame in the column layout load_custom_pvalue_file reads"""
+    frame = pvalue_frame.rename(columns={ 'chrom': 'chromo', 'pvalue': 'simple_pvalue'})
+    frame[['chromo', 'position', 'simple_pvalue']].to_csv(filename, index=False)
+
+
+def synthetic_ld_r2(positions, lead_position, decay_scale=100000, seed=0):
+    """r2 of each position against lead_position, decaying with distance"""
+    rng = np.random.default_rng(seed)
+    positions = np.asarray(positions, dtype=np.int64)
+    r2 = np.exp(-np.abs(positions - lead_position) / decay_scale) * rng.beta(2, 2, size=len(positions))
+    r2[positions == lead_position] = 1
+    return np.round(r2, 6)
+
+
+def write_plink_ld_file(filename, chrom, lead_position, positions, r2):
+    """Write a PLINK --r2 --ld-snp output file, with its space padded columns"""
+    lead = "chr{c}:{p}".format(c=chrom, p=lead_position)
+    with open(filename, "w") as f:
+        f.write(" CHR_A         BP_A         SNP_A  CHR_B         BP_B         SNP_B           R2 \n")
+        for position, value in zip(positions.tolist(), r2.tolist()):
+            f.write("{c:>6} {lp:>12} {l:>13} {c:>6} {p:>12} {v:>13} {r:>12g} \n".format(
+                c=chrom, lp=lead_position, l=lead, p=position, v="chr{c}:{p}".format(c=chrom, p=position), r=value))
+
+
+def synthetic_genotypes(positions, n_samples, seed=0, n_founders=24, recombination_rate=2e-6, drift_rate=2e-6,
+                        missing_rate=0.01, chunk_variants=4096):
+    """Yield int8 A1 dosage matrices (variants x samples, -1 missing) for consecutive chunks of positions
+
+    Haplotypes are mosaics of a few founder haplotypes, switching founder at
+    recombination_rate per base. Founder alleles at a variant copy those at
+    the previous one, each flipping with a probability growing with the gap
+    by drift_rate per base, so nearby variants are in LD and LD decays with
+    distance as in a real panel.
+    """
+    rng = np.random.default_rng(seed)
+    positions = np.asarray(positions, dtype=np.int64)
+    n_haplotypes = 2 * n_samples
+    haplotype_rows = np.arange(n_haplotypes)[:, None]
+    founder = rng.integers(n_founders, size=n_haplotypes)
+    founder_allele = rng.uniform(size=n_founders) < 0.5
+    previous_position = None
+
+    for start in range(0, len(positions), chunk_variants):
+        chunk = positions[start:start + chunk_variants]
+        n_chunk = len(chunk)
+        gaps = np.diff(chunk, prepend=chunk[0] if None == previous_position else previous_position)
+        switch_probability = 1 - np.exp(-gaps * recombination_rate)
+        flip_probability = 1 - np.exp(-gaps * drift_rate)
+        switches = rng.uniform(size=(n_haplotypes, n_chunk)) < switch_probability
+        new_founders = rng.integers(n_founders, size=(n_haplotypes, n_chunk))
+
+        # founder of each haplotype at each variant, carried forward from the last switch
+        last_switch = np.maximum.accumulate(np.where(switches, np.arange(n_chunk), -1), axis=1)
+        founders = np.where(last_switch >= 0, new_founders[haplotype_rows, np.maximum(last_switch, 0)], founder[:, None])
+        founder = founders[:, -1]
+        previous_position = chunk[-1]
+
+        flips = rng.uniform(size=(n_founders, n_chunk)) < flip_probability
+        founder_alleles = (founder_allele[:, None] + np.cumsum(flips, axis=1)) % 2 == 1
+        # keep every variant polymorphic, flipping one founder where they all agree
+        monomorphic = np.flatnonzero(founder_alleles.all(axis=0) | ~founder_alleles.any(axis=0))
+        founder_alleles[rng.integers(n_founders, size=len(monomorphic)), monomorphic] ^= True
+        founder_allele = founder_alleles[:, -1]
+        alleles = founder_alleles[founders, np.arange(n_chunk)]
+        dosage = (alleles[0::2] + alleles[1::2]).astype(np.int8).T
+        dosage[rng.uniform(size=dosage.shape) < missing_rate] = -1
+        yield dosage
+
+
+def pack_bed_rows(dosage):
+    """SNP-major .bed bytes for a (variants x samples) dosage matrix, -1 missing"""
+    n_variants, n_samples = dosage.shape
+    bytes_per_variant = (n_samples + 3) // 4
+    codes = np.full((n_variants, 4 * bytes_per_variant), DOSAGE_BED_CODE[0], dtype=np.uint8)
+    codes[:, :n_samples] = DOSAGE_BED_CODE[dosage]
+    codes = codes.reshape(n_variants, bytes_per_variant, 4)
+    return (codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) | (codes[:, :, 3] << 6)).tobytes()
+
+
+def write_plink_bed_panel(prefix, chrom, positions, n_samples=503, seed=0, **genotype_kwargs):
+    """Write a prefix.bed/.bim/.fam reference panel over positions, variants named chr{chrom}:{position}"""
+    positions = np.asarray(positions, dtype=np.int64)
+    with open(prefix + ".bed", "wb") as f:
+        f.write(b"\x6c\x1b\x01")
+        for dosage in synthetic_genotypes(positions, n_samples, seed=seed, **genotype_kwargs):
+            f.write(pack_bed_rows(dosage))
+
+    bim = pd.DataFrame({ 'chrom': str(chrom),
+                         'variant': [ "chr{c}:{p}".format(c=chrom, p=p) for p in positions],
+                         'cm': 0,
+                         'position': positions,
+                         'a1': 'A',
+                         'a2': 'G' })
+    bim.to_csv(prefix + ".bim", sep="\t", header=False, index=False)
+    with open(prefix + ".fam", "w") as f:
+        for sample in range(n_samples):
+            f.write("F{s} I{s} 0 0 0 -9\n".format(s=sample))
+
+
+def synthetic_gene_region(n_genes, position_min, position_max, seed=0, chrom='chr19', genes_per_cluster=40):
+    """Gene frame shaped like load_gene_region_info output, with clustered, heavily overlapping genes"""
+    rng = np.random.default_rng(seed)
+    cluster_centers = rng.uniform(position_min, position_max, size=max(1, n_genes // genes_per_cluster))
+    centers = rng.choice(cluster_centers, size=n_genes) + rng.normal(0, 50000, size=n_genes)
+    lengths = rng.lognormal(np.log(20000), 1.2, size=n_genes).astype(np.int64) + 100
+    tx_start = np.clip(centers - lengths/2, position_min - 200000, position_max).astype(np.int64)
+    tx_end = tx_start + lengths
+
+    exon_starts = []
+    exon_ends = []
+    for start, end in zip(tx_start, tx_end):
+        n_exons = int(rng.integers(1, 12))
+        edges = np.sort(rng.integers(start, end, size=2 * n_exons))
+        exon_starts.append(",".join(str(e) for e in edges[0::2]) + ",")
+        exon_ends.append(",".join(str(e) for e in edges[1::2]) + ",")
+
+    name_lengths = rng.integers(3, 12, size=n_genes)
+    frame = pd.DataFrame({ 'geneName': [ "G{i:0{w}d}".format(i=i, w=w) for i, w in enumerate(name_lengths)],
+                           'chrom': chrom,
+                           'strand': rng.choice(['+', '-'], size=n_genes),
+                           'txStart': tx_start,
+                           'txEnd': tx_end,
+                           'exonStarts': exon_starts,
+                           'exonEnds': exon_ends })
+    return frame.sort_values(by="txStart", kind="mergesort")
+
+
+def write_refflat_db(filename, gene_frames):
+    """Write gene frames (see synthetic_gene_region) as the refFlat table of a new SQLite database"""
+    if os.path.exists(filename):
+        os.unlink(filename)
+    refflat = pd.concat(gene_frames, ignore_index=True)
+    refflat['name'] = [ "NM_{i:06d}".format(i=i) for i in range(len(refflat))]
+    refflat['cdsStart'] = refflat['txStart']
+    refflat['cdsEnd'] = refflat['txEnd']
+    refflat['exonCount'] = refflat['exonStarts'].str.count(",")
+
+    conn = sqlite3.connect(filename)
+    try:
+        conn.execute("CREATE TABLE refFlat (geneName TEXT, name TEXT, chrom TEXT, strand TEXT, txStart INT, "
+                     "txEnd INT, cdsStart INT, cdsEnd INT, exonCount INT, exonStarts TEXT, exonEnds TEXT)")
+        conn.executemany("INSERT INTO refFlat VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                         refflat[REFFLAT_COLUMNS].itertuples(index=False, name=None))
+        conn.commit()
+    finally:
+        conn.close()
+    return filename
+
+
+################################################################################
+
+
+def synthetic_locus(directory, variants_per_mb, window_size, chrom=3, lead_position=50000000, genes_per_mb=10,
+                    n_samples=503, bed_panel=True, seed=0):
+    """Write every input of one locuszoom plot under directory and return them as a dict
+
+    The summary statistics, reference panel and refFlat database cover the
+    window_size bases either side of the lead variant plus a margin; the .ld
+    file holds what PLINK --ld-snp would write for that window.
+    """
+    os.makedirs(directory, exist_ok=True)
+    margin = window_size // 2
+    position_min = lead_position - window_size - margin
+    position_max = lead_position + window_size + margin
+
+    positions = variant_positions(position_min, position_max, variants_per_mb, seed=seed)
+    positions = np.union1d(positions, [lead_position])
+    pvalue_frame = synthetic_pvalue_frame(chrom, positions, lead_position, seed=seed + 1)
+
+    ld_positions = positions[np.abs(positions - lead_position) <= window_size]
+    ld_file = os.path.join(directory, "lead.ld")
+    write_plink_ld_file(ld_file, chrom, lead_position, ld_positions, synthetic_ld_r2(ld_positions, lead_position,
+                                                                                      seed=seed + 2))
+
+    n_genes = max(1, int(round((position_max - position_min) * genes_per_mb / 1e6)))
+    gene_db = write_refflat_db(os.path.join(directory, "refflat.db"),
+                               [ synthetic_gene_region(n_genes, position_min, position_max, seed=seed + 3,
+                                                       chrom="chr{c}".format(c=chrom), genes_per_cluster=4)])
+
+    locus = { 'directory': directory,
+              'chrom': chrom,
+              'target_variant': "chr{c}:{p}".format(c=chrom, p=lead_position),
+              'target_pos': lead_position,
+              'target_window_size': window_size,
+              'pvalue_frame': pvalue_frame,
+              'plink_file': ld_file,
+              'locuszoom_gene_db': gene_db,
+              'n_variants': len(positions),
+              'n_ld_rows': len(ld_positions),
+              'n_genes': n_genes,
+              'locuszoom_template': None }
+
+    if bed_panel:
+        panel_dir = os.path.join(directory, "panel", "SYN")
+        os.makedirs(panel_dir, exist_ok=True)
+        write_plink_bed_panel(os.path.join(panel_dir, "chr{c}".format(c=chrom)), chrom, positions,
+                              n_samples=n_samples, seed=seed + 4)
+        locus['locuszoom_template'] = os.path.join(directory, "panel", "{ancestry}", "{chrom}")
+        locus['ancestry'] = "SYN"
+    return locus
@@ -22,7 +22,7 @@ LOCUSZOOM_DIR = os.environ["LOCUSZOOM_DIR"]  # or set to where your locuszoom da
 LOCUSZOOM_GENE_DB = os.path.join(LOCUSZOOM_DIR, "locuszoom/data/database/locuszoom_hg19.db")
 LOCUSZOOM_GENOTYPES_TEMPLATE = os.path.join(LOCUSZOOM_DIR, "locuszoom/data/1000G/genotypes/2014-10-14/{ancestry}/{chrom}")
 
-SCRATCH_DIR = "/tmp"
+LD_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "locuszoom_plot", "ld")  # LD results are reused between runs
 
 PVALUE_FILE = "random_example_data.csv"
 
@@ -35,14 +35,12 @@ chromosome = 3
 
 pvalue_frame = pd.read_csv(PVALUE_FILE)
 ancestry="EUR"
-scratch_ld_file = os.path.join(SCRATCH_DIR, target_variant + "_" + ancestry + ".ld")
+ld_cache = lzp.LDCache(LD_CACHE_DIR)
 
-
-lzp.generate_plink_ld_file(scratch_ld_file, ancestry, "chr{chrom}".format(chrom=chromosome), target_variant,
-                           locuszoom_template=LOCUSZOOM_GENOTYPES_TEMPLATE)
-
-lzp.basic_locuszoom(pvalue_frame, scratch_ld_file, target_variant, target_pos, rs_name, target_window_size=500000,
-                    output_plot=OUTPUT_PLOT, output_pdf=None, title="Example with random data", locuszoom_gene_db=LOCUSZOOM_GENE_DB)
+# with no plink file given, LD is looked up in the cache and PLINK only runs on a miss
+lzp.basic_locuszoom(pvalue_frame, None, target_variant, target_pos, rs_name, target_window_size=500000,
+                    output_plot=OUTPUT_PLOT, output_pdf=None, title="Example with random data", locuszoom_gene_db=LOCUSZOOM_GENE_DB,
+                    ancestry=ancestry, locuszoom_template=LOCUSZOOM_GENOTYPES_TEMPLATE, ld_cache=ld_cache)
 
 
 
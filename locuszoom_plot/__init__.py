@@ -5,10 +5,91 @@ for looking at regions around a reference variant.
 
 # This file is to tell setuptools that this directory is a package
 
-from .generate_plink_ld import *
-from .plot_r2_region import *
-from .plot_gene_region import *
-from .basic_locuszoom import *
-from .multi_ancestry_locuszoom import *
+# Submodules are imported on first use of one of their names, so importing the
+# package does not pull in matplotlib, pandas or the PLINK environment module.
 
+import importlib
+import sys
+import types
 
+
+_SUBMODULE_NAMES = {
+    "generate_plink_ld": ["invoke_system", "plink_ld_params", "PLINK_BFILE_SUFFIXES", "file_signature",
+                          "plink_bfile_signature", "plink_bed_file_prefix_for", "load_plink_module",
+                          "generate_plink_ld_file", "generate_plink_ld_frame", "generate_plink_ld_batch"],
+    "instrumentation": ["span", "instrument_stage", "instrumented", "in_context", "SpanAggregator", "ProfileCapture",
+                        "profile_locus"],
+    "figures": ["new_figure", "save_figure", "show_figure", "release_figure"],
+    "plot_r2_region": ["LD_REGIMES", "load_custom_pvalue_file", "load_and_format_pvalue_file_custom", "window_pvalue",
+                       "select_pvalue_region", "PLINK_LD_COLUMNS", "PLINK_LD_DTYPES", "load_plink_r2_results_file",
+                       "pvalue_join_keys", "merge_pvalue_ld", "ld_color_map", "colorbar_magic", "ld_regime_colors",
+                       "bin_r2_region_points", "decimate_r2_points", "R2_POINT_SIZE", "R2_POINT_LINEWIDTH",
+                       "r2_point_pixels", "axes_pixel_size", "plot_r2_points_worker",
+                       "plot_r2_region_worker", "plot_r2_region"],
+    "plot_gene_region": ["GENE_REGION_INDEX_SUFFIX", "get_gene_db_connection", "close_gene_db_connections",
+                         "gene_db_signature", "build_gene_region_index", "query_gene_region", "overlap_interval",
+                         "overlap_region", "overlap_text", "parse_exon_positions", "gene_label_extents",
+                         "sort_gene_locations", "load_gene_region_info", "scale_gene_rows", "gene_track_segments",
+                         "plot_gene_region_worker", "plot_gene_region"],
+    "gene_annotation_index": ["GeneAnnotationIndex"],
+    "pvalue_store": ["PVALUE_STORE_METADATA", "normalize_chromosome", "build_pvalue_store", "PvalueStore"],
+    "tabix": ["TABIX_ZERO_BASED", "TBI_MIN_SHIFT", "TBI_DEPTH", "reg2bins", "read_tabix_index", "BgzfReader",
+              "TabixFile", "has_tabix_index"],
+    "multi_region": ["merge_windows", "format_region_frame", "extract_pvalue_regions"],
+    "bed_ld": ["BED_MAGIC", "BED_CODE_DOSAGE", "BED_BYTE_DOSAGE", "BIM_COLUMNS", "PlinkBedFile", "ld_r2_against",
+               "ld_r2_matrix", "open_plink_bed_file", "plink_bed_ld_frame", "generate_bed_ld_frame"],
+    "ld_cache": ["LD_CACHE_FORMAT_VERSION", "LD_CACHE_CHECK_INTERVAL", "LD_CACHE_EVICT_FRACTION",
+                 "LD_ENGINES", "window_kb_for", "generate_ld_frame",
+                 "window_ld_frame", "LDCache", "resolve_ld_frame"],
+    "ld_matrix": ["LD_MATRIX_FORMAT_VERSION", "LD_MATRIX_LEVELS", "LD_MATRIX_MISSING", "LD_MATRIX_DTYPES",
+                  "LD_MATRIX_BLOCK_ELEMENTS", "build_ld_matrix", "LDMatrix", "LDMatrixStore"],
+    "basic_locuszoom": ["basic_locuszoom", "draw_basic_locuszoom"],
+    "locus_session": ["LocusSession"],
+    "multi_ancestry_locuszoom": ["prepare_ancestry_points", "multi_ancestry_locuszoom"],
+    "batch_locuszoom": ["locus_ancestries", "locus_field", "locus_window", "prepare_batch_loci", "render_locus",
+                        "report_batch_progress", "iter_locuszoom_batch", "locuszoom_batch"],
+    "pdf_report": ["write_report_page", "iter_locuszoom_report", "locuszoom_report"],
+    "async_locuszoom": ["PLINK_JOB_MEMORY", "default_concurrency", "invoke_system_async",
+                        "generate_plink_ld_file_async", "AsyncLocuszoom"],
+    "tile_server": ["TILE_TRACKS", "TILE_BASE_SPAN", "TILE_MAX_ZOOM", "TILE_WIDTH", "TILE_HEIGHTS", "TILE_DPI",
+                    "TILE_GENE_ROWS",
+                    "tile_span", "tile_window", "tiles_covering", "TileRenderer", "TileRequestHandler",
+                    "make_tile_server", "serve_tiles"],
+}
+
+_NAME_SUBMODULES = { name: submodule for submodule, names in _SUBMODULE_NAMES.items() for name in names}
+
+__all__ = list(_NAME_SUBMODULES)
+
+
+# names of both a submodule and a function in it (basic_locuszoom, plot_r2_region, ...)
+_SHADOWED_NAMES = frozenset(_SUBMODULE_NAMES) & frozenset(_NAME_SUBMODULES)
+
+
+class _Package(types.ModuleType):
+    """The package module, keeping the functions named like their submodules bound to those names"""
+
+    def __setattr__(self, name, value):
+        # importing a submodule, however it is done, sets it as a package attribute,
+        # which must not hide the function of the same name
+        if name in _SHADOWED_NAMES and isinstance(value, types.ModuleType):
+            value = getattr(value, name, value)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
+
+
+def __getattr__(name):
+    submodule = _NAME_SUBMODULES.get(name)
+    if None == submodule:
+        if name in _SUBMODULE_NAMES:
+            return importlib.import_module("." + name, __name__)
+        raise AttributeError("module {m!r} has no attribute {n!r}".format(m=__name__, n=name))
+
+    value = getattr(importlib.import_module("." + submodule, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
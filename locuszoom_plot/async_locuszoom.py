@@ -0,0 +1,233 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### asyncio entry points for LD generation and plotting, for use inside
+### async web services
+###
+### PLINK runs through asyncio subprocesses, at most max_concurrency at a
+### time, each in its own scratch directory. Requests for LD that is already
+### being computed wait for that computation instead of starting another.
+
+
+
+import asyncio
+import contextvars
+import functools
+import os
+import shutil
+import tempfile
+import weakref
+
+from .instrumentation import span
+from .generate_plink_ld import plink_ld_params
+from .generate_plink_ld import load_plink_module
+from .generate_plink_ld import plink_bed_file_prefix_for
+from .plot_r2_region import load_plink_r2_results_file
+from .ld_cache import generate_ld_frame
+from .ld_cache import window_kb_for
+from .basic_locuszoom import basic_locuszoom
+from .multi_ancestry_locuszoom import multi_ancestry_locuszoom
+
+
+################################################################################
+
+# rough peak memory of one PLINK --r2 run over a 1000G chromosome, used to size the default concurrency
+PLINK_JOB_MEMORY = 1 << 30
+
+
+################################################################################
+
+
+def default_concurrency():
+    """Number of concurrent LD computations the machine has cores and memory for"""
+    cores = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return cores
+    return max(1, min(cores, memory // PLINK_JOB_MEMORY))
+
+
+async def invoke_system_async(command_parameters, timeout=None):
+    """Run a command given as a list of arguments without a shell; it is killed on timeout or cancellation"""
+    if "plink" == command_parameters[0]:
+        load_plink_module()
+    with span("invoke_system", command=os.path.basename(command_parameters[0])):
+        process = await asyncio.create_subprocess_exec(*command_parameters, stdout=asyncio.subprocess.DEVNULL)
+        try:
+            errcode = await asyncio.wait_for(process.wait(), timeout)
+        except BaseException:
+            # asyncio.TimeoutError or CancelledError, do not leave PLINK running
+            if None == process.returncode:
+                process.kill()
+                await process.wait()
+            raise
+    if 0 != errcode:
+        raise Exception("ERROR: failed (returns {errcode}):".format(errcode=errcode) + ' '.join(command_parameters) + '\n')
+
+
+async def generate_plink_ld_file_async(output_file, ancestry, chromosome_text, target_variant, locuszoom_template=None,
+                                       window_kb=1000, timeout=None):
+    """generate_plink_ld_file as a coroutine"""
+    plink_bed_file_prefix = plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text)
+
+    scratch_dir = tempfile.mkdtemp(prefix=".plink_ld_", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        scratch_output = os.path.join(scratch_dir, "ld")
+        params = plink_ld_params(plink_bed_file_prefix, ["--ld-snp", target_variant], scratch_output, window_kb)
+        await invoke_system_async(params, timeout=timeout)
+        os.replace(scratch_output + ".ld", output_file)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def _release_permit(semaphore, future):
+    semaphore.release()
+    if not future.cancelled():
+        future.exception()  # retrieved here, as the caller may have timed out or gone
+
+
+class _ResolvedLD(object):
+    """Stands in for an LDCache holding LD frames that were already computed, keyed by ancestry"""
+
+    def __init__(self, frames):
+        self.frames = frames
+
+
+    def ld_frame(self, ancestry, chromosome_text, target_variant, locuszoom_template, window_kb=1000, ld_engine="plink"):
+        return self.frames[ancestry]
+
+
+class AsyncLocuszoom(object):
+    """Coroutine versions of the locuszoom entry points computing LD from locuszoom_template
+
+    LD computations are limited to max_concurrency at a time (default from
+    default_concurrency) and each may take at most timeout seconds. A numpy
+    engine computation that times out keeps its slot until its thread
+    finishes, as the thread cannot be stopped. Identical requests in flight
+    share one computation; cancelling one caller does not cancel it for the
+    others. The limit and the sharing apply per event loop, so an instance
+    may be used from several loops, such as successive asyncio.run calls. Results go through ld_cache when given.
+    Reading files and drawing run in executor (default: the loop's default
+    thread pool), as the figures do not use pyplot. Spans are reported to an
+    instrument made current around the await with instrumentation.instrumented.
+    """
+
+    def __init__(self, locuszoom_template, ld_cache=None, ld_engine="plink", max_concurrency=None, timeout=None,
+                 executor=None):
+        self.locuszoom_template = locuszoom_template
+        self.ld_cache = ld_cache
+        self.ld_engine = ld_engine
+        self.max_concurrency = max_concurrency or default_concurrency()
+        self.timeout = timeout
+        self.executor = executor
+        self._loop_states = weakref.WeakKeyDictionary()
+
+
+    def _loop_state(self):
+        """Semaphore and in-flight computations of the running loop, as asyncio objects are bound to one loop"""
+        loop = asyncio.get_running_loop()
+        state = self._loop_states.get(loop)
+        if None == state:
+            state = { 'semaphore': asyncio.Semaphore(self.max_concurrency), 'in_flight': {} }
+            self._loop_states[loop] = state
+        return state
+
+
+    def _submit(self, f, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # in the caller's context, so spans of an active instrument are reported
+        return loop.run_in_executor(self.executor, functools.partial(contextvars.copy_context().run, f,
+                                                                     *args, **kwargs))
+
+
+    async def _run(self, f, *args, **kwargs):
+        return await self._submit(f, *args, **kwargs)
+
+
+    async def ld_frame(self, ancestry, chromosome_text, target_variant, window_kb=1000):
+        """LD frame of target_variant, see LDCache.ld_frame"""
+        key = (ancestry, chromosome_text, target_variant, window_kb)
+        loop_in_flight = self._loop_state()['in_flight']
+        in_flight = loop_in_flight.get(key)
+        if None == in_flight:
+            task = asyncio.ensure_future(self._compute_ld_frame(ancestry, chromosome_text, target_variant, window_kb))
+            in_flight = { 'task': task, 'waiters': 0 }
+            loop_in_flight[key] = in_flight
+            task.add_done_callback(functools.partial(self._computation_done, loop_in_flight, key))
+
+        task = in_flight['task']
+        in_flight['waiters'] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # the last caller waiting gave up, stop the computation too
+            if 1 == in_flight['waiters'] and not task.done():
+                task.cancel()
+            raise
+        finally:
+            in_flight['waiters'] -= 1
+
+
+    def _computation_done(self, loop_in_flight, key, task):
+        loop_in_flight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved here too, as the callers may all have gone
+
+
+    async def _compute_ld_frame(self, ancestry, chromosome_text, target_variant, window_kb):
+        cache_key = None
+        if None != self.ld_cache:
+            cache_key = await self._run(self.ld_cache.key, ancestry, chromosome_text, target_variant,
+                                        self.locuszoom_template, window_kb, self.ld_engine)
+            frame = await self._run(self.ld_cache.get, cache_key)
+            if frame is not None:
+                return frame
+
+        semaphore = self._loop_state()['semaphore']
+        if "plink" == self.ld_engine:
+            # PLINK is killed on timeout or cancellation, so the slot is free when this block exits
+            async with semaphore:
+                scratch_dir = tempfile.mkdtemp(prefix="locuszoom_ld_")
+                try:
+                    output_file = os.path.join(scratch_dir, "ld")
+                    await generate_plink_ld_file_async(output_file, ancestry, chromosome_text, target_variant,
+                                                       self.locuszoom_template, window_kb, timeout=self.timeout)
+                    frame = await self._run(load_plink_r2_results_file, output_file, target_variant)
+                finally:
+                    shutil.rmtree(scratch_dir, ignore_errors=True)
+        else:
+            # the executor thread runs on after a timeout, so it gives the slot back itself when it finishes
+            await semaphore.acquire()
+            try:
+                compute = self._submit(generate_ld_frame, ancestry, chromosome_text, target_variant,
+                                       locuszoom_template=self.locuszoom_template, window_kb=window_kb,
+                                       ld_engine=self.ld_engine)
+            except BaseException:
+                semaphore.release()
+                raise
+            compute.add_done_callback(functools.partial(_release_permit, semaphore))
+            frame = await asyncio.wait_for(asyncio.shield(compute), self.timeout)
+
+        if None != cache_key:
+            await self._run(self.ld_cache.put, cache_key, frame)
+        return frame
+
+
+    async def basic_locuszoom(self, pvalue_frame, target_variant, target_pos, fancy_name, ancestry,
+                              target_window_size=1000000, **kwargs):
+        """basic_locuszoom for ancestry, with LD from ld_frame; other keyword arguments are passed through"""
+        chromosome_text = target_variant.split(":")[0]
+        frame = await self.ld_frame(ancestry, chromosome_text, target_variant, window_kb_for(target_window_size))
+        return await self._run(basic_locuszoom, pvalue_frame, None, target_variant, target_pos, fancy_name,
+                               target_window_size=target_window_size, ancestry=ancestry,
+                               locuszoom_template=self.locuszoom_template, ld_cache=_ResolvedLD({ ancestry: frame}),
+                               **kwargs)
+
+
+    async def multi_ancestry_locuszoom(self, pvalue_frame, ancestries, target_variant, target_pos, fancy_name, **kwargs):
+        """multi_ancestry_locuszoom over ancestries, with their LD computed concurrently"""
+        chromosome_text = target_variant.split(":")[0]
+        frames = await asyncio.gather(*[ self.ld_frame(a, chromosome_text, target_variant) for a in ancestries])
+        return await self._run(multi_ancestry_locuszoom, pvalue_frame, [ (a, None) for a in ancestries],
+                               target_variant, target_pos, fancy_name, locuszoom_template=self.locuszoom_template,
+                               ld_cache=_ResolvedLD(dict(zip(ancestries, frames))), **kwargs)
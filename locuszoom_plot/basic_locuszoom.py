@@ -7,48 +7,78 @@
 
 
 import numpy as np
-import matplotlib.pyplot as pyplot
 
 from .plot_gene_region import load_gene_region_info
 from .plot_gene_region import sort_gene_locations
 from .plot_gene_region import plot_gene_region_worker
 
 
-from .plot_r2_region import plot_r2_region_worker
+from .plot_r2_region import bin_r2_region_points
+from .plot_r2_region import plot_r2_points_worker
 from .plot_r2_region import colorbar_magic
 from .plot_r2_region import load_and_format_pvalue_file_custom
-from .plot_r2_region import load_plink_r2_results_file
 from .plot_r2_region import merge_pvalue_ld
+from .plot_r2_region import select_pvalue_region
 
+from .ld_cache import resolve_ld_frame
+from .ld_cache import window_kb_for
 
+from .figures import new_figure
+from .figures import save_figure
+from .figures import release_figure
 
-
-################################################################################
+from .instrumentation import span
+from .instrumentation import instrumented
 
 
-################################################################################
 
 
-def basic_locuszoom(pvalue_frame, plink_file, target_variant, target_pos, fancy_name, target_window_size=1000000,
-                    output_plot=None, output_pdf=None, title=None, locuszoom_gene_db=None):
-
-    target_chromosome = target_variant.split(":")[0]
-    position_min = target_pos - (target_window_size)
-    position_max = target_pos + (target_window_size)
-    region_info = load_gene_region_info(target_chromosome, position_min, position_max, locuszoom_gene_db)
-    gene_rows = sort_gene_locations(region_info, position_min, position_max)
+################################################################################
 
 
+################################################################################
 
-    ld_frame = load_plink_r2_results_file(plink_file, target_variant, position_min, position_max)
-    pvalue_ld_result = merge_pvalue_ld(pvalue_frame, ld_frame)
 
+def basic_locuszoom(pvalue_frame, plink_file, target_variant, target_pos, fancy_name, target_window_size=1000000,
+                    output_plot=None, output_pdf=None, title=None, locuszoom_gene_db=None,
+                    ancestry=None, locuszoom_template=None, ld_cache=None, ld_engine="plink", decimate=False,
+                    instrument=None):
+    """Plot the association and gene tracks around target_variant, returns (n_rendered, n_input) scatter points
+
+    With decimate, points that cannot be seen at the plot resolution are
+    dropped before drawing, see decimate_r2_points. instrument receives a
+    span event for the plot and each of its stages, see instrumentation.span.
+    """
+    with instrumented(instrument), span("basic_locuszoom", target_variant=target_variant):
+        target_chromosome = target_variant.split(":")[0]
+        position_min = target_pos - (target_window_size)
+        position_max = target_pos + (target_window_size)
+        region_info = load_gene_region_info(target_chromosome, position_min, position_max, locuszoom_gene_db)
+        gene_rows = sort_gene_locations(region_info, position_min, position_max)
+
+
+
+        ld_frame = resolve_ld_frame(plink_file, target_variant, position_min, position_max, ancestry=ancestry,
+                                    locuszoom_template=locuszoom_template, ld_cache=ld_cache,
+                                    window_kb=window_kb_for(target_window_size), ld_engine=ld_engine)
+        pvalue_frame = select_pvalue_region(pvalue_frame, target_chromosome, position_min, position_max)
+        pvalue_ld_result = merge_pvalue_ld(pvalue_frame, ld_frame)
+        r2_points = bin_r2_region_points(pvalue_ld_result, target_variant)
+
+        return draw_basic_locuszoom(gene_rows, r2_points, position_min, position_max, fancy_name,
+                                    output_plot=output_plot, output_pdf=output_pdf, title=title, decimate=decimate)
+
+
+def draw_basic_locuszoom(gene_rows, r2_points, position_min, position_max, fancy_name, output_plot=None,
+                         output_pdf=None, title=None, decimate=False):
+    """Draw and save a basic locuszoom figure from packed gene rows and binned scatter points, see basic_locuszoom"""
     n_gene_rows = len(gene_rows)
 
-    pyplot.clf()
-    mainfig, (r2_axes, gene_axes) = pyplot.subplots(2,1, gridspec_kw={'height_ratios': [10, n_gene_rows]}, num=None, figsize=(8,6), dpi=150)    
+    mainfig = new_figure(figsize=(8,6), dpi=150)
+    r2_axes, gene_axes = mainfig.subplots(2,1, gridspec_kw={'height_ratios': [10, n_gene_rows]})
 
-    plot_r2_region_worker(r2_axes, pvalue_ld_result, target_variant, position_min, position_max, fancy_name)
+    point_counts = plot_r2_points_worker(r2_axes, r2_points, position_min, position_max, fancy_name,
+                                         decimate=decimate)
 
     plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max)
 
@@ -57,12 +87,9 @@ def basic_locuszoom(pvalue_frame, plink_file, target_variant, target_pos, fancy_
     if None != title:
         mainfig.suptitle(title)
 
-    if None != output_plot:
-        pyplot.savefig(output_plot, bbox_inches='tight');
-        pyplot.draw()
-    elif None != output_pdf:
-        output_pdf.savefig(mainfig)
-    else:
-        raise Exception("ERROR no output plot or output pdf object given")
-
+    try:
+        save_figure(mainfig, output_plot, output_pdf)
+    finally:
+        release_figure(mainfig)
 
+    return point_counts
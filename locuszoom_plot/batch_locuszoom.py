@@ -0,0 +1,179 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Render many locuszoom plots across a pool of worker processes
+
+
+
+import concurrent.futures
+import os
+import sys
+import time
+import traceback
+
+import pandas as pd
+
+from .gene_annotation_index import GeneAnnotationIndex
+from .ld_cache import LDCache
+from .basic_locuszoom import basic_locuszoom
+from .multi_ancestry_locuszoom import multi_ancestry_locuszoom
+from .multi_region import extract_pvalue_regions
+from .instrumentation import instrumented
+
+
+################################################################################
+
+# per-process state set up by _init_batch_worker
+_worker_state = {}
+
+
+################################################################################
+
+
+def locus_ancestries(ancestry):
+    """Ancestry set of a locus, given as a list/tuple/set or a comma separated string"""
+    if isinstance(ancestry, str):
+        return [ a.strip() for a in ancestry.split(",") if len(a.strip()) > 0]
+    return list(ancestry)
+
+
+def locus_field(locus, key, default=None):
+    """Optional scalar field of a locus dict, default when absent or missing (None/NaN, as frame rows give)"""
+    value = locus.get(key)
+    if value is None or pd.isnull(value):
+        return default
+    return value
+
+
+def locus_window(locus):
+    """(chrom, position_min, position_max) plotted for a locus dict"""
+    target_pos = int(locus['target_pos'])
+    window = locus_field(locus, 'target_window_size', 1000000)
+    if 1 < len(locus_ancestries(locus['ancestry'])):
+        window = 1000000
+    return (locus['target_variant'].split(":")[0], target_pos - int(window), target_pos + int(window))
+
+
+def prepare_batch_loci(loci, pvalue_frame):
+    """(list of locus dicts, shared pvalue frame) for a batch, see iter_locuszoom_batch"""
+    if isinstance(loci, pd.DataFrame):
+        loci = loci.to_dict('records')
+    if isinstance(pvalue_frame, str):
+        regions = extract_pvalue_regions(pvalue_frame, [ locus_window(locus) for locus in loci])
+        loci = [ dict(locus, pvalue_frame=region) for locus, region in zip(loci, regions)]
+        pvalue_frame = None
+    return list(loci), pvalue_frame
+
+
+def _init_batch_worker(pvalue_frame, locuszoom_gene_db, locuszoom_template, ld_cache_dir, ld_engine):
+    _worker_state['pvalue_frame'] = pvalue_frame
+    _worker_state['gene_index'] = GeneAnnotationIndex(locuszoom_gene_db)
+    _worker_state['locuszoom_template'] = locuszoom_template
+    _worker_state['ld_cache'] = None if None == ld_cache_dir else LDCache(ld_cache_dir)
+    _worker_state['ld_engine'] = ld_engine
+
+
+def render_locus(locus):
+    """Render one locus dict with the worker's shared pvalue frame and caches
+
+    Keys are target_variant, target_pos, fancy_name, output_plot and ancestry,
+    with optional title, target_window_size and plink_file (single ancestry only),
+    and pvalue_frame to use instead of the shared one.
+    """
+    ancestries = locus_ancestries(locus['ancestry'])
+    pvalue_frame = locus.get('pvalue_frame')
+    if pvalue_frame is None:
+        pvalue_frame = _worker_state['pvalue_frame']
+    common = { 'output_plot': locus['output_plot'],
+               'title': locus_field(locus, 'title'),
+               'locuszoom_gene_db': _worker_state['gene_index'],
+               'locuszoom_template': _worker_state['locuszoom_template'],
+               'ld_cache': _worker_state['ld_cache'],
+               'ld_engine': _worker_state['ld_engine'] }
+
+    if 1 == len(ancestries):
+        basic_locuszoom(pvalue_frame, locus_field(locus, 'plink_file'), locus['target_variant'],
+                        int(locus['target_pos']), locus['fancy_name'],
+                        target_window_size=int(locus_field(locus, 'target_window_size', 1000000)),
+                        ancestry=ancestries[0], **common)
+    else:
+        ancestry_file_set = [ (a, None) for a in ancestries]
+        multi_ancestry_locuszoom(pvalue_frame, ancestry_file_set, locus['target_variant'],
+                                 int(locus['target_pos']), locus['fancy_name'], **common)
+
+
+def _render_batch_item(index, locus, collect_spans=False):
+    start = time.perf_counter()
+    error = None
+    spans = [] if collect_spans else None
+    try:
+        with instrumented(None if None == spans else spans.append):
+            render_locus(locus)
+    except Exception:
+        error = traceback.format_exc()
+
+    return { 'index': index,
+             'target_variant': locus['target_variant'],
+             'output_plot': locus['output_plot'],
+             'seconds': time.perf_counter() - start,
+             'error': error,
+             'pid': os.getpid(),
+             'spans': spans }
+
+
+def _forward_spans(result, instrument):
+    """Pass the span events a worker collected for result on to instrument, tagged with the locus"""
+    spans = result.pop('spans')
+    if None == instrument or None == spans:
+        return
+    for event in spans:
+        event.setdefault('target_variant', result['target_variant'])
+        instrument(event)
+
+
+def report_batch_progress(done, total, result):
+    """Progress callback printing one line per finished locus to stderr"""
+    status = "ok" if None == result['error'] else "FAILED"
+    sys.stderr.write("[{d}/{t}] {v} {s} {sec:.2f}s\n".format(d=done, t=total, v=result['target_variant'],
+                                                             s=status, sec=result['seconds']))
+    if None != result['error']:
+        sys.stderr.write(result['error'])
+
+
+def iter_locuszoom_batch(loci, pvalue_frame, locuszoom_gene_db, locuszoom_template=None, ld_cache_dir=None,
+                         ld_engine="plink", processes=None, ordered=True, progress=None, instrument=None):
+    """Render loci (a frame or list of dicts, see render_locus) in a process pool, yielding one result per locus
+
+    Each result is a dict with index, target_variant, output_plot, seconds and
+    error (None or the formatted traceback). Results come in input order when
+    ordered is True, otherwise as soon as each locus finishes. Every worker
+    keeps its own gene annotation index and LD cache handle for all the loci
+    it renders, and draws figures on their own Agg canvas rather than pyplot.
+
+    pvalue_frame may also be the name of a CSV file with chrom, position,
+    pvalue (and optionally variant) columns: the windows of all loci are then
+    extracted in one pass over the file and each worker only receives its
+    locus' rows.
+
+    With an instrument (e.g. a SpanAggregator), workers record the span
+    events of each locus and they are passed to it here as results arrive.
+    """
+    loci, pvalue_frame = prepare_batch_loci(loci, pvalue_frame)
+    total = len(loci)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_worker,
+                                                initargs=(pvalue_frame, locuszoom_gene_db, locuszoom_template,
+                                                          ld_cache_dir, ld_engine)) as executor:
+        futures = [ executor.submit(_render_batch_item, i, locus, None != instrument) for i, locus in enumerate(loci)]
+        finished = futures if ordered else concurrent.futures.as_completed(futures)
+        for done, future in enumerate(finished, start=1):
+            result = future.result()
+            _forward_spans(result, instrument)
+            if None != progress:
+                progress(done, total, result)
+            yield result
+
+
+def locuszoom_batch(loci, pvalue_frame, locuszoom_gene_db, **kwargs):
+    """Render all loci, see iter_locuszoom_batch, and return a frame of per-locus results"""
+    results = list(iter_locuszoom_batch(loci, pvalue_frame, locuszoom_gene_db, **kwargs))
+    return pd.DataFrame(results, columns=['index', 'target_variant', 'output_plot', 'seconds', 'error', 'pid'])
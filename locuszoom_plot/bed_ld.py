@@ -0,0 +1,162 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### In-process LD from PLINK .bed/.bim/.fam filesets, without running PLINK
+###
+### The .bed file is memory-mapped and only the variants inside the LD window
+### are decoded, then r2 of the lead variant against the window is computed
+### as one vectorized correlation.
+
+
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrument_stage
+from .generate_plink_ld import plink_bed_file_prefix_for
+from .generate_plink_ld import plink_bfile_signature
+
+
+################################################################################
+
+BED_MAGIC = b"\x6c\x1b\x01"  # SNP-major .bed
+
+# 2-bit .bed codes as copies of the A1 allele: 00 hom A1, 01 missing, 10 het, 11 hom A2
+BED_CODE_DOSAGE = np.array([2, -1, 1, 0], dtype=np.int8)
+
+# dosage of the four samples packed in each possible byte, first sample in the low bits
+BED_BYTE_DOSAGE = BED_CODE_DOSAGE[(np.arange(256)[:, None] >> np.array([0, 2, 4, 6])) & 3]
+
+BIM_COLUMNS = ["chrom", "variant", "cm", "position", "a1", "a2"]
+
+
+################################################################################
+
+
+class PlinkBedFile(object):
+    """Memory-mapped PLINK fileset, decoding genotypes for selected variants on demand"""
+
+    def __init__(self, plink_bed_file_prefix):
+        self.prefix = plink_bed_file_prefix
+        self.bim = pd.read_csv(plink_bed_file_prefix + ".bim", sep=r"\s+", header=None, names=BIM_COLUMNS,
+                               dtype={ "chrom": str, "variant": str, "cm": np.float64, "position": np.int64,
+                                       "a1": str, "a2": str})
+        with open(plink_bed_file_prefix + ".fam") as f:
+            self.n_samples = sum(1 for line in f if len(line.strip()) > 0)
+
+        self.bytes_per_variant = (self.n_samples + 3) // 4
+        self.bed = np.memmap(plink_bed_file_prefix + ".bed", dtype=np.uint8, mode="r")
+        if bytes(self.bed[:3]) != BED_MAGIC:
+            raise Exception("ERROR {f}.bed is not a SNP-major PLINK 1 .bed file".format(f=plink_bed_file_prefix))
+        expected_size = 3 + len(self.bim) * self.bytes_per_variant
+        if len(self.bed) != expected_size:
+            raise Exception("ERROR {f}.bed has {n} bytes, expected {e} from .bim/.fam".format(
+                f=plink_bed_file_prefix, n=len(self.bed), e=expected_size))
+
+        self.positions = self.bim['position'].to_numpy()
+        self.variant_rows = pd.Index(self.bim['variant'])
+        chrom = self.bim['chrom'].to_numpy()
+        self.sorted = bool(np.all(chrom[1:] == chrom[:-1]) and np.all(np.diff(self.positions) >= 0))
+
+
+    def variant_row(self, variant):
+        rows = self.variant_rows.get_indexer_for([variant])
+        if 0 == len(rows) or rows[0] < 0:
+            raise Exception("ERROR variant {v} not found in {f}.bim".format(v=variant, f=self.prefix))
+        return rows[0]
+
+
+    def window_rows(self, row, window_kb):
+        """Rows on the same chromosome within window_kb of row, as a slice or an index array"""
+        position = self.positions[row]
+        distance = window_kb * 1000
+        if self.sorted:
+            lo = np.searchsorted(self.positions, position - distance, side="left")
+            hi = np.searchsorted(self.positions, position + distance, side="right")
+            return slice(lo, hi)
+        chrom = self.bim['chrom'].to_numpy()
+        return np.flatnonzero((chrom == chrom[row]) & (np.abs(self.positions - position) <= distance))
+
+
+    def genotypes(self, rows):
+        """int8 matrix of A1 dosages (variants x samples), -1 where missing"""
+        packed = self.bed[3:].reshape(len(self.bim), self.bytes_per_variant)[rows]
+        dosage = BED_BYTE_DOSAGE[packed].reshape(packed.shape[0], -1)
+        return dosage[:, :self.n_samples]
+
+
+
+def _called_dosages(genotypes):
+    """(called, dosage) float32 arrays of genotypes, missing calls zero in both"""
+    called = genotypes >= 0
+    return called.astype(np.float32), np.where(called, genotypes, 0).astype(np.float32)
+
+
+def ld_r2_matrix(genotypes_a, genotypes_b):
+    """r2 of every row of genotypes_a with every row of genotypes_b (rows x rows), over samples called in both"""
+    # float32 sums of small integer dosages are exact, then finish in float64
+    called_a, x = _called_dosages(genotypes_a)
+    called_b, y = _called_dosages(genotypes_b)
+
+    n = (called_a @ called_b.T).astype(np.float64)
+    sum_x = (x @ called_b.T).astype(np.float64)
+    sum_xx = ((x * x) @ called_b.T).astype(np.float64)
+    sum_y = (called_a @ y.T).astype(np.float64)
+    sum_yy = (called_a @ (y * y).T).astype(np.float64)
+    sum_xy = (x @ y.T).astype(np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = n * sum_xy - sum_x * sum_y
+        variance = (n * sum_xx - sum_x * sum_x) * (n * sum_yy - sum_y * sum_y)
+        return covariance * covariance / variance
+
+
+def ld_r2_against(lead, genotypes):
+    """r2 of the lead dosage vector with each row of genotypes, the one-row case of ld_r2_matrix"""
+    return ld_r2_matrix(lead[None, :], genotypes)[0]
+
+
+_bed_files = {}
+_bed_files_lock = threading.Lock()
+
+
+def open_plink_bed_file(plink_bed_file_prefix):
+    """PlinkBedFile for the prefix, reused while the .bed/.bim/.fam files are unchanged"""
+    signature = plink_bfile_signature(plink_bed_file_prefix)
+    key = os.path.abspath(plink_bed_file_prefix)
+
+    with _bed_files_lock:
+        cached = _bed_files.get(key)
+        if None != cached and cached[0] == signature:
+            return cached[1]
+        bed_file = PlinkBedFile(plink_bed_file_prefix)
+        _bed_files[key] = (signature, bed_file)
+        return bed_file
+
+
+@instrument_stage(rows=len)
+def plink_bed_ld_frame(plink_bed_file_prefix, target_variant, window_kb=1000):
+    """LD of target_variant against its window, in the frame shape of load_plink_r2_results_file"""
+    bed_file = open_plink_bed_file(plink_bed_file_prefix)
+    row = bed_file.variant_row(target_variant)
+    rows = bed_file.window_rows(row, window_kb)
+
+    r2 = ld_r2_against(bed_file.genotypes([row])[0], bed_file.genotypes(rows))
+    window = bed_file.bim.iloc[rows]
+
+    # like PLINK --ld-window-r2 0, pairs without a defined r2 are not reported
+    keep = ~np.isnan(r2)
+    window = window[keep]
+    return pd.DataFrame({ "target_variant": target_variant,
+                          "chrom": pd.Categorical(window['chrom']),
+                          "position": window['position'].to_numpy(),
+                          "variant": window['variant'].to_numpy(),
+                          "ld_r2": np.clip(r2[keep], 0, 1).astype(np.float32) })
+
+
+def generate_bed_ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template=None, window_kb=1000):
+    """Same as generate_plink_ld_frame, computed in-process from the reference panel .bed"""
+    plink_bed_file_prefix = plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text)
+    return plink_bed_ld_frame(plink_bed_file_prefix, target_variant, window_kb)
@@ -0,0 +1,49 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Figure construction without pyplot global state, so figures can be
+### built concurrently from several threads and freed deterministically
+
+
+
+# matplotlib is imported on first use, so modules that only load data stay light to import
+
+from .instrumentation import instrument_stage
+
+
+################################################################################
+
+
+def new_figure(figsize=(8,6), dpi=150, interactive=False):
+    """Figure with its own Agg canvas, or a pyplot managed figure when it is to be shown on screen"""
+    if interactive:
+        import matplotlib.pyplot as pyplot
+        return pyplot.figure(figsize=figsize, dpi=dpi)
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+@instrument_stage()
+def save_figure(figure, output_plot=None, output_pdf=None):
+    if None != output_plot:
+        figure.savefig(output_plot, bbox_inches='tight')
+    elif None != output_pdf:
+        output_pdf.savefig(figure)
+    else:
+        raise Exception("ERROR no output plot or output pdf object given")
+
+
+def show_figure(figure):
+    import matplotlib.pyplot as pyplot
+    pyplot.show()
+
+
+def release_figure(figure):
+    """Free a figure's artists, and unregister it from pyplot if it was shown"""
+    figure.clear()
+    if None != getattr(figure.canvas, 'manager', None):
+        import matplotlib.pyplot as pyplot
+        pyplot.close(figure)
@@ -0,0 +1,119 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### In-memory refFlat gene models, loaded once and shared across plots
+
+
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .plot_gene_region import get_gene_db_connection
+
+
+################################################################################
+
+
+def _exon_csr(values):
+    """Flatten comma separated refFlat exon lists into (offsets, positions) arrays"""
+    counts = np.array([ v.count(',') + (0 if v.endswith(',') or 0 == len(v) else 1) for v in values], dtype=np.int64)
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    joined = ','.join(v.strip(',') for v in values if len(v.strip(',')) > 0)
+    if 0 == len(joined):
+        positions = np.zeros(0, dtype=np.int64)
+    else:
+        positions = np.array(joined.split(','), dtype=np.int64)
+    return offsets, positions
+
+
+class GeneAnnotationIndex(object):
+    """refFlat gene models held as NumPy arrays, loaded lazily one chromosome at a time
+
+    An instance can be passed anywhere a locuszoom_gene_db path is accepted, so
+    a batch of plots only reads and parses the gene annotation once.
+    """
+
+    def __init__(self, locuszoom_gene_db, chromosomes=None):
+        self.locuszoom_gene_db = locuszoom_gene_db
+        self._chromosomes = {}
+        self._lock = threading.Lock()
+        for chromosome in chromosomes or []:
+            self.chromosome_genes(chromosome)
+
+
+    def chromosome_genes(self, chromosome):
+        """Return the dict of arrays for chromosome, loading it from the gene database on first use"""
+        with self._lock:
+            genes = self._chromosomes.get(chromosome)
+            if None == genes:
+                genes = self._load_chromosome(chromosome)
+                self._chromosomes[chromosome] = genes
+            return genes
+
+
+    def _load_chromosome(self, chromosome):
+        conn = get_gene_db_connection(self.locuszoom_gene_db)
+        cursor = conn.execute("SELECT * FROM refFlat WHERE chrom = ? ORDER BY rowid", (chromosome,))
+        records = cursor.fetchall()
+        columns = [ t[0] for t in cursor.description]
+        frame = pd.DataFrame.from_records(records, columns=columns)
+
+        # arrays are kept in txStart order, table_rank remembers the refFlat row order
+        frame['table_rank'] = np.arange(len(frame), dtype=np.int64)
+        frame = frame.sort_values(by="txStart", kind="mergesort").reset_index(drop=True)
+
+        tx_start = frame['txStart'].to_numpy(dtype=np.int64)
+        tx_end = frame['txEnd'].to_numpy(dtype=np.int64)
+        name_codes, names = pd.factorize(frame['geneName'])
+        exon_start_offsets, exon_starts = _exon_csr(frame['exonStarts'].astype(str).tolist())
+        exon_end_offsets, exon_ends = _exon_csr(frame['exonEnds'].astype(str).tolist())
+
+        other_columns = [ c for c in columns if c not in ('txStart', 'txEnd', 'exonStarts', 'exonEnds')]
+        return { 'columns': columns,
+                 'tx_start': tx_start,
+                 'tx_end': tx_end,
+                 'max_tx_end': np.maximum.accumulate(tx_end) if len(tx_end) > 0 else tx_end,
+                 'table_rank': frame['table_rank'].to_numpy(),
+                 'name_codes': name_codes.astype(np.int32),
+                 'exon_start_offsets': exon_start_offsets,
+                 'exon_starts': exon_starts,
+                 'exon_end_offsets': exon_end_offsets,
+                 'exon_ends': exon_ends,
+                 'other': { c: frame[c].to_numpy() for c in other_columns} }
+
+
+    def query(self, chromosome, position_min, position_max):
+        """Return indices of genes overlapping [position_min, position_max], in txStart order
+
+        Duplicate gene names keep the first record in refFlat table order, as
+        load_gene_region_info does.
+        """
+        genes = self.chromosome_genes(chromosome)
+        # everything before lo ends before the window, everything from hi on starts after it
+        hi = np.searchsorted(genes['tx_start'], position_max, side='right')
+        lo = np.searchsorted(genes['max_tx_end'], position_min, side='left')
+        if hi <= lo:
+            return np.zeros(0, dtype=np.int64)
+        candidates = lo + np.flatnonzero(genes['tx_end'][lo:hi] >= position_min)
+
+        by_rank = candidates[np.argsort(genes['table_rank'][candidates], kind='mergesort')]
+        _, first = np.unique(genes['name_codes'][by_rank], return_index=True)
+        return np.sort(by_rank[first])
+
+
+    def region_info(self, chromosome, position_min, position_max):
+        """Same frame as load_gene_region_info, with exonStarts/exonEnds already split into int lists"""
+        genes = self.chromosome_genes(chromosome)
+        selected = self.query(chromosome, position_min, position_max)
+
+        starts_offsets = genes['exon_start_offsets']
+        ends_offsets = genes['exon_end_offsets']
+        data = { 'txStart': genes['tx_start'][selected],
+                 'txEnd': genes['tx_end'][selected],
+                 'exonStarts': [ genes['exon_starts'][starts_offsets[i]:starts_offsets[i+1]].tolist() for i in selected],
+                 'exonEnds': [ genes['exon_ends'][ends_offsets[i]:ends_offsets[i+1]].tolist() for i in selected] }
+        for c, values in genes['other'].items():
+            data[c] = values[selected]
+        return pd.DataFrame(data, columns=genes['columns'])
@@ -7,19 +7,36 @@
 
 
 import os
+import shlex
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 
+from .instrumentation import span
 
 
 
 ################################################################################
 ### MAGIC ENVIRONMENT MODULE STUFF
-### Automatically load plink environment module when this module is loaded
+### Automatically load plink environment module before the first PLINK run
 
-if "LMOD_PACKAGE_PATH" in os.environ:
-    sys.path.insert(0, os.path.join(os.environ["LMOD_PACKAGE_PATH"], "lmod/init"))
-    from env_modules_python import module
-    module('load','plink')
+_plink_module_lock = threading.Lock()
+_plink_module_loaded = False
+
+
+def load_plink_module():
+    """Load the plink LMOD environment module once per process, when LMOD is available"""
+    global _plink_module_loaded
+    with _plink_module_lock:
+        if _plink_module_loaded:
+            return
+        if "LMOD_PACKAGE_PATH" in os.environ:
+            sys.path.insert(0, os.path.join(os.environ["LMOD_PACKAGE_PATH"], "lmod/init"))
+            from env_modules_python import module
+            module('load','plink')
+        _plink_module_loaded = True
 
 
 
@@ -32,45 +49,155 @@ if "LMOD_PACKAGE_PATH" in os.environ:
 ################################################################################
 
 
-def invoke_system(command_parameters):
-    cmd = ' '.join(command_parameters)
-    errcode = os.system(cmd)
+def invoke_system(command_parameters, timeout=None):
+    """Run a command given as a list of arguments, without a shell, so paths may contain spaces"""
+    cmd = ' '.join(shlex.quote(p) for p in command_parameters)
+    if "plink" == command_parameters[0]:
+        load_plink_module()
+    try:
+        with span("invoke_system", command=os.path.basename(command_parameters[0])):
+            errcode = subprocess.run(command_parameters, stdout=subprocess.DEVNULL, timeout=timeout).returncode
+    except subprocess.TimeoutExpired:
+        raise Exception("ERROR: timed out after {t}s: ".format(t=timeout) + cmd + '\n')
     if 0 != errcode:
         raise Exception("ERROR: failed (returns {errcode}):".format(errcode=errcode) + cmd + '\n')
 
 
 
-def generate_plink_ld_file(output_file, ancestry, chromosome_text, target_variant, locuszoom_template=None, window_kb=1000):
-    #known_sets = set(["AFR", "ASN", "AMR", "EUR", "SAN"])
+def plink_ld_params(plink_bed_file_prefix, ld_snp_params, output_file, window_kb=1000):
+    return [ "plink",
+             "--bfile", plink_bed_file_prefix,
+             "--r2"] + ld_snp_params + [
+             "--ld-window-kb", str(window_kb),
+             "--ld-window", "99999",
+             "--ld-window-r2", "0",
+             "--out", output_file
+    ]
 
-    #if ancestry not in known_sets:
-    #    raise Exception("ERROR unknown ancestry: {a}".format(a=ancestry))
 
-    if None == locuszoom_template:
-        raise Exception("ERROR locuszoom template for files not specified, expecting format like '/path/{ancestry}/{chrom}'")
 
-    plink_bed_file_prefix = locuszoom_template.format(ancestry=ancestry, chrom=chromosome_text)
+PLINK_BFILE_SUFFIXES = [".bed", ".bim", ".fam"]
 
 
-    params = [ "plink",
-               "--bfile", plink_bed_file_prefix,
-               "--r2",
-               "--ld-snp", target_variant,
-               "--ld-window-kb", str(window_kb),
-               "--ld-window", "99999",
-               "--ld-window-r2", "0",
-               "--out", output_file
-    ]
+def file_signature(filename):
+    """(size, modification time in ns) of filename, or None when it cannot be stat'ed"""
+    try:
+        st = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+    return (st.st_size, st.st_mtime_ns)
 
 
-    invoke_system(params)
+def plink_bfile_signature(plink_bed_file_prefix):
+    """Identify a PLINK fileset by path, size and modification time of its .bed/.bim/.fam files"""
+    parts = [os.path.abspath(plink_bed_file_prefix)]
+    for suffix in PLINK_BFILE_SUFFIXES:
+        signature = file_signature(plink_bed_file_prefix + suffix)
+        if None != signature:
+            parts.append("{s}:{size}:{mtime}".format(s=suffix, size=signature[0], mtime=signature[1]))
+    return "|".join(parts)
 
-    plink_out = output_file + ".ld"
-    plink_log = output_file + ".log"
-    plink_nosex = output_file + ".nosex"
 
-    os.unlink(plink_log)
-    os.unlink(plink_nosex)
-    os.rename(plink_out, output_file)
+def plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text):
+    if None == locuszoom_template:
+        raise Exception("ERROR locuszoom template for files not specified, expecting format like '/path/{ancestry}/{chrom}'")
+    return locuszoom_template.format(ancestry=ancestry, chrom=chromosome_text)
+
+
+def generate_plink_ld_file(output_file, ancestry, chromosome_text, target_variant, locuszoom_template=None, window_kb=1000,
+                           timeout=None):
+    """Run PLINK --r2 for target_variant and write its .ld output to output_file
 
+    PLINK writes into a private scratch directory next to output_file, which
+    is then replaced atomically, so concurrent calls for the same output
+    never see each other's partial files.
+    """
+    #known_sets = set(["AFR", "ASN", "AMR", "EUR", "SAN"])
+
+    #if ancestry not in known_sets:
+    #    raise Exception("ERROR unknown ancestry: {a}".format(a=ancestry))
 
+    plink_bed_file_prefix = plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text)
+
+    scratch_dir = tempfile.mkdtemp(prefix=".plink_ld_", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        scratch_output = os.path.join(scratch_dir, "ld")
+        params = plink_ld_params(plink_bed_file_prefix, ["--ld-snp", target_variant], scratch_output, window_kb)
+        invoke_system(params, timeout=timeout)
+        os.replace(scratch_output + ".ld", output_file)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+
+
+def generate_plink_ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template=None, window_kb=1000):
+    """Run PLINK for target_variant in a scratch directory and return the loaded LD frame"""
+    from .plot_r2_region import load_plink_r2_results_file
+
+    with tempfile.TemporaryDirectory(prefix="locuszoom_ld_") as scratch_dir:
+        output_file = os.path.join(scratch_dir, "ld")
+        generate_plink_ld_file(output_file, ancestry, chromosome_text, target_variant,
+                               locuszoom_template=locuszoom_template, window_kb=window_kb)
+        return load_plink_r2_results_file(output_file, target_variant)
+
+
+
+def generate_plink_ld_batch(lead_variants, locuszoom_template=None, window_kb=1000, output_dir=None, ld_cache=None):
+    """Compute LD for many lead variants with one PLINK run per (ancestry, chromosome)
+
+    lead_variants is a list of (ancestry, chromosome_text, target_variant). The
+    result maps each of those tuples to its LD frame, or to the path of a
+    PLINK-formatted .ld file written under output_dir when one is given. When
+    returning frames, leads already held in ld_cache are not recomputed and new
+    results are stored there.
+    """
+    import pandas as pd
+    from .plot_r2_region import load_plink_r2_results_file
+
+    results = {}
+    groups = {}
+    for lead in lead_variants:
+        ancestry, chromosome_text, target_variant = lead
+        if lead in results or target_variant in groups.get((ancestry, chromosome_text), []):
+            continue
+        if None != ld_cache and None == output_dir:
+            frame = ld_cache.get(ld_cache.key(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb))
+            if frame is not None:
+                results[lead] = frame
+                continue
+        groups.setdefault((ancestry, chromosome_text), []).append(target_variant)
+
+    for (ancestry, chromosome_text), target_variants in groups.items():
+        plink_bed_file_prefix = plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text)
+
+        with tempfile.TemporaryDirectory(prefix="locuszoom_ld_") as scratch_dir:
+            snp_list_file = os.path.join(scratch_dir, "lead_variants.txt")
+            with open(snp_list_file, "w") as f:
+                f.write("\n".join(target_variants) + "\n")
+
+            output_file = os.path.join(scratch_dir, "ld")
+            invoke_system(plink_ld_params(plink_bed_file_prefix, ["--ld-snp-list", snp_list_file], output_file, window_kb))
+            plink_out = output_file + ".ld"
+
+            if None != output_dir:
+                # keep every PLINK column, one file per lead variant
+                combined = pd.read_csv(plink_out, sep=r"\s+", dtype=str)
+                by_target = dict(list(combined.groupby("SNP_A", sort=False)))
+                for target_variant in target_variants:
+                    filename = os.path.join(output_dir, "{v}_{a}.ld".format(v=target_variant, a=ancestry))
+                    frame = by_target.get(target_variant, combined.iloc[0:0])
+                    frame.to_csv(filename, sep=" ", index=False)
+                    results[(ancestry, chromosome_text, target_variant)] = filename
+                continue
+
+            combined = load_plink_r2_results_file(plink_out)
+
+        by_target = dict(list(combined.groupby("target_variant", sort=False, observed=True)))
+        for target_variant in target_variants:
+            frame = by_target.get(target_variant, combined.iloc[0:0]).reset_index(drop=True)
+            results[(ancestry, chromosome_text, target_variant)] = frame
+            if None != ld_cache:
+                ld_cache.put(ld_cache.key(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb), frame)
+
+    return results
@@ -0,0 +1,291 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Opt-in timing and memory instrumentation of the plotting pipeline
+###
+### An instrument is any callable taking one span event (a dict). Entry points
+### such as basic_locuszoom take it as instrument= and make it current for the
+### call; every instrumented stage running in that context, down to PLINK in
+### invoke_system, then reports one event when it finishes. With no instrument
+### current a stage costs one context variable lookup.
+
+
+
+import contextlib
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, peak RSS and child CPU are then not reported
+    resource = None
+
+
+################################################################################
+
+# (instrument, name of the enclosing stage) for the running context
+_current = contextvars.ContextVar("locuszoom_instrument", default=None)
+
+# ru_maxrss is in kilobytes on Linux, bytes on macOS
+_MAXRSS_UNIT = 1 if "darwin" == sys.platform else 1024
+
+
+################################################################################
+
+
+def _usage():
+    if None == resource:
+        return None, None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_maxrss * _MAXRSS_UNIT, children.ru_utime + children.ru_stime
+
+
+class _Span(object):
+    """One running stage, reported to the instrument when it exits; set rows to record a row count"""
+
+    def __init__(self, instrument, stage, parent, attributes):
+        self.instrument = instrument
+        self.stage = stage
+        self.parent = parent
+        self.attributes = attributes
+        self.rows = None
+
+
+    def __enter__(self):
+        self._token = _current.set((self.instrument, self.stage))
+        self._max_rss, self._child_cpu = _usage()
+        self._start_time = time.time()
+        self._start_cpu = time.thread_time()
+        self._start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall_seconds = time.perf_counter() - self._start
+        cpu_seconds = time.thread_time() - self._start_cpu
+        max_rss, child_cpu = _usage()
+        _current.reset(self._token)
+
+        event = { 'stage': self.stage,
+                  'parent': self.parent,
+                  'start': self._start_time,
+                  'wall_seconds': wall_seconds,
+                  'cpu_seconds': cpu_seconds,
+                  'child_cpu_seconds': None if None == child_cpu else child_cpu - self._child_cpu,
+                  'peak_rss_delta': None if None == max_rss else max_rss - self._max_rss,
+                  'rows': self.rows,
+                  'error': None if None == exc_type else exc_type.__name__,
+                  'pid': os.getpid(),
+                  'thread': threading.current_thread().name }
+        event.update(self.attributes)
+        self.instrument(event)
+        return False
+
+
+class _NoSpan(object):
+    """Stands in for a span when nothing is instrumented"""
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+    def __setattr__(self, name, value):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+
+def span(stage, **attributes):
+    """Context manager timing stage for the current instrument, if any
+
+    The event holds stage, parent (the enclosing stage or None), start (epoch
+    seconds), wall_seconds, cpu_seconds (this thread), child_cpu_seconds
+    (finished subprocesses such as PLINK), peak_rss_delta (bytes the process
+    peak RSS grew by), rows, error (exception class name or None), pid,
+    thread and the given attributes.
+    """
+    current = _current.get()
+    if None == current:
+        return _NO_SPAN
+    return _Span(current[0], stage, current[1], attributes)
+
+
+def instrument_stage(stage=None, rows=None):
+    """Decorator running a function inside span(stage, default its name), rows(result) giving its row count"""
+    def decorate(f):
+        name = stage or f.__name__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            current = _current.get()
+            if None == current:
+                return f(*args, **kwargs)
+            with _Span(current[0], name, current[1], {}) as s:
+                result = f(*args, **kwargs)
+                if None != rows:
+                    s.rows = rows(result)
+            return result
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def instrumented(instrument):
+    """Make instrument current within the block; None leaves any current instrument in place"""
+    if None == instrument:
+        yield
+        return
+    token = _current.set((instrument, None))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def in_context(f):
+    """f bound to a copy of the current context, to submit to a thread pool so its spans are reported"""
+    return functools.partial(contextvars.copy_context().run, f)
+
+
+################################################################################
+
+
+class SpanAggregator(object):
+    """Instrument collecting span events, with percentile summaries per stage over a batch run"""
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+
+    def frame(self):
+        import pandas as pd
+        with self._lock:
+            return pd.DataFrame(list(self.events))
+
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Frame of count, total and percentile wall seconds, mean CPU seconds, max peak RSS growth and rows per stage"""
+        import numpy as np
+        import pandas as pd
+
+        frame = self.frame()
+        if 0 == len(frame):
+            return pd.DataFrame()
+
+        summaries = []
+        for stage, group in frame.groupby('stage', sort=False):
+            wall = group['wall_seconds'].to_numpy(dtype=np.float64)
+            summary = { 'stage': stage,
+                        'count': len(group),
+                        'total_s': wall.sum() }
+            for p in percentiles:
+                summary['p{p}_s'.format(p=p)] = np.percentile(wall, p)
+            summary['mean_cpu_s'] = group['cpu_seconds'].mean()
+            summary['child_cpu_s'] = group['child_cpu_seconds'].sum(min_count=1)
+            summary['max_rss_delta_mb'] = group['peak_rss_delta'].max() / 2**20
+            summary['rows'] = group['rows'].sum(min_count=1)
+            summaries.append(summary)
+        summary_frame = pd.DataFrame(summaries).set_index('stage')
+        summary_frame['rows'] = summary_frame['rows'].astype('Int64')
+        return summary_frame
+
+
+    def print_summary(self, percentiles=(50, 90, 99), file=None):
+        summary = self.summary(percentiles)
+        file = file or sys.stdout
+        if 0 == len(summary):
+            file.write("no spans recorded\n")
+            return
+        file.write(summary.to_string(float_format=lambda v: "{v:.4f}".format(v=v)) + "\n")
+
+
+################################################################################
+
+
+class ProfileCapture(object):
+    """Context manager profiling one call, e.g. one locus, with cProfile and optionally tracemalloc
+
+    cProfile only sees the thread entering the block, so run multi-ancestry
+    plots with ld_threads=1 to profile their LD stages.
+    """
+
+    def __init__(self, trace_memory=False, memory_frames=1):
+        self.trace_memory = trace_memory
+        self.memory_frames = memory_frames
+        self.profile = None
+        self.snapshot = None
+        self.memory_peak = None
+
+
+    def __enter__(self):
+        import cProfile
+        import tracemalloc
+        if self.trace_memory:
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start(self.memory_frames)
+            elif hasattr(tracemalloc, 'reset_peak'):
+                # already traced by the caller, keep its traces (before 3.9 the peak may predate the block)
+                tracemalloc.reset_peak()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        import tracemalloc
+        self.profile.disable()
+        if self.trace_memory:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.memory_peak = tracemalloc.get_traced_memory()[1]
+            if self._started_tracing:
+                tracemalloc.stop()
+        return False
+
+
+    def stats(self, sort='cumulative', file=None):
+        import pstats
+        return pstats.Stats(self.profile, stream=file or sys.stdout).sort_stats(sort)
+
+
+    def dump_stats(self, filename):
+        """Write the profile for snakeviz, pstats and similar tools"""
+        self.profile.dump_stats(filename)
+
+
+    def memory_top(self, limit=20, key_type='lineno'):
+        """Largest allocations still held at the end of the block, as tracemalloc statistics"""
+        if None == self.snapshot:
+            raise Exception("ERROR memory was not traced, expecting ProfileCapture(trace_memory=True)")
+        return self.snapshot.statistics(key_type)[:limit]
+
+
+    def print_report(self, limit=25, sort='cumulative', file=None):
+        file = file or sys.stdout
+        self.stats(sort, file).print_stats(limit)
+        if None != self.snapshot:
+            file.write("peak traced memory {m:.1f} MB, largest allocations held:\n".format(m=self.memory_peak / 2**20))
+            for statistic in self.memory_top(limit):
+                file.write("  {s}\n".format(s=statistic))
+
+
+def profile_locus(plot, *args, trace_memory=False, **kwargs):
+    """Call a plot entry point (e.g. basic_locuszoom) under ProfileCapture, returning (result, capture)"""
+    with ProfileCapture(trace_memory=trace_memory) as capture:
+        result = plot(*args, **kwargs)
+    return result, capture
@@ -0,0 +1,226 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Persistent on-disk cache of LD results, so re-plotting a lead variant
+### does not re-run PLINK
+
+
+
+import hashlib
+import math
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrument_stage
+from .generate_plink_ld import generate_plink_ld_frame
+from .generate_plink_ld import plink_bed_file_prefix_for
+from .generate_plink_ld import plink_bfile_signature
+from .bed_ld import generate_bed_ld_frame
+from .plot_r2_region import load_plink_r2_results_file
+from .plot_r2_region import window_pvalue
+
+
+################################################################################
+
+LD_CACHE_FORMAT_VERSION = 1
+
+# puts between scans of the cache directory, and the fraction of max_bytes a scan evicts down to
+LD_CACHE_CHECK_INTERVAL = 64
+LD_CACHE_EVICT_FRACTION = 0.9
+
+# ways of computing an LD frame from the reference panel, "numpy" needs no PLINK binary
+LD_ENGINES = { "plink": generate_plink_ld_frame,
+               "numpy": generate_bed_ld_frame }
+
+
+################################################################################
+
+
+def window_kb_for(target_window_size):
+    """PLINK --ld-window-kb covering target_window_size bases either side of the lead variant"""
+    return int(math.ceil(target_window_size / 1000.0))
+
+
+@instrument_stage(rows=len)
+def generate_ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template=None, window_kb=1000, ld_engine="plink"):
+    if ld_engine not in LD_ENGINES:
+        raise Exception("ERROR unknown LD engine {e}, expecting one of {k}".format(e=ld_engine, k=sorted(LD_ENGINES)))
+    return LD_ENGINES[ld_engine](ancestry, chromosome_text, target_variant,
+                                 locuszoom_template=locuszoom_template, window_kb=window_kb)
+
+
+# LD frames are windowed on position exactly like p-value frames
+window_ld_frame = window_pvalue
+
+
+class LDCache(object):
+    """Content addressed cache of LD frames keyed by reference panel, ancestry, lead variant and window
+
+    Entries are NumPy .npz files holding one array per column. Files are written
+    to a temporary name and renamed into place so concurrent writers never
+    expose partial entries, and the least recently used entries are removed once
+    the cache grows past max_bytes.
+
+    The directory is not scanned on every put: each cache object adds the
+    size of its own puts to the total found by its last scan, and scans
+    again when that passes max_bytes or after check_interval puts, which
+    picks up entries written by other processes. A scan evicts down to
+    LD_CACHE_EVICT_FRACTION of max_bytes, so the next ones are rare too.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2*1024**3, check_interval=LD_CACHE_CHECK_INTERVAL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._estimated_bytes = None  # unknown until the first scan
+        self._puts_since_scan = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def key(self, ancestry, chromosome_text, target_variant, locuszoom_template, window_kb=1000, ld_engine="plink"):
+        plink_bed_file_prefix = plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text)
+        text = "\n".join([ str(LD_CACHE_FORMAT_VERSION),
+                           plink_bfile_signature(plink_bed_file_prefix),
+                           ancestry, chromosome_text, target_variant,
+                           str(window_kb), ld_engine])
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+
+    @instrument_stage("ld_cache_get", rows=lambda frame: None if frame is None else len(frame))
+    def get(self, key):
+        """Return the cached LD frame for key, or None"""
+        filename = self.path(key)
+        try:
+            with np.load(filename, allow_pickle=False) as data:
+                n = len(data['position'])
+                chrom = pd.Categorical.from_codes(data['chrom_codes'], categories=data['chrom_categories'].astype(str))
+                frame = pd.DataFrame({ "target_variant": np.repeat(data['target_variant'].astype(str), n),
+                                       "chrom": chrom,
+                                       "position": data['position'],
+                                       "variant": data['variant'].astype(str),
+                                       "ld_r2": data['ld_r2'] })
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return None
+
+        try:
+            os.utime(filename) # mark as recently used
+        except OSError:
+            pass
+        return frame
+
+
+    @instrument_stage("ld_cache_put")
+    def put(self, key, ld_frame):
+        filename = self.path(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        chrom = pd.Categorical(ld_frame['chrom'].astype(str))
+        target_variants = ld_frame['target_variant'].astype(str).unique()
+        target_variant = target_variants[0] if len(target_variants) > 0 else ""
+        if len(target_variants) > 1:
+            raise Exception("ERROR LD cache entries hold results for a single target variant")
+
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f,
+                         target_variant=np.array([target_variant], dtype=bytes),
+                         chrom_categories=np.array(chrom.categories.tolist(), dtype=bytes),
+                         chrom_codes=chrom.codes.astype(np.int16),
+                         position=ld_frame['position'].to_numpy(dtype=np.int64),
+                         variant=ld_frame['variant'].to_numpy(dtype=bytes),
+                         ld_r2=ld_frame['ld_r2'].to_numpy(dtype=np.float32))
+            size = os.path.getsize(tmp_file)
+            os.replace(tmp_file, filename)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            raise
+
+        with self._lock:
+            self._puts_since_scan += 1
+            if None != self._estimated_bytes:
+                self._estimated_bytes += size
+            scan = (None == self._estimated_bytes or self._estimated_bytes > self.max_bytes
+                    or self._puts_since_scan >= self.check_interval)
+            if scan:
+                self._puts_since_scan = 0
+        if scan:
+            self.evict()
+
+
+    def evict(self):
+        """Scan the cache and, if it is over max_bytes, remove least recently used entries down to
+        LD_CACHE_EVICT_FRACTION of it; returns the size left"""
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                if not name.endswith(".npz"):
+                    continue
+                filename = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, filename))
+                total += st.st_size
+
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, filename in entries:
+                if total <= self.max_bytes * LD_CACHE_EVICT_FRACTION:
+                    break
+                try:
+                    os.unlink(filename)
+                except FileNotFoundError:
+                    pass # another process evicted it first
+                total -= size
+
+        with self._lock:
+            self._estimated_bytes = total
+        return total
+
+
+    def ld_frame(self, ancestry, chromosome_text, target_variant, locuszoom_template, window_kb=1000, ld_engine="plink"):
+        """Return the LD frame for target_variant from the cache, computing it with ld_engine on a miss"""
+        key = self.key(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb, ld_engine)
+        frame = self.get(key)
+        if frame is None:
+            frame = generate_ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template=locuszoom_template,
+                                      window_kb=window_kb, ld_engine=ld_engine)
+            self.put(key, frame)
+        return frame
+
+
+
+@instrument_stage(rows=len)
+def resolve_ld_frame(plink_file, target_variant, position_min, position_max, ancestry=None,
+                     locuszoom_template=None, ld_cache=None, window_kb=1000, ld_engine="plink"):
+    """LD frame for the plot window, read from plink_file or computed from the reference panel
+
+    When plink_file is None, LD is looked up in ld_cache (if given) before it is
+    computed by ld_engine (a key of LD_ENGINES) from locuszoom_template for ancestry.
+    """
+    chromosome_text = target_variant.split(":")[0]
+    if None != plink_file:
+        return load_plink_r2_results_file(plink_file, target_variant, position_min, position_max,
+                                          chromosome=chromosome_text)
+
+    if None == locuszoom_template or None == ancestry:
+        raise Exception("ERROR no plink file given, expecting an ancestry and locuszoom template to compute LD")
+
+    if None != ld_cache:
+        frame = ld_cache.ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb, ld_engine)
+    else:
+        frame = generate_ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template=locuszoom_template,
+                                  window_kb=window_kb, ld_engine=ld_engine)
+    return window_ld_frame(frame, position_min, position_max)
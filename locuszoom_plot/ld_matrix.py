@@ -0,0 +1,336 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Precomputed banded LD matrices, so any lead variant in a region can be
+### plotted against any reference panel ancestry without running PLINK again
+###
+### A matrix covers the variants of one region of a reference panel. Row i of
+### its band holds r2 of variant i with variants i, i+1, ..., i+band_width-1
+### (those within window_kb of it), quantized to uint8 or stored as float16,
+### in a .npy file that is memory-mapped when read. The r2 of a lead variant
+### with its whole window is its own band row plus the anti-diagonal of the
+### rows before it, so it is sliced out without any computation.
+
+
+
+import concurrent.futures
+import glob
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .generate_plink_ld import plink_bed_file_prefix_for
+from .generate_plink_ld import plink_bfile_signature
+from .bed_ld import open_plink_bed_file
+from .bed_ld import ld_r2_matrix
+from .ld_cache import generate_ld_frame
+from .instrumentation import instrument_stage
+
+
+################################################################################
+
+LD_MATRIX_FORMAT_VERSION = 1
+
+# uint8 bands store round(r2 * LD_MATRIX_LEVELS), LD_MATRIX_MISSING where r2 is undefined or out of the window
+LD_MATRIX_LEVELS = 254
+LD_MATRIX_MISSING = 255
+
+LD_MATRIX_DTYPES = ("uint8", "float16")
+
+# r2 values per block computed at once when block_variants is not given, bounding the temporaries of each thread
+LD_MATRIX_BLOCK_ELEMENTS = 2 ** 21
+
+
+################################################################################
+
+
+def _quantize(r2, dtype):
+    if "uint8" == dtype:
+        quantized = np.rint(np.clip(r2, 0, 1) * LD_MATRIX_LEVELS)
+        quantized[np.isnan(r2)] = LD_MATRIX_MISSING
+        return quantized.astype(np.uint8)
+    return np.clip(r2, 0, 1).astype(np.float16)
+
+
+def _dequantize(values, dtype):
+    """float32 r2 of stored values, NaN where missing"""
+    if "uint8" == dtype:
+        r2 = values.astype(np.float32) / LD_MATRIX_LEVELS
+        r2[values == LD_MATRIX_MISSING] = np.nan
+        return r2
+    return values.astype(np.float32)
+
+
+def _write_band_block(bed_file, rows, window_end, band, start, stop, dtype):
+    """Compute band rows start..stop-1 into the memory-mapped band"""
+    block_end = int(window_end[start:stop].max())
+    genotypes = bed_file.genotypes(rows[start:block_end])
+    r2 = ld_r2_matrix(genotypes[:stop - start], genotypes)
+
+    band_width = band.shape[1]
+    local_rows = np.arange(stop - start)[:, None]
+    columns = local_rows + np.arange(band_width)[None, :]
+    in_window = (columns + start) < window_end[start:stop, None]
+    values = np.where(in_window, r2[local_rows, np.minimum(columns, r2.shape[1] - 1)], np.nan)
+    band[start:stop] = _quantize(values, dtype)
+
+
+@instrument_stage(rows=lambda ld_matrix: ld_matrix.n_variants)
+def build_ld_matrix(plink_bed_file_prefix, output_prefix, position_min=None, position_max=None, window_kb=1000,
+                    dtype="uint8", block_variants=None, threads=None):
+    """Compute the banded LD matrix of the panel variants in [position_min, position_max] and return it as an LDMatrix
+
+    The panel must hold one chromosome sorted by position, as the per
+    chromosome 1000G filesets do. Blocks of block_variants rows (by default
+    sized from the band width) are computed concurrently by threads threads
+    (default one per core); the products release the GIL and each block
+    writes its own rows of the memory-mapped band. Files are written under
+    temporary names and renamed into place, the metadata last, so readers
+    never see a partial matrix.
+    """
+    if dtype not in LD_MATRIX_DTYPES:
+        raise Exception("ERROR unknown LD matrix dtype {d}, expecting one of {k}".format(d=dtype, k=LD_MATRIX_DTYPES))
+    bed_file = open_plink_bed_file(plink_bed_file_prefix)
+    if not bed_file.sorted:
+        raise Exception("ERROR {f}.bim must hold one chromosome sorted by position".format(f=plink_bed_file_prefix))
+
+    positions = bed_file.positions
+    lo = 0 if None == position_min else np.searchsorted(positions, position_min, side="left")
+    hi = len(positions) if None == position_max else np.searchsorted(positions, position_max, side="right")
+    rows = np.arange(lo, hi)
+    region_positions = positions[lo:hi]
+
+    # first row past the window of each row, within the region
+    window_end = np.searchsorted(region_positions, region_positions + window_kb * 1000, side="right")
+    band_width = int((window_end - np.arange(len(rows))).max()) if len(rows) > 0 else 1
+    if None == block_variants:
+        block_variants = max(16, min(1024, LD_MATRIX_BLOCK_ELEMENTS // band_width))
+
+    directory = os.path.dirname(os.path.abspath(output_prefix))
+    os.makedirs(directory, exist_ok=True)
+    tmp_files = {}
+    try:
+        for suffix in [".band.npy", ".variants.npz", ".json"]:
+            fd, tmp_files[suffix] = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            os.close(fd)
+
+        band = np.lib.format.open_memmap(tmp_files[".band.npy"], mode="w+", dtype=dtype,
+                                         shape=(len(rows), band_width))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+            futures = [ executor.submit(_write_band_block, bed_file, rows, window_end, band, start,
+                                        min(start + block_variants, len(rows)), dtype)
+                        for start in range(0, len(rows), block_variants)]
+            for future in futures:
+                future.result()
+        band.flush()
+        del band
+
+        window = bed_file.bim.iloc[lo:hi]
+        with open(tmp_files[".variants.npz"], "wb") as f:
+            np.savez(f,
+                     position=region_positions.astype(np.int64),
+                     variant=window['variant'].to_numpy(dtype=bytes),
+                     chrom=window['chrom'].to_numpy(dtype=bytes))
+
+        metadata = { 'format_version': LD_MATRIX_FORMAT_VERSION,
+                     'source_signature': plink_bfile_signature(plink_bed_file_prefix),
+                     'position_min': None if None == position_min else int(position_min),
+                     'position_max': None if None == position_max else int(position_max),
+                     'window_kb': window_kb,
+                     'dtype': dtype,
+                     'n_variants': len(rows),
+                     'band_width': band_width }
+        with open(tmp_files[".json"], "w") as f:
+            json.dump(metadata, f)
+
+        for suffix in [".band.npy", ".variants.npz", ".json"]:
+            os.replace(tmp_files.pop(suffix), output_prefix + suffix)
+    finally:
+        for tmp_file in tmp_files.values():
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+    return LDMatrix(output_prefix)
+
+
+class LDMatrix(object):
+    """A built LD matrix (see build_ld_matrix), with its band memory-mapped read-only"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + ".json") as f:
+            self.metadata = json.load(f)
+        if LD_MATRIX_FORMAT_VERSION != self.metadata['format_version']:
+            raise Exception("ERROR {p} has LD matrix format {v}, expecting {e}".format(
+                p=prefix, v=self.metadata['format_version'], e=LD_MATRIX_FORMAT_VERSION))
+
+        self.band = np.load(prefix + ".band.npy", mmap_mode="r")
+        if self.band.shape != (self.metadata['n_variants'], self.metadata['band_width']):
+            raise Exception("ERROR {p}.band.npy does not match its metadata, rebuilt while opening?".format(p=prefix))
+        with np.load(prefix + ".variants.npz", allow_pickle=False) as data:
+            self.positions = data['position']
+            self.variants = data['variant'].astype(str)
+            chrom = data['chrom'].astype(str)
+        self.chrom = chrom[0] if len(chrom) > 0 else ""
+        self.variant_rows = pd.Index(self.variants)
+        self.n_variants = self.metadata['n_variants']
+        self.window_kb = self.metadata['window_kb']
+        self.dtype = self.metadata['dtype']
+
+
+    def covers(self, position, window_kb):
+        """True when the matrix holds every panel variant within window_kb of position"""
+        if window_kb > self.window_kb:
+            return False
+        position_min = self.metadata['position_min']
+        position_max = self.metadata['position_max']
+        return ((None == position_min or position_min <= position - window_kb * 1000) and
+                (None == position_max or position + window_kb * 1000 <= position_max))
+
+
+    def variant_row(self, variant):
+        """Row of variant, or None when it is not in the matrix"""
+        rows = self.variant_rows.get_indexer_for([variant])
+        if 0 == len(rows) or rows[0] < 0:
+            return None
+        return rows[0]
+
+
+    def r2_row(self, row):
+        """(rows, r2) of every variant in the window of row, in position order, r2 NaN where undefined"""
+        band_width = self.band.shape[1]
+        offsets = np.arange(1, min(band_width, row + 1))
+        before_rows = row - offsets[::-1]
+        before = self.band[before_rows, offsets[::-1]]
+        after = self.band[row, :min(band_width, self.n_variants - row)]
+
+        rows = np.concatenate([before_rows, row + np.arange(len(after))])
+        return rows, _dequantize(np.concatenate([before, after]), self.dtype)
+
+
+    @instrument_stage("ld_matrix_slice", rows=len)
+    def ld_frame(self, target_variant, window_kb=None):
+        """LD of target_variant within window_kb (default the matrix window), in the frame shape of load_plink_r2_results_file"""
+        row = self.variant_row(target_variant)
+        if None == row:
+            raise Exception("ERROR variant {v} not found in LD matrix {p}".format(v=target_variant, p=self.prefix))
+        rows, r2 = self.r2_row(row)
+
+        # pairs past the window of an earlier row are stored as missing, so only undefined r2 needs dropping here
+        keep = ~np.isnan(r2)
+        if None != window_kb:
+            keep &= np.abs(self.positions[rows] - self.positions[row]) <= window_kb * 1000
+        rows = rows[keep]
+        return pd.DataFrame({ "target_variant": target_variant,
+                              "chrom": pd.Categorical(np.full(len(rows), self.chrom)),
+                              "position": self.positions[rows],
+                              "variant": self.variants[rows],
+                              "ld_r2": r2[keep] })
+
+
+class LDMatrixStore(object):
+    """Directory of LD matrices per ancestry and chromosome region, an LD source for basic_locuszoom
+
+    Pass it as ld_cache: lead variants whose window a current matrix covers
+    are sliced from it, others go to fallback (e.g. an LDCache) or are
+    computed with ld_engine. Matrices built from a panel that has changed
+    since are ignored. key/get/put follow LDCache, for callers such as
+    AsyncLocuszoom and generate_plink_ld_batch that compute LD themselves
+    on a miss; put only stores into fallback, matrices are built explicitly.
+    """
+
+    def __init__(self, store_dir, fallback=None):
+        self.store_dir = store_dir
+        self.fallback = fallback
+        self._matrices = {}
+        self._lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+
+
+    def path(self, ancestry, chromosome_text, position_min=None, position_max=None):
+        region = "all" if None == position_min and None == position_max else "{a}-{b}".format(
+            a="" if None == position_min else position_min, b="" if None == position_max else position_max)
+        return os.path.join(self.store_dir, ancestry, "{c}_{r}".format(c=chromosome_text, r=region))
+
+
+    def build(self, ancestry, chromosome_text, locuszoom_template, position_min=None, position_max=None,
+              window_kb=1000, **kwargs):
+        """Build the matrix of a region of the ancestry's panel, see build_ld_matrix"""
+        plink_bed_file_prefix = plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text)
+        ld_matrix = build_ld_matrix(plink_bed_file_prefix, self.path(ancestry, chromosome_text, position_min,
+                                                                      position_max),
+                                    position_min=position_min, position_max=position_max, window_kb=window_kb,
+                                    **kwargs)
+        with self._lock:
+            self._matrices.pop(ld_matrix.prefix, None)
+        return ld_matrix
+
+
+    def matrices(self, ancestry, chromosome_text):
+        """LD matrices built for the ancestry and chromosome, opened once and kept while unchanged"""
+        pattern = os.path.join(self.store_dir, ancestry, glob.escape(chromosome_text) + "_*.json")
+        result = []
+        for metadata_file in sorted(glob.glob(pattern)):
+            prefix = metadata_file[:-len(".json")]
+            try:
+                mtime = os.stat(metadata_file).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                cached = self._matrices.get(prefix)
+                if None == cached or cached[0] != mtime:
+                    cached = (mtime, LDMatrix(prefix))
+                    self._matrices[prefix] = cached
+            result.append(cached[1])
+        return result
+
+
+    def find(self, ancestry, chromosome_text, target_variant, locuszoom_template, window_kb=1000):
+        """(LDMatrix, row) of a current matrix covering the window of target_variant, or None"""
+        signature = plink_bfile_signature(plink_bed_file_prefix_for(locuszoom_template, ancestry, chromosome_text))
+        for ld_matrix in self.matrices(ancestry, chromosome_text):
+            if signature != ld_matrix.metadata['source_signature']:
+                continue
+            row = ld_matrix.variant_row(target_variant)
+            if None != row and ld_matrix.covers(ld_matrix.positions[row], window_kb):
+                return ld_matrix, row
+        return None
+
+
+    def key(self, ancestry, chromosome_text, target_variant, locuszoom_template, window_kb=1000, ld_engine="plink"):
+        fallback_key = None
+        if None != self.fallback:
+            fallback_key = self.fallback.key(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb,
+                                             ld_engine)
+        return (ancestry, chromosome_text, target_variant, locuszoom_template, window_kb, fallback_key)
+
+
+    def get(self, key):
+        """LD frame for key sliced from a matrix, otherwise from fallback, or None"""
+        ancestry, chromosome_text, target_variant, locuszoom_template, window_kb, fallback_key = key
+        found = self.find(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb)
+        if None != found:
+            return found[0].ld_frame(target_variant, window_kb)
+        if None != self.fallback:
+            return self.fallback.get(fallback_key)
+        return None
+
+
+    def put(self, key, ld_frame):
+        if None != self.fallback:
+            self.fallback.put(key[-1], ld_frame)
+
+
+    def ld_frame(self, ancestry, chromosome_text, target_variant, locuszoom_template, window_kb=1000, ld_engine="plink"):
+        """LD frame for target_variant sliced from a matrix, otherwise from fallback or computed with ld_engine"""
+        found = self.find(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb)
+        if None != found:
+            return found[0].ld_frame(target_variant, window_kb)
+        if None != self.fallback:
+            return self.fallback.ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template, window_kb,
+                                          ld_engine)
+        return generate_ld_frame(ancestry, chromosome_text, target_variant, locuszoom_template=locuszoom_template,
+                                 window_kb=window_kb, ld_engine=ld_engine)
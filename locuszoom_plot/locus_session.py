@@ -0,0 +1,202 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Re-render one locus without rebuilding its data panels
+###
+### A LocusSession keeps the intermediate products of basic_locuszoom: packed
+### gene rows, the windowed LD frame, the merged p-value/LD frame and the
+### binned scatter arrays. Each is keyed by its inputs, so a new render only
+### recomputes stages whose inputs changed, and a narrower window around the
+### same lead variant is sliced out of the products of a wider one.
+
+
+
+import collections
+
+import numpy as np
+
+from .plot_gene_region import load_gene_region_info
+from .plot_gene_region import sort_gene_locations
+from .plot_r2_region import bin_r2_region_points
+from .plot_r2_region import merge_pvalue_ld
+from .plot_r2_region import select_pvalue_region
+from .generate_plink_ld import file_signature
+from .generate_plink_ld import plink_bed_file_prefix_for
+from .ld_cache import resolve_ld_frame
+from .ld_cache import window_kb_for
+from .ld_cache import window_ld_frame
+from .basic_locuszoom import draw_basic_locuszoom
+from .instrumentation import span
+from .instrumentation import instrumented
+
+
+################################################################################
+
+
+def _input_token(value):
+    """Comparable stand-in for an input: plain values as themselves, file names with their size and mtime,
+    other objects (frames, caches) by identity"""
+    if isinstance(value, str):
+        return (value, file_signature(value))
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return ('object', id(value))
+
+
+def _window_slice(positions, position_min, position_max):
+    """Slice or mask selecting positions in [position_min, position_max], a slice when they are sorted"""
+    if len(positions) < 2 or np.all(positions[1:] >= positions[:-1]):
+        lo = np.searchsorted(positions, position_min, side="left")
+        hi = np.searchsorted(positions, position_max, side="right")
+        return slice(lo, hi)
+    return (positions >= position_min) & (positions <= position_max)
+
+
+class LocusSession(object):
+    """Memoized data panels of one locus, re-rendered by render() with other labels, output or window
+
+    The inputs are the arguments of basic_locuszoom that fix the data; they
+    are plain attributes and may be reassigned between renders, after which
+    only the stages depending on them are recomputed. Data frames and caches
+    are compared by identity, file names by size and modification time. A
+    window no wider than one already computed is sliced from its products
+    (a slice of the position sorted arrays when the p-values are sorted),
+    which gives the same plot as computing it afresh. last_recomputed lists
+    the stages the latest render had to compute. Use a session from one
+    thread at a time.
+    """
+
+    def __init__(self, pvalue_frame, target_variant, target_pos, fancy_name=None, plink_file=None,
+                 locuszoom_gene_db=None, ancestry=None, locuszoom_template=None, ld_cache=None, ld_engine="plink",
+                 max_gene_windows=8):
+        self.pvalue_frame = pvalue_frame
+        self.target_variant = target_variant
+        self.target_pos = target_pos
+        self.fancy_name = fancy_name or target_variant
+        self.plink_file = plink_file
+        self.locuszoom_gene_db = locuszoom_gene_db
+        self.ancestry = ancestry
+        self.locuszoom_template = locuszoom_template
+        self.ld_cache = ld_cache
+        self.ld_engine = ld_engine
+        self.max_gene_windows = max_gene_windows
+
+        # gene packing depends on the exact window (label extents), so it is kept per window
+        self._gene_rows = collections.OrderedDict()
+        # the widest computed product of each stage: { 'key', 'inputs', 'window_size', 'value' }
+        self._ld = None
+        self._merged = None
+        self._points = None
+        self.last_recomputed = []
+
+
+    @property
+    def chromosome(self):
+        return self.target_variant.split(":")[0]
+
+
+    def window(self, target_window_size):
+        return (self.target_pos - target_window_size, self.target_pos + target_window_size)
+
+
+    def _ld_inputs(self):
+        panel = None
+        if None != self.locuszoom_template and None != self.ancestry:
+            panel = plink_bed_file_prefix_for(self.locuszoom_template, self.ancestry, self.chromosome) + ".bed"
+        return (self.target_variant, self.target_pos, self.plink_file, self.ancestry, self.locuszoom_template,
+                panel, self.ld_cache, self.ld_engine)
+
+
+    def _lookup(self, entry, inputs, target_window_size):
+        """entry when it was computed from inputs over a window at least target_window_size wide, else None"""
+        key = tuple(_input_token(v) for v in inputs)
+        if None != entry and key == entry['key'] and target_window_size <= entry['window_size']:
+            return entry
+        return None
+
+
+    def _entry(self, stage, inputs, target_window_size, value):
+        self.last_recomputed.append(stage)
+        # inputs are held so that the objects compared by id stay alive
+        return { 'key': tuple(_input_token(v) for v in inputs),
+                 'inputs': inputs,
+                 'window_size': target_window_size,
+                 'value': value }
+
+
+    def gene_rows(self, target_window_size):
+        """Packed gene rows of the window, see sort_gene_locations"""
+        position_min, position_max = self.window(target_window_size)
+        key = (_input_token(self.locuszoom_gene_db), self.chromosome, position_min, position_max)
+        entry = self._gene_rows.get(key)
+        if None != entry:
+            self._gene_rows.move_to_end(key)
+            return entry['value']
+
+        region_info = load_gene_region_info(self.chromosome, position_min, position_max, self.locuszoom_gene_db)
+        gene_rows = sort_gene_locations(region_info, position_min, position_max)
+        self._gene_rows[key] = self._entry("gene_rows", (self.locuszoom_gene_db,), target_window_size, gene_rows)
+        while len(self._gene_rows) > self.max_gene_windows:
+            self._gene_rows.popitem(last=False)
+        return gene_rows
+
+
+    def ld_frame(self, target_window_size):
+        """LD frame of the lead variant over the window, see resolve_ld_frame"""
+        position_min, position_max = self.window(target_window_size)
+        inputs = self._ld_inputs()
+        entry = self._lookup(self._ld, inputs, target_window_size)
+        if None == entry:
+            frame = resolve_ld_frame(self.plink_file, self.target_variant, position_min, position_max,
+                                     ancestry=self.ancestry, locuszoom_template=self.locuszoom_template,
+                                     ld_cache=self.ld_cache, window_kb=window_kb_for(target_window_size),
+                                     ld_engine=self.ld_engine)
+            self._ld = self._entry("ld_frame", inputs, target_window_size, frame)
+            return frame
+        if target_window_size == entry['window_size']:
+            return entry['value']
+        return window_ld_frame(entry['value'], position_min, position_max)
+
+
+    def pvalue_ld_frame(self, target_window_size):
+        """p-values of the window merged with LD, see merge_pvalue_ld"""
+        position_min, position_max = self.window(target_window_size)
+        inputs = self._ld_inputs() + (self.pvalue_frame,)
+        entry = self._lookup(self._merged, inputs, target_window_size)
+        if None == entry:
+            pvalue_frame = select_pvalue_region(self.pvalue_frame, self.chromosome, position_min, position_max)
+            frame = merge_pvalue_ld(pvalue_frame, self.ld_frame(target_window_size))
+            self._merged = self._entry("pvalue_ld_frame", inputs, target_window_size, frame)
+            return frame
+        if target_window_size == entry['window_size']:
+            return entry['value']
+        frame = entry['value']
+        return frame[_window_slice(frame['position'].to_numpy(), position_min, position_max)]
+
+
+    def r2_points(self, target_window_size):
+        """Binned scatter arrays of the window, see bin_r2_region_points"""
+        position_min, position_max = self.window(target_window_size)
+        inputs = self._ld_inputs() + (self.pvalue_frame,)
+        entry = self._lookup(self._points, inputs, target_window_size)
+        if None == entry:
+            r2_points = bin_r2_region_points(self.pvalue_ld_frame(target_window_size), self.target_variant)
+            self._points = self._entry("r2_points", inputs, target_window_size, r2_points)
+            return r2_points
+        if target_window_size == entry['window_size']:
+            return entry['value']
+        positions, log_pvalues, ld_bins, target_position, target_log_pvalue = entry['value']
+        select = _window_slice(positions, position_min, position_max)
+        return (positions[select], log_pvalues[select], ld_bins[select], target_position, target_log_pvalue)
+
+
+    def render(self, target_window_size=1000000, fancy_name=None, output_plot=None, output_pdf=None, title=None,
+               decimate=False, instrument=None):
+        """Draw the locus as basic_locuszoom would, reusing every product whose inputs are unchanged"""
+        self.last_recomputed = []
+        with instrumented(instrument), span("locus_session_render", target_variant=self.target_variant):
+            position_min, position_max = self.window(target_window_size)
+            gene_rows = self.gene_rows(target_window_size)
+            r2_points = self.r2_points(target_window_size)
+            return draw_basic_locuszoom(gene_rows, r2_points, position_min, position_max,
+                                        fancy_name or self.fancy_name, output_plot=output_plot,
+                                        output_pdf=output_pdf, title=title, decimate=decimate)
@@ -6,9 +6,9 @@
 
 
 
+import concurrent.futures
 
 import numpy as np
-import matplotlib.pyplot as pyplot
 
 
 
@@ -17,64 +17,99 @@ from .plot_gene_region import sort_gene_locations
 from .plot_gene_region import plot_gene_region_worker
 
 
-from .plot_r2_region import plot_r2_region_worker
+from .plot_r2_region import bin_r2_region_points
+from .plot_r2_region import plot_r2_points_worker
 from .plot_r2_region import colorbar_magic
-from .plot_r2_region import load_plink_r2_results_file
 from .plot_r2_region import merge_pvalue_ld
-from .plot_r2_region import window_pvalue
+from .plot_r2_region import pvalue_join_keys
+from .plot_r2_region import select_pvalue_region
 
+from .ld_cache import resolve_ld_frame
 
+from .figures import new_figure
+from .figures import save_figure
+from .figures import release_figure
 
-################################################################################
-
-
-################################################################################
-
-
-def multi_ancestry_locuszoom(pvalue_frame, ancestry_file_set, target_variant, target_pos, fancy_name, output_plot=None, output_pdf=None, title=None, locuszoom_gene_db=None):
-
-    target_chromosome = target_variant.split(":")[0]
-    position_min = target_pos - 1000000
-    position_max = target_pos + 1000000
-    region_info = load_gene_region_info(target_chromosome, position_min, position_max, locuszoom_gene_db)
-    gene_rows = sort_gene_locations(region_info, position_min, position_max)
-
-
-    pvalue_frame = window_pvalue(pvalue_frame, position_min, position_max)
+from .instrumentation import span
+from .instrumentation import instrumented
+from .instrumentation import in_context
 
-    n_gene_rows = len(gene_rows)
 
-    n_ancestry = len(ancestry_file_set)
-    height_ratios = {'height_ratios': [10 for i in range(n_ancestry)] + [n_gene_rows]}
-    pyplot.clf()
 
+################################################################################
 
-    mainfig, axes_objects = pyplot.subplots(n_ancestry+1,1, gridspec_kw=height_ratios, num=None, figsize=(8,11), dpi=150)    
-
-    gene_axes = axes_objects[n_ancestry]
-    for i, ancestry_group in enumerate(ancestry_file_set):
-        label, plink_file = ancestry_group
-
-        ld_frame = load_plink_r2_results_file(plink_file, target_variant, position_min, position_max)
-        pvalue_ld_result = merge_pvalue_ld(pvalue_frame, ld_frame)
-        r2_axes = axes_objects[i]
-
-        plot_r2_region_worker(r2_axes, pvalue_ld_result, target_variant, position_min, position_max, fancy_name)
-        r2_axes.set_title(label)
-
-    plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max)
-
-    colorbar_magic(mainfig, n_ancestry)
-
-    if None != title:
-        mainfig.suptitle(title)
 
-    if None != output_plot:
-        pyplot.savefig(output_plot, bbox_inches='tight');
-        pyplot.draw()
-    elif None != output_pdf:
-        output_pdf.savefig(mainfig)
-    else:
-        raise Exception("ERROR no output plot or output pdf object given")
+################################################################################
 
 
+def prepare_ancestry_points(pvalue_frame, pvalue_keys, label, plink_file, target_variant, position_min, position_max,
+                            locuszoom_template=None, ld_cache=None, ld_engine="plink"):
+    """LD for one ancestry panel merged onto the p-values and binned for plotting, see bin_r2_region_points"""
+    ld_frame = resolve_ld_frame(plink_file, target_variant, position_min, position_max, ancestry=label,
+                                locuszoom_template=locuszoom_template, ld_cache=ld_cache, ld_engine=ld_engine)
+    pvalue_ld_result = merge_pvalue_ld(pvalue_frame, ld_frame, pvalue_keys)
+    return bin_r2_region_points(pvalue_ld_result, target_variant)
+
+
+def multi_ancestry_locuszoom(pvalue_frame, ancestry_file_set, target_variant, target_pos, fancy_name, output_plot=None, output_pdf=None, title=None, locuszoom_gene_db=None,
+                             locuszoom_template=None, ld_cache=None, ld_engine="plink", decimate=False, ld_threads=None,
+                             instrument=None):
+    """ancestry_file_set is a list of (label, plink_file); when plink_file is None the label is
+    used as the ancestry to compute LD for from locuszoom_template, through ld_cache if given.
+    Returns the (n_rendered, n_input) scatter point counts per ancestry, see basic_locuszoom
+
+    LD for every ancestry is read or computed, merged and binned concurrently
+    in a pool of ld_threads threads (one per ancestry by default), alongside
+    the gene lookup; PLINK runs as a subprocess and the NumPy engine and file
+    parsing mostly release the GIL. Only drawing the figure is serial.
+    instrument receives span events as in basic_locuszoom."""
+    with instrumented(instrument), span("multi_ancestry_locuszoom", target_variant=target_variant):
+        target_chromosome = target_variant.split(":")[0]
+        position_min = target_pos - 1000000
+        position_max = target_pos + 1000000
+
+        pvalue_frame = select_pvalue_region(pvalue_frame, target_chromosome, position_min, position_max)
+        pvalue_keys = pvalue_join_keys(pvalue_frame)
+
+        n_ancestry = len(ancestry_file_set)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ld_threads or max(1, n_ancestry)) as executor:
+            # each task runs in a copy of this context, so its stages report to the instrument
+            region_info_future = executor.submit(in_context(load_gene_region_info), target_chromosome, position_min,
+                                                 position_max, locuszoom_gene_db)
+            panel_futures = [ executor.submit(in_context(prepare_ancestry_points), pvalue_frame, pvalue_keys, label,
+                                              plink_file, target_variant, position_min, position_max,
+                                              locuszoom_template, ld_cache, ld_engine)
+                              for label, plink_file in ancestry_file_set]
+            region_info = region_info_future.result()
+            panel_points = [ f.result() for f in panel_futures]
+
+        gene_rows = sort_gene_locations(region_info, position_min, position_max)
+        n_gene_rows = len(gene_rows)
+
+        height_ratios = {'height_ratios': [10 for i in range(n_ancestry)] + [n_gene_rows]}
+        mainfig = new_figure(figsize=(8,11), dpi=150)
+        axes_objects = mainfig.subplots(n_ancestry+1,1, gridspec_kw=height_ratios)
+
+        gene_axes = axes_objects[n_ancestry]
+        point_counts = []
+        for i, ancestry_group in enumerate(ancestry_file_set):
+            label, plink_file = ancestry_group
+            r2_axes = axes_objects[i]
+
+            point_counts.append(plot_r2_points_worker(r2_axes, panel_points[i], position_min, position_max, fancy_name,
+                                                      decimate=decimate))
+            r2_axes.set_title(label)
+
+        plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max)
+
+        colorbar_magic(mainfig, n_ancestry)
+
+        if None != title:
+            mainfig.suptitle(title)
+
+        try:
+            save_figure(mainfig, output_plot, output_pdf)
+        finally:
+            release_figure(mainfig)
+
+        return point_counts
@@ -0,0 +1,102 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Extract the windows of many loci from a summary statistics file in one
+### sequential pass, instead of re-reading the file for every locus
+
+
+
+import numpy as np
+import pandas as pd
+
+from .pvalue_store import normalize_chromosome
+from .plot_r2_region import _CHROM_KEY_SHIFT
+from .plot_r2_region import _chromosome_codes
+from .plot_r2_region import _chrom_position_keys
+
+
+################################################################################
+
+
+def merge_windows(windows):
+    """Sort and merge overlapping (chrom, position_min, position_max) windows
+
+    Returns (chrom_codes, starts, ends, window_ids): chrom_codes maps normalized
+    chromosome names to ints, starts/ends are the merged windows as sorted
+    packed keys, and window_ids gives the merged window holding each input window.
+    """
+    chrom_codes = {}
+    keyed = []
+    for i, (chromosome, position_min, position_max) in enumerate(windows):
+        code = chrom_codes.setdefault(normalize_chromosome(chromosome), len(chrom_codes))
+        keyed.append(((code << _CHROM_KEY_SHIFT) + int(position_min), (code << _CHROM_KEY_SHIFT) + int(position_max), i))
+    keyed.sort()
+
+    starts, ends = [], []
+    window_ids = np.zeros(len(windows), dtype=np.int64)
+    for start, end, i in keyed:
+        if len(ends) > 0 and start <= ends[-1] and start >> _CHROM_KEY_SHIFT == ends[-1] >> _CHROM_KEY_SHIFT:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+        window_ids[i] = len(starts) - 1
+    return chrom_codes, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), window_ids
+
+
+def _chunk_keys(chunk, chrom_codes, chrom_column, position_column):
+    codes = _chromosome_codes(chunk[chrom_column], chrom_codes)
+    known = codes >= 0
+    return _chrom_position_keys(np.maximum(codes, 0), chunk[position_column]), known
+
+
+def format_region_frame(frame, rename=None):
+    """Rename columns to chrom/position/pvalue and add 'chr{chrom}:{pos}' variant ids when the file has none"""
+    if None != rename:
+        frame = frame.rename(columns=rename)
+    if 'variant' not in frame.columns:
+        frame = frame.assign(variant=[ 'chr{chrom}:{pos}'.format(chrom=c, pos=p)
+                                       for c,p in zip(frame['chrom'], frame['position'])])
+    return frame
+
+
+def extract_pvalue_regions(filename, windows, chrom_column="chrom", position_column="position", rename=None,
+                           chunksize=1000000, **read_csv_kwargs):
+    """Read filename once and return one frame per (chrom, position_min, position_max) window, in input order
+
+    Overlapping windows are merged so each row is routed to at most one buffer
+    while the file streams by in chunks; only rows inside some window are kept.
+    Frames are passed through format_region_frame with rename, so they can be
+    handed straight to the locuszoom entry points. Extra keyword arguments go
+    to pandas.read_csv.
+    """
+    chrom_codes, starts, ends, window_ids = merge_windows(windows)
+
+    kept_rows = []
+    kept_ids = []
+    for chunk in pd.read_csv(filename, chunksize=chunksize, **read_csv_kwargs):
+        if 0 == len(starts):
+            break
+        keys, known = _chunk_keys(chunk, chrom_codes, chrom_column, position_column)
+        merged_id = np.searchsorted(starts, keys, side="right") - 1
+        inside = known & (merged_id >= 0) & (keys <= ends[np.maximum(merged_id, 0)])
+        if inside.any():
+            kept_rows.append(chunk[inside])
+            kept_ids.append(merged_id[inside])
+
+    if 0 == len(kept_rows):
+        empty = pd.read_csv(filename, nrows=0, **read_csv_kwargs)
+        return [ format_region_frame(empty.copy(), rename) for _ in windows]
+
+    rows = pd.concat(kept_rows, ignore_index=True)
+    ids = np.concatenate(kept_ids)
+    order = np.argsort(ids, kind="stable")
+    rows = rows.iloc[order].reset_index(drop=True)
+    bounds = np.searchsorted(ids[order], np.arange(len(starts) + 1), side="left")
+
+    results = []
+    for i, (chromosome, position_min, position_max) in enumerate(windows):
+        merged = rows.iloc[bounds[window_ids[i]]:bounds[window_ids[i] + 1]]
+        positions = merged[position_column]
+        selected = merged[(positions >= position_min) & (positions <= position_max)].reset_index(drop=True)
+        results.append(format_region_frame(selected, rename))
+    return results
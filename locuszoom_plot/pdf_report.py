@@ -0,0 +1,117 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Write many loci as the pages of one PDF, rendering pages in worker processes
+
+
+
+import collections
+import concurrent.futures
+import io
+import os
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+import matplotlib.image
+from matplotlib.backends.backend_pdf import PdfPages
+
+from .figures import new_figure
+from .figures import release_figure
+from .batch_locuszoom import prepare_batch_loci
+from .batch_locuszoom import render_locus
+from .batch_locuszoom import _init_batch_worker
+from .batch_locuszoom import _forward_spans
+from .instrumentation import instrumented
+
+
+################################################################################
+
+
+def _render_report_page(index, locus, collect_spans=False):
+    start = time.perf_counter()
+    png = io.BytesIO()
+    error = None
+    spans = [] if collect_spans else None
+    try:
+        with instrumented(None if None == spans else spans.append):
+            render_locus(dict(locus, output_plot=png))
+    except Exception:
+        error = traceback.format_exc()
+
+    return { 'index': index,
+             'target_variant': locus['target_variant'],
+             'png': None if None != error else png.getvalue(),
+             'seconds': time.perf_counter() - start,
+             'error': error,
+             'pid': os.getpid(),
+             'spans': spans }
+
+
+def write_report_page(pdf, page, dpi=150):
+    """Add a page rendered by a report worker to pdf, at its native resolution, or a page noting the failure"""
+    if None == page['error']:
+        image = matplotlib.image.imread(io.BytesIO(page['png']))
+        image = (image[:, :, :3] * 255).astype(np.uint8)
+        height, width = image.shape[:2]
+        figure = new_figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        axes = figure.add_axes([0, 0, 1, 1])
+        axes.imshow(image, interpolation='none', aspect='auto')
+        axes.set_axis_off()
+    else:
+        figure = new_figure(figsize=(8, 6), dpi=dpi)
+        figure.text(0.5, 0.5, "{v}: plot failed".format(v=page['target_variant']),
+                    horizontalalignment='center', verticalalignment='center')
+    try:
+        pdf.savefig(figure)
+    finally:
+        release_figure(figure)
+
+
+def iter_locuszoom_report(loci, output_pdf_file, pvalue_frame, locuszoom_gene_db, locuszoom_template=None,
+                          ld_cache_dir=None, ld_engine="plink", processes=None, max_in_flight=None, dpi=150,
+                          progress=None, instrument=None):
+    """Render loci (see render_locus) as the pages of one PDF, in locus order, yielding one result per page
+
+    Pages are rendered to images by a process pool whose workers share a gene
+    annotation index and LD cache across all their pages, as in
+    iter_locuszoom_batch, and are appended to output_pdf_file as they come
+    back. At most max_in_flight pages (default twice the number of workers)
+    are submitted but not yet written, which bounds memory however many
+    loci there are. A locus that fails gets a page saying so; its result
+    carries the traceback in error. Span events go to instrument as in
+    iter_locuszoom_batch.
+    """
+    loci, pvalue_frame = prepare_batch_loci(loci, pvalue_frame)
+    total = len(loci)
+    if None == processes:
+        processes = os.cpu_count() or 1
+    if None == max_in_flight:
+        max_in_flight = 2 * processes
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_worker,
+                                                initargs=(pvalue_frame, locuszoom_gene_db, locuszoom_template,
+                                                          ld_cache_dir, ld_engine)) as executor, \
+         PdfPages(output_pdf_file) as pdf:
+        pending = collections.deque()
+        next_locus = 0
+        for done in range(1, total + 1):
+            while next_locus < total and len(pending) < max_in_flight:
+                pending.append(executor.submit(_render_report_page, next_locus, loci[next_locus],
+                                               None != instrument))
+                next_locus += 1
+
+            page = pending.popleft().result()
+            _forward_spans(page, instrument)
+            write_report_page(pdf, page, dpi=dpi)
+            result = { k: v for k, v in page.items() if 'png' != k}
+            if None != progress:
+                progress(done, total, result)
+            yield result
+
+
+def locuszoom_report(loci, output_pdf_file, pvalue_frame, locuszoom_gene_db, **kwargs):
+    """Write all loci to output_pdf_file, see iter_locuszoom_report, and return a frame of per-page results"""
+    results = list(iter_locuszoom_report(loci, output_pdf_file, pvalue_frame, locuszoom_gene_db, **kwargs))
+    return pd.DataFrame(results, columns=['index', 'target_variant', 'seconds', 'error', 'pid'])
@@ -4,11 +4,21 @@
 ### test gridspec stuff for locuszoom plotting
 
 
+import hashlib
+import heapq
+import os
 import sqlite3
+import tempfile
+import threading
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as pyplot
-import matplotlib.gridspec as gridspec
+
+from .instrumentation import instrument_stage
+from .generate_plink_ld import file_signature
+from .figures import new_figure
+from .figures import show_figure
+from .figures import release_figure
 
 ################################################################################
 
@@ -16,6 +26,157 @@ import matplotlib.gridspec as gridspec
 
 # LOCUSZOOM_GENE = "locuszoom1.4_data/locuszoom/data/database/locuszoom_hg19.db"
 
+GENE_REGION_INDEX_SUFFIX = ".region_index"
+
+
+################################################################################
+### Gene database access
+### Connections are kept open per database file, and lookups go through an
+### R-tree sidecar database derived once from the refFlat table
+
+_gene_db_connections = {}
+_gene_db_lock = threading.RLock()
+
+# connections inherited over fork, kept referenced so the child never closes them
+_inherited_gene_db_connections = []
+
+
+def get_gene_db_connection(db_file):
+    """Return a cached sqlite3 connection for db_file, opening it on first use"""
+    db_file = os.path.abspath(db_file)
+    with _gene_db_lock:
+        conn = _gene_db_connections.get(db_file)
+        if None == conn:
+            conn = sqlite3.connect(db_file, check_same_thread=False)
+            _gene_db_connections[db_file] = conn
+        return conn
+
+
+def close_gene_db_connections():
+    with _gene_db_lock:
+        for conn in _gene_db_connections.values():
+            conn.close()
+        _gene_db_connections.clear()
+
+
+def _forget_gene_db_connections():
+    # a forked child (e.g. a batch worker) must not use the parent's sqlite connections,
+    # nor close them; it opens its own, under a fresh lock in case the parent held it
+    global _gene_db_lock
+    _inherited_gene_db_connections.extend(_gene_db_connections.values())
+    _gene_db_connections.clear()
+    _gene_db_lock = threading.RLock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_gene_db_connections)
+
+
+def gene_db_signature(locuszoom_gene_db):
+    signature = file_signature(locuszoom_gene_db)
+    if None == signature:
+        raise FileNotFoundError("ERROR gene database not found: " + locuszoom_gene_db)
+    return "{size}:{mtime}".format(size=signature[0], mtime=signature[1])
+
+
+def build_gene_region_index(locuszoom_gene_db, index_db=None):
+    """Build an R-tree sidecar database over refFlat (chrom, txStart, txEnd)
+
+    The refFlat rows are copied in their original order so lookups return
+    the same records as a scan of locuszoom_gene_db.
+    """
+    if None == index_db:
+        index_db = locuszoom_gene_db + GENE_REGION_INDEX_SUFFIX
+    tmp_file = "{f}.{pid}.tmp".format(f=index_db, pid=os.getpid())
+    if os.path.exists(tmp_file):
+        os.unlink(tmp_file)
+
+    conn = sqlite3.connect(tmp_file)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (locuszoom_gene_db,))
+        conn.execute("CREATE TABLE refFlat AS SELECT * FROM src.refFlat ORDER BY rowid")
+        conn.execute("CREATE TABLE chrom_ids (chrom_id INTEGER PRIMARY KEY, chrom TEXT UNIQUE)")
+        conn.execute("INSERT INTO chrom_ids (chrom) SELECT DISTINCT chrom FROM refFlat")
+        conn.execute("CREATE VIRTUAL TABLE refFlat_rtree USING rtree_i32(id, chrom_min, chrom_max, tx_min, tx_max)")
+        conn.execute("INSERT INTO refFlat_rtree "
+                     "SELECT refFlat.rowid, chrom_ids.chrom_id, chrom_ids.chrom_id, "
+                     "MIN(refFlat.txStart, refFlat.txEnd), MAX(refFlat.txStart, refFlat.txEnd) "
+                     "FROM refFlat JOIN chrom_ids ON refFlat.chrom = chrom_ids.chrom")
+        conn.execute("CREATE TABLE index_info (source_signature TEXT)")
+        conn.execute("INSERT INTO index_info VALUES (?)", (gene_db_signature(locuszoom_gene_db),))
+        conn.commit()
+        conn.execute("DETACH DATABASE src")
+    finally:
+        conn.close()
+    os.replace(tmp_file, index_db)
+    return index_db
+
+
+def _gene_region_index_paths(locuszoom_gene_db):
+    """Places for the index of locuszoom_gene_db: next to it, else in a per-database temp directory entry"""
+    yield locuszoom_gene_db + GENE_REGION_INDEX_SUFFIX
+    name = "{h}_{b}{s}".format(h=hashlib.sha256(os.path.abspath(locuszoom_gene_db).encode("utf-8")).hexdigest()[:16],
+                               b=os.path.basename(locuszoom_gene_db), s=GENE_REGION_INDEX_SUFFIX)
+    yield os.path.join(tempfile.gettempdir(), "locuszoom_plot", name)
+
+
+# { index path: signature of the database the build failed for }, so it is not retried on every lookup
+_gene_region_index_failures = {}
+
+
+def _current_gene_region_index(locuszoom_gene_db):
+    """Return a connection to an up to date index for locuszoom_gene_db, building it if needed, or None"""
+    signature = gene_db_signature(locuszoom_gene_db)
+    with _gene_db_lock:
+        for index_db in _gene_region_index_paths(locuszoom_gene_db):
+            key = os.path.abspath(index_db)
+            if signature == _gene_region_index_failures.get(key):
+                continue
+
+            if os.path.exists(index_db):
+                conn = get_gene_db_connection(index_db)
+                try:
+                    stored = conn.execute("SELECT source_signature FROM index_info").fetchone()
+                    if None != stored and signature == stored[0]:
+                        return conn
+                except sqlite3.Error:
+                    pass
+                # stale or damaged index, rebuild below
+                _gene_db_connections.pop(key).close()
+
+            try:
+                os.makedirs(os.path.dirname(key), exist_ok=True)
+                build_gene_region_index(locuszoom_gene_db, index_db)
+            except (OSError, sqlite3.Error):
+                # e.g. a read-only data directory, try the next place
+                _gene_region_index_failures[key] = signature
+                continue
+            return get_gene_db_connection(index_db)
+
+    # fall back to querying refFlat directly
+    return None
+
+
+@instrument_stage(rows=lambda result: len(result[0]))
+def query_gene_region(chromosome, position_min, position_max, locuszoom_gene_db):
+    """Return (records, columns) for refFlat rows overlapping the window, in table order"""
+    conn = _current_gene_region_index(locuszoom_gene_db)
+    if None != conn:
+        sql = ("SELECT refFlat.* FROM refFlat_rtree "
+               "JOIN refFlat ON refFlat.rowid = refFlat_rtree.id "
+               "WHERE refFlat_rtree.chrom_min = (SELECT chrom_id FROM chrom_ids WHERE chrom = ?) "
+               "AND refFlat_rtree.tx_min <= ? AND refFlat_rtree.tx_max >= ? "
+               "ORDER BY refFlat.rowid")
+    else:
+        conn = get_gene_db_connection(locuszoom_gene_db)
+        sql = ("SELECT * FROM refFlat WHERE chrom = ? AND txStart <= ? AND txEnd >= ? "
+               "ORDER BY rowid")
+
+    with _gene_db_lock:
+        cursor = conn.execute(sql, (chromosome, int(position_max), int(position_min)))
+        records = cursor.fetchall()
+        columns = [ t[0] for t in cursor.description]
+    return records, columns
+
 
 ################################################################################
 
@@ -49,36 +210,95 @@ def overlap_text(a, b, position_min, position_max):
                             center_b_x - b_width/2, center_b_x + b_width/2)
 
 
+def parse_exon_positions(exon_positions):
+    """refFlat exon lists are comma separated text, a GeneAnnotationIndex gives them already split"""
+    if isinstance(exon_positions, str):
+        return [ int(s) for s in exon_positions.split(',') if len(s) > 0]
+    return [ int(s) for s in exon_positions]
+
+
+def gene_label_extents(gene_frame, position_min, position_max):
+    """Left/right edges of the gene name labels in axes fraction, as overlap_text estimates them"""
+    text_scaling_factor = .015  ## this is a pure guesstimate here
+
+    position_range = (position_max - position_min)
+    center = (gene_frame['txStart'].to_numpy(dtype=np.int64) + gene_frame['txEnd'].to_numpy(dtype=np.int64))/2
+    center_x = (center - position_min) / position_range
+    width = text_scaling_factor * (1 + np.array([ len(name) for name in gene_frame['geneName']], dtype=np.float64))
+    return center_x - width/2, center_x + width/2
+
+
+class _LeftmostBelow(object):
+    """Segment tree over row numbers answering: first row whose value is below a bound"""
+
+    def __init__(self, n):
+        self.size = 1
+        while self.size < max(n, 1):
+            self.size *= 2
+        self.tree = [np.inf] * (2 * self.size)
+
+
+    def set(self, row, value):
+        i = row + self.size
+        self.tree[i] = value
+        i //= 2
+        while i >= 1:
+            self.tree[i] = min(self.tree[2*i], self.tree[2*i + 1])
+            i //= 2
+
+
+    def leftmost_below(self, bound):
+        if not self.tree[1] < bound:
+            return None
+        i = 1
+        while i < self.size:
+            i = 2*i if self.tree[2*i] < bound else 2*i + 1
+        return i - self.size
+
+
+@instrument_stage(rows=lambda rows: sum(len(row) for row in rows))
 def sort_gene_locations(gene_frame, position_min, position_max):
+    """Pack genes into display rows so neither gene extents nor name labels collide
+
+    Genes are taken in txStart order and each goes into the first row whose
+    last gene neither overlaps it nor has a label reaching into its label,
+    which is the assignment the original row-by-row greedy scan produces.
+    Rows still holding a gene that reaches this txStart wait in a heap keyed
+    on txEnd; rows clear of it sit in a segment tree keyed on the right edge
+    of their last label, so each gene is placed in O(log n).
+    """
+    if not gene_frame['txStart'].is_monotonic_increasing:
+        gene_frame = gene_frame.sort_values(by="txStart", kind="mergesort")
     records = gene_frame.to_dict('records')
 
     for gene in records:
-        gene['exonStarts'] = [ int(s) for s in gene['exonStarts'].split(',') if len(s) > 0]
-        gene['exonEnds'] =  [ int(s) for s in gene['exonEnds'].split(',') if len(s) > 0]
-
+        gene['exonStarts'] = parse_exon_positions(gene['exonStarts'])
+        gene['exonEnds'] =  parse_exon_positions(gene['exonEnds'])
 
+    tx_start = gene_frame['txStart'].to_numpy(dtype=np.int64).tolist()
+    tx_end = gene_frame['txEnd'].to_numpy(dtype=np.int64).tolist()
+    label_left, label_right = [ e.tolist() for e in gene_label_extents(gene_frame, position_min, position_max)]
 
     rows = []
-    while len(records) > 0:
-
-        current_row = []
-        last_item = None
-        remainder = []
-        
-        for r in records:
-            if None == last_item:
-                current_row.append(r)
-                last_item = r
-            elif overlap_region(last_item, r):
-                remainder.append(r)
-            elif overlap_text(last_item, r, position_min, position_max):
-                remainder.append(r)
-            else:
-                current_row.append(r)
-                last_item = r
-        rows.append(current_row)
-        records = remainder
-
+    busy_rows = []  # heap of (txEnd of the row's last gene, row)
+    free_rows = _LeftmostBelow(len(records))
+    row_label_right = []
+    for i, gene in enumerate(records):
+        while len(busy_rows) > 0 and busy_rows[0][0] < tx_start[i]:
+            _, row = heapq.heappop(busy_rows)
+            free_rows.set(row, row_label_right[row])
+
+        row = free_rows.leftmost_below(label_left[i])
+        if None == row:
+            row = len(rows)
+            rows.append([])
+            row_label_right.append(None)
+        else:
+            free_rows.set(row, np.inf)
+
+        rows[row].append(gene)
+        row_label_right[row] = label_right[i]
+        heapq.heappush(busy_rows, (tx_end[i], row))
 
     return rows
 
@@ -87,41 +307,81 @@ def sort_gene_locations(gene_frame, position_min, position_max):
 
 
 
+@instrument_stage(rows=len)
 def load_gene_region_info(chromosome, position_min, position_max, locuszoom_gene_db):
-    conn = sqlite3.connect(locuszoom_gene_db)
+    if hasattr(locuszoom_gene_db, 'region_info'):
+        # an in-memory GeneAnnotationIndex rather than a database path
+        return locuszoom_gene_db.region_info(chromosome, position_min, position_max)
 
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM refFlat where refFlat.chrom='{chrom}';".format(chrom=chromosome))
-    records = [ r for r in cursor.fetchall()]
-    columns = [ t[0] for t in cursor.description]
+    records, columns = query_gene_region(chromosome, position_min, position_max, locuszoom_gene_db)
     frame = pd.DataFrame.from_records(records, columns=columns)
-    exclude_select = (frame['txEnd'] < position_min) | (position_max < frame['txStart'])
-    frame = frame[~exclude_select]
     frame = frame.drop_duplicates('geneName')
     # drop duplicate gene names
-    return frame.sort_values(by="txStart")
+    return frame.sort_values(by="txStart", kind="mergesort")
 
 
 def scale_gene_rows(gene_rows):
-    """Scale gene rows to use megabases or mega-nucleotides rather than plain nucleotides"""
+    """Copy of gene rows using megabases or mega-nucleotides rather than plain nucleotides"""
 
     M = 1e6
+    scaled_rows = []
     for row in gene_rows:
+        scaled_row = []
         for gene in row:
-            gene['txStart'] = float(gene['txStart']) / M
-            gene['txEnd'] = float(gene['txEnd']) / M
-            gene['exonStarts'] = [ float(s)/M for s in gene['exonStarts']]
-            gene['exonEnds'] = [ float(s)/M for s in gene['exonEnds']]
+            scaled = dict(gene)
+            scaled['txStart'] = float(gene['txStart']) / M
+            scaled['txEnd'] = float(gene['txEnd']) / M
+            scaled['exonStarts'] = [ float(s)/M for s in gene['exonStarts']]
+            scaled['exonEnds'] = [ float(s)/M for s in gene['exonEnds']]
+            scaled_row.append(scaled)
+        scaled_rows.append(scaled_row)
+
+    return scaled_rows
+
+
+def _row_segments(x_pairs, y):
+    x = np.array(x_pairs, dtype=np.float64).reshape(-1, 2) / 1e6
+    y = np.array(y, dtype=np.float64)
+    return np.stack([np.column_stack([x[:, 0], y]), np.column_stack([x[:, 1], y])], axis=1)
+
 
-    return gene_rows
+def gene_track_segments(gene_rows):
+    """(gene_segments, exon_segments) of gene rows as (n, 2, 2) arrays of ((start, y), (end, y)) in Mb
+
+    Row i is drawn at y = -i.
+    """
+    gene_x, gene_y = [], []
+    exon_x, exon_y = [], []
+    for i, row in enumerate(gene_rows):
+        for gene in row:
+            gene_x.append((float(gene['txStart']), float(gene['txEnd'])))
+            gene_y.append(-i)
+            exon_x.extend(zip(gene['exonStarts'], gene['exonEnds']))
+            exon_y.extend([-i] * len(gene['exonStarts']))
+    return _row_segments(gene_x, gene_y), _row_segments(exon_x, exon_y)
 
 
+@instrument_stage()
 def plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max):
+    """Draw gene_rows (see sort_gene_locations) on gene_axes without modifying them
+
+    Gene spans, exons and the end ticks are each a single artist however many
+    genes and exons are in the window; only the gene name labels are per gene.
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+
     M = 1e6
     position_min = position_min/ M
     position_max = position_max/M
 
-    scale_gene_rows(gene_rows)
+    gene_segments, exon_segments = gene_track_segments(gene_rows)
+    gene_axes.add_collection(LineCollection(gene_segments, colors='b', linewidths=1, capstyle='projecting'))
+    gene_axes.add_collection(LineCollection(exon_segments, colors='b', linewidths=5, capstyle='projecting'))
+
+    ## force vertical line at beginning and end for short genes that might otherwis get dropped by the plot rendering engine
+    ends = np.concatenate([gene_segments.reshape(-1, 2), exon_segments.reshape(-1, 2)])
+    gene_axes.add_line(Line2D(ends[:, 0], ends[:, 1], linestyle='None', marker='|', color='b'))
 
     text_yoffset = 0.4
     fontsize_magic = 5
@@ -129,21 +389,7 @@ def plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max):
     for i,row in enumerate(gene_rows):
         y_coord = -i
         for gene in row:
-            center_x = (gene['txStart'] +  gene['txEnd'])/2
-            x = [float(gene['txStart']), float(gene['txEnd'])]
-            y = [y_coord, y_coord]
-            gene_axes.plot(x,y, 'b-|', linewidth=1)   ## force vertical line at beginning and end for short genes that might otherwis get dropped by the plot rendering engine
-
-            
-            exonStarts = gene['exonStarts']
-            exonEnds = gene['exonEnds']
-
-
-            for es, ee in zip(exonStarts, exonEnds):
-                x = [es, ee]
-                y = [y_coord, y_coord]
-                gene_axes.plot(x,y, 'b-|', linewidth=5)
-
+            center_x = (float(gene['txStart'])/M + float(gene['txEnd'])/M)/2
             if '+' == gene['strand']:
                 gene_axes.text(center_x, y_coord + text_yoffset, gene['geneName'] + "→",
                                horizontalalignment='center', verticalalignment='center',
@@ -167,16 +413,14 @@ def plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max):
 
 
 def plot_gene_region(output_plot, gene_rows, position_min, position_max):
-    pyplot.clf()
-    mainfig, gene_axes = pyplot.subplots(1,1, num=None, figsize=(8,6), dpi=150)
+    mainfig = new_figure(figsize=(8,6), dpi=150, interactive=(None == output_plot))
+    gene_axes = mainfig.subplots(1,1)
 
     plot_gene_region_worker(gene_axes, gene_rows, position_min, position_max)
 
-    #pyplot.show()
     if None != output_plot:
-        pyplot.savefig(output_plot, bbox_inches='tight');
-        pyplot.draw()
+        mainfig.savefig(output_plot, bbox_inches='tight')
     else:
-        pyplot.show()
-    pyplot.close(mainfig)
+        show_figure(mainfig)
+    release_figure(mainfig)
 
@@ -5,19 +5,27 @@
 
 
 
-import re
+import functools
 
 import pandas as pd
 import numpy as np
 
-import matplotlib
-import matplotlib.pyplot as pyplot
-import matplotlib.cm as cmx
-from matplotlib.patches import Rectangle
+from .tabix import TabixFile
+from .tabix import has_tabix_index
+from .pvalue_store import normalize_chromosome
+from .instrumentation import instrument_stage
+
+from .figures import new_figure
+from .figures import show_figure
+from .figures import release_figure
 
 
 ################################################################################
 
+# scatter marker area in points^2, and the edge width in points, of the association points
+R2_POINT_SIZE = 36
+R2_POINT_LINEWIDTH = 1
+
 LD_REGIMES =  [  (0,   0.2, (0,0,0x80)),
                  (0.2, 0.4, (0x87,0xce, 0xfa)),
                  (0.4, 0.6, (0x00,0xff, 0x00)),
@@ -65,40 +73,175 @@ def window_pvalue(pvalue_frame, position_min, position_max):
     exclude_select = (pvalue_frame['position'] < position_min) | (position_max < pvalue_frame['position'])
     results = pvalue_frame[~exclude_select]
     return results
+
+
+@instrument_stage(rows=len)
+def select_pvalue_region(pvalue_frame, chromosome, position_min, position_max):
+    """Rows of chromosome in the window, from a frame or an indexed store with a region() method such as PvalueStore
+
+    Chromosome labels are compared normalized, so 3, '3' and 'chr3' match. A
+    frame without a chrom column is windowed on position only.
+    """
+    if hasattr(pvalue_frame, 'region'):
+        return pvalue_frame.region(chromosome, position_min, position_max)
+    frame = window_pvalue(pvalue_frame, position_min, position_max)
+    if 'chrom' in frame.columns:
+        frame = frame[_chromosome_select(frame['chrom'], chromosome)]
+    return frame
     
 
 
 
 
-def load_plink_r2_results_file(filename, target_variant, position_min, position_max):
-    # PLINK has strange formatting for its output files
-    lines = [line.strip(" \t\n") for line in open(filename)]
-    records = [ re.split("[ \t]+", line) for line in lines]
-    header = records[0]
-    rest = records[1:]
-    initial = pd.DataFrame.from_records(rest, columns=header)
-    replace = { "SNP_A" : "target_variant",
-                "CHR_B" : "chrom",
-                "BP_B"  : "position",
-                "SNP_B" : "variant",
-                "R2"    : "ld_r2" }
-    initial = initial.rename(columns=replace)
-    initial['ld_r2'] = [ float(x) for x in initial['ld_r2']]
+PLINK_LD_COLUMNS = { "SNP_A" : "target_variant",
+                     "CHR_B" : "chrom",
+                     "BP_B"  : "position",
+                     "SNP_B" : "variant",
+                     "R2"    : "ld_r2" }
+
+PLINK_LD_DTYPES = { "SNP_A" : str,
+                    "CHR_B" : str,
+                    "BP_B"  : np.int64,
+                    "SNP_B" : str,
+                    "R2"    : np.float32 }
+
+
+def _read_plink_ld_chunks(filename, chunksize, position_min, position_max, chromosome=None):
+    if None != position_min and None != position_max and has_tabix_index(filename):
+        # bgzip compressed and tabix indexed on CHR_B/BP_B, only read the blocks in the window
+        tabix_file = TabixFile(filename)
+        chromosomes = tabix_file.header['names'] if None == chromosome else [chromosome]
+        for c in chromosomes:
+            chunk = tabix_file.region(c, position_min, position_max)
+            yield chunk[list(PLINK_LD_COLUMNS)].astype(PLINK_LD_DTYPES)
+        return
+
+    # PLINK has strange formatting for its output files, runs of spaces with leading padding
+    reader = pd.read_csv(filename, sep=r"\s+", engine="c", usecols=list(PLINK_LD_COLUMNS),
+                         dtype=PLINK_LD_DTYPES, chunksize=chunksize)
+    for chunk in reader:
+        yield chunk
+
+
+# (chrom, position) pairs are packed into one sortable int64 key as chromosome code << _CHROM_KEY_SHIFT + position
+_CHROM_KEY_SHIFT = 32
+
+
+def _chromosome_codes(chrom, chrom_codes):
+    """Code in chrom_codes (keyed by normalized chromosome) of each label in chrom, -1 when absent"""
+    # factorize so chromosome names are normalized once per distinct value, not per row
+    codes, uniques = pd.factorize(chrom)
+    table = np.array([ chrom_codes.get(normalize_chromosome(u), -1) for u in uniques] + [-1], dtype=np.int64)
+    return table[codes]
+
+
+def _chrom_position_keys(codes, positions):
+    """Packed (chrom, position) keys of known (non-negative) chromosome codes"""
+    return (np.asarray(codes, dtype=np.int64) << _CHROM_KEY_SHIFT) + np.asarray(positions, dtype=np.int64)
+
+
+def _chromosome_select(chrom, chromosome):
+    return 0 == _chromosome_codes(chrom, { normalize_chromosome(chromosome): 0 })
+
+
+@instrument_stage(rows=len)
+def load_plink_r2_results_file(filename, target_variant=None, position_min=None, position_max=None, chunksize=1000000,
+                               chromosome=None):
+    """Read PLINK --r2 output, keeping only rows for target_variant (SNP_A) with BP_B in [position_min, position_max]
+
+    The file is parsed in chunks with the C parser, so only rows that pass the
+    filters are ever held in memory. Passing None for a filter disables it;
+    chromosome ('3' and 'chr3' match) keeps rows with that CHR_B. A bgzip
+    compressed file with a tabix index next to it is read by region instead,
+    touching only the blocks that overlap the window on chromosome, or on
+    every chromosome of the index when it is None.
+    """
+    chunks = []
+    for chunk in _read_plink_ld_chunks(filename, chunksize, position_min, position_max, chromosome):
+        select = np.ones(len(chunk), dtype=bool)
+        if None != target_variant:
+            select &= (chunk["SNP_A"] == target_variant).to_numpy()
+        if None != chromosome:
+            select &= _chromosome_select(chunk["CHR_B"], chromosome)
+        if None != position_min:
+            select &= (chunk["BP_B"] >= position_min).to_numpy()
+        if None != position_max:
+            select &= (chunk["BP_B"] <= position_max).to_numpy()
+        chunks.append(chunk[select])
+
+    if 0 == len(chunks):
+        initial = pd.DataFrame({ c: pd.Series(dtype=t) for c, t in PLINK_LD_DTYPES.items()})
+    else:
+        initial = pd.concat(chunks, ignore_index=True)
+
+    initial = initial.rename(columns=PLINK_LD_COLUMNS)
+    initial['chrom'] = initial['chrom'].astype('category')
     results = initial[["target_variant", "chrom", "position", "variant", "ld_r2"]]
     return results
 
 
 
-def merge_pvalue_ld(pvalue_frame, ld_frame):
-    results = pd.merge(left=pvalue_frame, right=ld_frame, on="variant", how="left")
-    results = results.rename(columns={"position_x": "position"})
+def pvalue_join_keys(pvalue_frame):
+    """Integer (chrom, position) join keys of pvalue_frame rows, reusable across merge_pvalue_ld calls
+
+    Keys are chromosome code << _CHROM_KEY_SHIFT + position, with chromosome codes
+    numbered over the chromosomes present in pvalue_frame.
+    """
+    uniques = pd.unique(pvalue_frame['chrom'])
+    chrom_codes = {}
+    for u in uniques:
+        chrom_codes.setdefault(normalize_chromosome(u), len(chrom_codes))
+    codes = _chromosome_codes(pvalue_frame['chrom'], chrom_codes)
+    keys = _chrom_position_keys(codes, pvalue_frame['position'])
+    return { 'chrom_codes': chrom_codes, 'keys': keys }
+
+
+@instrument_stage(rows=len)
+def merge_pvalue_ld(pvalue_frame, ld_frame, pvalue_keys=None):
+    """pvalue_frame rows with an ld_r2 column from ld_frame, matched on (chrom, position)
+
+    LD rows are sorted once by integer key and looked up with a binary search,
+    so no variant strings are compared. Rows without LD get NaN; when several
+    LD rows share a position the highest r2 is used. The result is a shallow
+    copy of pvalue_frame, so its columns are not duplicated per ancestry; pass
+    pvalue_keys from pvalue_join_keys to reuse the pvalue side keys too.
+    """
+    if None == pvalue_keys:
+        pvalue_keys = pvalue_join_keys(pvalue_frame)
+
+    ld_codes = _chromosome_codes(ld_frame['chrom'], pvalue_keys['chrom_codes'])
+    known = ld_codes >= 0
+    ld_keys = _chrom_position_keys(ld_codes[known], ld_frame['position'].to_numpy(dtype=np.int64)[known])
+    ld_r2 = ld_frame['ld_r2'].to_numpy()[known]
+
+    # PLINK writes LD rows in position order, so sorting is usually skipped; otherwise
+    # sort by key, highest r2 first within a key, and keep the first row of each key
+    if not np.all(ld_keys[1:] > ld_keys[:-1]):
+        order = np.lexsort((-ld_r2, ld_keys))
+        ld_keys = ld_keys[order]
+        ld_r2 = ld_r2[order]
+        first = np.ones(len(ld_keys), dtype=bool)
+        first[1:] = ld_keys[1:] != ld_keys[:-1]
+        ld_keys = ld_keys[first]
+        ld_r2 = ld_r2[first]
+
+    merged_r2 = np.full(len(pvalue_frame), np.nan, dtype=ld_r2.dtype if len(ld_r2) > 0 else np.float32)
+    if len(ld_keys) > 0:
+        index = np.minimum(np.searchsorted(ld_keys, pvalue_keys['keys']), len(ld_keys) - 1)
+        hit = ld_keys[index] == pvalue_keys['keys']
+        merged_r2[hit] = ld_r2[index[hit]]
+
+    results = pvalue_frame.copy(deep=False)
+    results['ld_r2'] = merged_r2
     return results
 
 
 
-def colorbar_magic(figure, n_plots):
+@functools.lru_cache(maxsize=None)
+def ld_color_map():
+    """(colormap, norm) of the LD_REGIMES colorbar, built once and shared by every figure"""
+    import matplotlib.colors
     colors = []
-    ncolors = len(LD_REGIMES)
     for _, _, c in LD_REGIMES:
         red, green, blue = c
         colors.append( [float(red)/255, float(green)/255, float(blue)/255, 1])
@@ -106,6 +249,15 @@ def colorbar_magic(figure, n_plots):
     custom_color_map = matplotlib.colors.ListedColormap(colors)
 
     cNorm  = matplotlib.colors.Normalize(vmin=0, vmax=1)
+    return custom_color_map, cNorm
+
+
+@instrument_stage()
+def colorbar_magic(figure, n_plots):
+    import matplotlib.cm as cmx
+    ncolors = len(LD_REGIMES)
+    custom_color_map, cNorm = ld_color_map()
+    # a mappable per figure, as a colorbar registers itself with its mappable
     scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=custom_color_map)
     scalarMap.set_array([])
 
@@ -122,7 +274,7 @@ def colorbar_magic(figure, n_plots):
     cax = figure.add_axes(positioning_magic)  
     cax.set_title("r2", fontsize=fontsize_magic)  
 
-    pyplot.colorbar(scalarMap, cax = cax, ticks=[float(i) / ncolors for i in range(0, ncolors+1)],
+    figure.colorbar(scalarMap, cax = cax, ticks=[float(i) / ncolors for i in range(0, ncolors+1)],
                                             orientation='vertical')
     for text_obj in cax.get_yticklabels():
         text_obj.set_fontsize(fontsize_magic)
@@ -131,57 +283,131 @@ def colorbar_magic(figure, n_plots):
 
 
 
-def plot_r2_region_worker(r2_axes, pvalue_ld_frame, target_variant, position_min, position_max, fancy_variant_name):
-    M = 1e6
-    position_min = position_min/M
-    position_max = position_max/M
-
-    ld_color_groups = {} ## will include "gray" for unknown ld
-
+def ld_regime_colors():
+    """Colors indexed by LD bin, bin 0 is grey for variants without LD information"""
     colors = ["grey"]
-    for ld_min, ld_max, color_tuple in LD_REGIMES:
+    for _, _, color_tuple in LD_REGIMES:
         red, green, blue = color_tuple
-        color = "#{r:02X}{g:02X}{b:02X}".format(r=red, g=green, b=blue) 
-        colors.append(color)
-        x = []
-        y = []
-        for pos,pvalue,ld,variant in zip(pvalue_ld_frame['position'], pvalue_ld_frame['pvalue'], pvalue_ld_frame['ld_r2'], pvalue_ld_frame['variant']):
-            if pd.isnull(ld):
-                continue
-
-            elif variant == target_variant:
-                continue
+        colors.append("#{r:02X}{g:02X}{b:02X}".format(r=red, g=green, b=blue))
+    return colors
+
+
+@instrument_stage(rows=lambda r2_points: len(r2_points[0]))
+def bin_r2_region_points(pvalue_ld_frame, target_variant):
+    """Split merged pvalue/LD rows into scatter arrays
+
+    Returns (positions, log_pvalues, ld_bins, target_position, target_log_pvalue)
+    where the arrays exclude the target variant and ld_bins is 0 for unknown LD
+    or 1..len(LD_REGIMES) for the LD_REGIMES interval holding the r2 value.
+    """
+    positions = pvalue_ld_frame['position'].to_numpy(dtype=np.float64)
+    log_pvalues = -np.log10(pvalue_ld_frame['pvalue'].to_numpy(dtype=np.float64))
+    ld = pvalue_ld_frame['ld_r2'].to_numpy(dtype=np.float64)
+    is_target = (pvalue_ld_frame['variant'] == target_variant).to_numpy(dtype=bool)
+
+    target_rows = np.flatnonzero(is_target)
+    if 0 == len(target_rows):
+        raise Exception("ERROR target variant {v} not found in pvalue data".format(v=target_variant))
+    target_row = target_rows[-1]
+
+    # r2 of exactly 1 belongs in the top regime
+    ld_edges = [ ld_min for ld_min, _, _ in LD_REGIMES[1:]]
+    ld_bins = np.digitize(ld, ld_edges) + 1
+    ld_bins[np.isnan(ld)] = 0
+
+    keep = ~is_target
+    return (positions[keep], log_pvalues[keep], ld_bins[keep],
+            positions[target_row], log_pvalues[target_row])
+
+
+def decimate_r2_points(r2_points, position_min, position_max, pixel_width, pixel_height, keep_log_pvalue=None,
+                       cell_pixels=1):
+    """Drop scatter points that cannot be told apart at the plot resolution
+
+    The plot is divided into cells of cell_pixels x cell_pixels pixels and
+    only the highest point of each LD bin in each cell is kept, so the
+    highest point per cell column and LD bin always survives. Cells sized
+    from the drawn point (see r2_point_pixels) make each kept point cover
+    most of the points dropped with it. Points with -log10(p) >=
+    keep_log_pvalue are all kept, as are points whose -log10(p) is not
+    finite (p of 0) and the target variant, which r2_points holds
+    separately. Kept points stay in their input order.
+    """
+    positions, log_pvalues, ld_bins, variant_pos, variant_y = r2_points
+    if 0 == len(positions):
+        return r2_points
+
+    n_columns = max(1, int(np.ceil(pixel_width / cell_pixels)))
+    n_rows = max(1, int(np.ceil(pixel_height / cell_pixels)))
+    # the cell grid spans the finite values, a single p of 0 must not squash it into one row
+    finite = np.isfinite(log_pvalues)
+    finite_y = log_pvalues[finite]
+    y_min = min(0.0, finite_y.min()) if 0 < len(finite_y) else 0.0
+    y_max = max(y_min + 1e-9, finite_y.max() if 0 < len(finite_y) else 0.0,
+                variant_y if np.isfinite(variant_y) else y_min)
+
+    x_fraction = (positions - position_min) / max(position_max - position_min, 1)
+    columns = np.clip(np.floor(x_fraction * n_columns), -1, n_columns).astype(np.int64) + 1
+    rows = np.clip(np.floor((np.where(finite, log_pvalues, y_min) - y_min) / (y_max - y_min) * n_rows),
+                   0, n_rows).astype(np.int64)
+    cells = (ld_bins.astype(np.int64) * (n_columns + 2) + columns) * (n_rows + 1) + rows
+
+    order = np.lexsort((-log_pvalues, cells))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = cells[order[1:]] != cells[order[:-1]]
+    keep = np.zeros(len(positions), dtype=bool)
+    keep[order[first]] = True
+    keep |= ~finite
+    if None != keep_log_pvalue:
+        keep |= log_pvalues >= keep_log_pvalue
+
+    return positions[keep], log_pvalues[keep], ld_bins[keep], variant_pos, variant_y
+
+
+def r2_point_pixels(dpi, s=R2_POINT_SIZE, linewidths=R2_POINT_LINEWIDTH):
+    """Diameter in pixels of an association point drawn at dpi: a '.' marker of area s (points^2) is a
+    dot of half the marker width, plus its edge"""
+    return (0.5 * np.sqrt(s) + linewidths) * dpi / 72.0
+
+
+def axes_pixel_size(axes):
+    """(width, height) of axes in figure pixels"""
+    extent = axes.get_window_extent()
+    return extent.width, extent.height
+
+
+@instrument_stage(rows=lambda point_counts: point_counts[1])
+def plot_r2_points_worker(r2_axes, r2_points, position_min, position_max, fancy_variant_name, decimate=False,
+                          keep_log_pvalue=-np.log10(5e-8)):
+    """Scatter r2_points (see bin_r2_region_points) on r2_axes, returns (n_rendered, n_input) counting the target
+
+    With decimate, points that a higher point of the same LD bin mostly
+    covers at the figure resolution are dropped first: decimate_r2_points
+    with cells the size of the radius of a drawn point.
+    """
+    n_input = len(r2_points[0]) + 1
+    if decimate:
+        pixel_width, pixel_height = axes_pixel_size(r2_axes)
+        r2_points = decimate_r2_points(r2_points, position_min, position_max, pixel_width, pixel_height,
+                                       keep_log_pvalue=keep_log_pvalue,
+                                       cell_pixels=r2_point_pixels(r2_axes.figure.dpi) / 2)
+    n_rendered = len(r2_points[0]) + 1
 
-            elif ld_min <= ld and ld < ld_max:
-                x.append(pos)
-                y.append(-np.log10(pvalue))
-
-        ld_color_groups[color] = (x,y)
-
-    x = []
-    y = []
-    for pos,pvalue,ld,variant in zip(pvalue_ld_frame['position'], pvalue_ld_frame['pvalue'], pvalue_ld_frame['ld_r2'], pvalue_ld_frame['variant']):
-        if pd.isnull(ld) and variant != target_variant:
-            x.append(pos)
-            y.append(-np.log10(pvalue))
-
-    ld_color_groups["grey"] = (x,y)
-
-    variant_pos = None
-    variant_y = None
-    for pos,pvalue,variant in zip(pvalue_ld_frame['position'], pvalue_ld_frame['pvalue'], pvalue_ld_frame['variant']):
-        if variant == target_variant:
-            variant_pos = pos
-            variant_y = -np.log10(pvalue)
+    M = 1e6
+    position_min = position_min/M
+    position_max = position_max/M
 
+    positions, log_pvalues, ld_bins, variant_pos, variant_y = r2_points
 
+    # one single-colored PathCollection per LD group, drawn grey first and highest LD last;
+    # Agg renders these much faster than a single scatter with per-point colors
+    for ld_bin, color in enumerate(ld_regime_colors()):
+        select = (ld_bins == ld_bin)
+        r2_axes.scatter(positions[select]/M, log_pvalues[select], color=color, marker='.', s=R2_POINT_SIZE,
+                        linewidths=R2_POINT_LINEWIDTH)
 
     #scale and plot
     variant_pos /=M
-    for color in colors:
-        x,y = ld_color_groups[color]
-        r2_axes.plot(np.array(x)/M, y,'.', color=color)
-
     r2_axes.plot([variant_pos], [variant_y], 'D', color="purple")
     #pyplot.text(variant_pos, variant_y, fancy_variant_name, horizontalalignment='center', verticalalignment='bottom')
 
@@ -202,21 +428,29 @@ def plot_r2_region_worker(r2_axes, pvalue_ld_frame, target_variant, position_min
     #colorbar_magic(mainfig)
     #colorbar_magic(r2_axes)
 
+    return n_rendered, n_input
+
+
+def plot_r2_region_worker(r2_axes, pvalue_ld_frame, target_variant, position_min, position_max, fancy_variant_name,
+                          decimate=False):
+    """Plot the association scatter, returns (n_rendered, n_input) points, see plot_r2_points_worker"""
+    r2_points = bin_r2_region_points(pvalue_ld_frame, target_variant)
+    return plot_r2_points_worker(r2_axes, r2_points, position_min, position_max, fancy_variant_name,
+                                 decimate=decimate)
+
 
 
 def plot_r2_region(output_plot, pvalue_ld_frame, target_variant, position_min, position_max, fancy_variant_name):
-    pyplot.clf()
-    mainfig, r2_axes = pyplot.subplots(1,1, num=None, figsize=(8,6), dpi=150)
+    mainfig = new_figure(figsize=(8,6), dpi=150, interactive=(None == output_plot))
+    r2_axes = mainfig.subplots(1,1)
 
     plot_r2_region_worker(r2_axes, pvalue_ld_frame, target_variant, position_min, position_max, fancy_variant_name)
 
-    #pyplot.show()
     if None != output_plot:
-        pyplot.savefig(output_plot, bbox_inches='tight');
-        pyplot.draw()
+        mainfig.savefig(output_plot, bbox_inches='tight')
     else:
-        pyplot.show()
-    pyplot.close(mainfig)
+        show_figure(mainfig)
+    release_figure(mainfig)
 
 
 
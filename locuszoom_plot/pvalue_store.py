@@ -0,0 +1,162 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Chromosome partitioned, position sorted summary statistics on disk
+###
+### build_pvalue_store ingests a GWAS results file once; PvalueStore then
+### answers region queries by binary search over memory-mapped arrays, so a
+### plot never loads the whole genome.
+
+
+
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+################################################################################
+
+PVALUE_STORE_METADATA = "pvalue_store.json"
+
+
+################################################################################
+
+
+def normalize_chromosome(chromosome):
+    """Chromosome label without a leading 'chr', so 3, '3' and 'chr3' all match"""
+    text = str(chromosome)
+    if text.startswith("chr"):
+        text = text[3:]
+    return text
+
+
+def _ingest_chunk(chunk, ingest_dir, columns, chrom_labels):
+    chunk_chrom = chunk[columns['chrom']].astype(str)
+    for chrom_label, rows in chunk.groupby(chunk_chrom, sort=False):
+        chrom = normalize_chromosome(chrom_label)
+        chrom_labels.setdefault(chrom, chrom_label)
+        prefix = os.path.join(ingest_dir, chrom)
+        with open(prefix + ".position", "ab") as f:
+            rows[columns['position']].to_numpy(dtype=np.int64).tofile(f)
+        with open(prefix + ".pvalue", "ab") as f:
+            rows[columns['pvalue']].to_numpy(dtype=np.float64).tofile(f)
+        if None != columns['variant']:
+            with open(prefix + ".variant", "a") as f:
+                f.write("\n".join(rows[columns['variant']].astype(str)) + "\n")
+
+
+def build_pvalue_store(source, store_dir, chrom_column="chrom", position_column="position", pvalue_column="pvalue",
+                       variant_column="variant", chunksize=1000000):
+    """Write summary statistics from source (a CSV file name or a frame) into store_dir
+
+    Rows are appended per chromosome while the input is read in chunks, then
+    each chromosome is sorted by position and saved as .npy columns, so peak
+    memory is bounded by the largest chromosome. variant_column may be None
+    (or missing from the input), in which case variant ids are formatted as
+    'chr{chrom}:{position}' on read, like load_custom_pvalue_file does.
+    """
+    if isinstance(source, pd.DataFrame):
+        chunks = [ source[i:i+chunksize] for i in range(0, len(source), chunksize)]
+        header = list(source.columns)
+    else:
+        header = list(pd.read_csv(source, nrows=0).columns)
+        usecols = [ c for c in [chrom_column, position_column, pvalue_column, variant_column] if c in header]
+        chunks = pd.read_csv(source, usecols=usecols, chunksize=chunksize)
+
+    columns = { 'chrom': chrom_column,
+                'position': position_column,
+                'pvalue': pvalue_column,
+                'variant': variant_column if variant_column in header else None }
+
+    ingest_dir = os.path.join(store_dir, ".ingest")
+    if os.path.exists(ingest_dir):
+        shutil.rmtree(ingest_dir)
+    os.makedirs(ingest_dir)
+
+    chrom_labels = {}
+    for chunk in chunks:
+        _ingest_chunk(chunk, ingest_dir, columns, chrom_labels)
+
+    chromosomes = {}
+    for chrom, chrom_label in chrom_labels.items():
+        prefix = os.path.join(ingest_dir, chrom)
+        positions = np.fromfile(prefix + ".position", dtype=np.int64)
+        order = np.argsort(positions, kind="stable")
+        np.save(os.path.join(store_dir, chrom + ".position.npy"), positions[order])
+        del positions
+        np.save(os.path.join(store_dir, chrom + ".pvalue.npy"), np.fromfile(prefix + ".pvalue", dtype=np.float64)[order])
+        if None != columns['variant']:
+            with open(prefix + ".variant") as f:
+                variants = np.array(f.read().splitlines(), dtype=bytes)
+            np.save(os.path.join(store_dir, chrom + ".variant.npy"), variants[order])
+            del variants
+        chromosomes[chrom] = { 'label': chrom_label, 'rows': int(len(order))}
+
+    shutil.rmtree(ingest_dir)
+    with open(os.path.join(store_dir, PVALUE_STORE_METADATA), "w") as f:
+        json.dump({ 'chromosomes': chromosomes, 'has_variant': None != columns['variant']}, f, indent=1)
+    return PvalueStore(store_dir)
+
+
+class PvalueStore(object):
+    """Region reader over a directory written by build_pvalue_store
+
+    Can be passed as the pvalue_frame of the locuszoom entry points. Columns
+    are memory-mapped on first use of each chromosome; pickling keeps only the
+    directory name so a store can be handed to worker processes cheaply.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, PVALUE_STORE_METADATA)) as f:
+            self.metadata = json.load(f)
+        self._columns = {}
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        return { 'store_dir': self.store_dir}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['store_dir'])
+
+
+    def chromosome_columns(self, chromosome):
+        chrom = normalize_chromosome(chromosome)
+        with self._lock:
+            columns = self._columns.get(chrom)
+            if None == columns:
+                columns = {}
+                if chrom in self.metadata['chromosomes']:
+                    names = ["position", "pvalue"] + (["variant"] if self.metadata['has_variant'] else [])
+                    for name in names:
+                        filename = os.path.join(self.store_dir, "{c}.{n}.npy".format(c=chrom, n=name))
+                        columns[name] = np.load(filename, mmap_mode="r")
+                self._columns[chrom] = columns
+            return columns
+
+
+    def region(self, chromosome, position_min, position_max):
+        """Rows of chromosome with position in [position_min, position_max], position sorted"""
+        columns = self.chromosome_columns(chromosome)
+        chrom = normalize_chromosome(chromosome)
+        if 0 == len(columns):
+            return pd.DataFrame({ "chrom": pd.Series(dtype=str), "variant": pd.Series(dtype=str),
+                                  "position": pd.Series(dtype=np.int64), "pvalue": pd.Series(dtype=np.float64)})
+
+        lo = np.searchsorted(columns['position'], position_min, side="left")
+        hi = np.searchsorted(columns['position'], position_max, side="right")
+        positions = np.array(columns['position'][lo:hi])
+        if 'variant' in columns:
+            variants = columns['variant'][lo:hi].astype(str)
+        else:
+            variants = [ 'chr{chrom}:{pos}'.format(chrom=chrom, pos=p) for p in positions]
+
+        return pd.DataFrame({ "chrom": self.metadata['chromosomes'][chrom]['label'],
+                              "variant": variants,
+                              "position": positions,
+                              "pvalue": np.array(columns['pvalue'][lo:hi]) })
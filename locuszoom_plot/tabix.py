@@ -0,0 +1,310 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Random access to bgzip compressed, tabix indexed text files
+###
+### Pure Python BGZF block reader and .tbi/.csi index parser. A region query
+### only seeks to and decompresses the BGZF blocks overlapping the window.
+
+
+
+import gzip
+import io
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from .pvalue_store import normalize_chromosome
+
+
+################################################################################
+
+TABIX_ZERO_BASED = 0x10000
+
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+
+################################################################################
+
+
+def reg2bins(beg, end, min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+    """Bins overlapping the 0-based half-open interval [beg, end), as in the SAM/CSI specification"""
+    bins = []
+    end -= 1
+    level = 0
+    first_bin = 0
+    shift = min_shift + depth * 3
+    while level <= depth:
+        bins.extend(range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1))
+        shift -= 3
+        first_bin += 1 << (level * 3)
+        level += 1
+    return bins
+
+
+def _parse_tabix_header(data, offset):
+    fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from("<7i", data, offset)
+    offset += 28
+    names = data[offset:offset + l_nm].split(b"\0")
+    names = [ n.decode() for n in names if len(n) > 0]
+    return { 'format': fmt, 'col_seq': col_seq, 'col_beg': col_beg, 'col_end': col_end,
+             'meta': chr(meta), 'skip': skip, 'names': names}, offset + l_nm
+
+
+def _read_chunks(data, offset, n_chunk):
+    chunks = np.frombuffer(data, dtype="<u8", count=2 * n_chunk, offset=offset).reshape(n_chunk, 2)
+    return chunks, offset + 16 * n_chunk
+
+
+def read_tabix_index(index_filename):
+    """Parse a .tbi or .csi index into a header dict and per-reference bin/linear indexes"""
+    with open(index_filename, "rb") as f:
+        data = gzip.decompress(f.read())
+
+    magic = data[:4]
+    references = []
+    if b"TBI\1" == magic:
+        n_ref = struct.unpack_from("<i", data, 4)[0]
+        header, offset = _parse_tabix_header(data, 8)
+        header['min_shift'] = TBI_MIN_SHIFT
+        header['depth'] = TBI_DEPTH
+        for _ in range(n_ref):
+            n_bin = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            bins = {}
+            for _ in range(n_bin):
+                bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+                bins[bin_id], offset = _read_chunks(data, offset + 8, n_chunk)
+            n_intv = struct.unpack_from("<i", data, offset)[0]
+            linear = np.frombuffer(data, dtype="<u8", count=n_intv, offset=offset + 4)
+            offset += 4 + 8 * n_intv
+            references.append({ 'bins': bins, 'linear': linear})
+
+    elif b"CSI\1" == magic:
+        min_shift, depth, l_aux = struct.unpack_from("<3i", data, 4)
+        header, _ = _parse_tabix_header(data, 16)
+        header['min_shift'] = min_shift
+        header['depth'] = depth
+        offset = 16 + l_aux
+        n_ref = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        for _ in range(n_ref):
+            n_bin = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            bins = {}
+            for _ in range(n_bin):
+                bin_id, _loffset, n_chunk = struct.unpack_from("<IQi", data, offset)
+                bins[bin_id], offset = _read_chunks(data, offset + 16, n_chunk)
+            references.append({ 'bins': bins, 'linear': None})
+    else:
+        raise Exception("ERROR {f} is not a tabix .tbi or .csi index".format(f=index_filename))
+
+    return header, references
+
+
+class BgzfReader(object):
+    """Reads byte ranges of a BGZF file addressed by virtual offsets, one block at a time"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._lock = threading.Lock()
+        self._cached_block = (None, None, None)
+
+
+    def close(self):
+        self._file.close()
+
+
+    def read_block(self, block_offset):
+        """Return (uncompressed data, offset of the next block) for the block starting at block_offset"""
+        cached_offset, data, next_offset = self._cached_block
+        if block_offset == cached_offset:
+            return data, next_offset
+
+        with self._lock:
+            self._file.seek(block_offset)
+            header = self._file.read(18)
+            if len(header) < 18:
+                return b"", block_offset
+            if header[0:2] != b"\x1f\x8b" or not (header[3] & 4):
+                raise Exception("ERROR {f} is not BGZF compressed".format(f=self.filename))
+            xlen = struct.unpack_from("<H", header, 10)[0]
+            extra = header[12:18] + self._file.read(xlen - 6)
+            block_size = None
+            i = 0
+            while i < xlen:
+                si1, si2, slen = struct.unpack_from("<BBH", extra, i)
+                if 66 == si1 and 67 == si2:
+                    block_size = struct.unpack_from("<H", extra, i + 4)[0] + 1
+                i += 4 + slen
+            if None == block_size:
+                raise Exception("ERROR {f} has a gzip block without a BGZF size field".format(f=self.filename))
+            compressed = self._file.read(block_size - 12 - xlen - 8)
+
+        data = zlib.decompress(compressed, -15)
+        next_offset = block_offset + block_size
+        self._cached_block = (block_offset, data, next_offset)
+        return data, next_offset
+
+
+    def read_range(self, virtual_begin, virtual_end):
+        """Uncompressed bytes from virtual offset virtual_begin up to virtual_end"""
+        block_offset, within = virtual_begin >> 16, virtual_begin & 0xffff
+        end_block, end_within = virtual_end >> 16, virtual_end & 0xffff
+        pieces = []
+        while block_offset <= end_block:
+            data, next_offset = self.read_block(block_offset)
+            if 0 == len(data) and next_offset == block_offset:
+                break
+            stop = end_within if block_offset == end_block else len(data)
+            pieces.append(data[within:stop])
+            within = 0
+            block_offset = next_offset
+        return b"".join(pieces)
+
+
+    def read_lines(self, count_predicate):
+        """Lines from the start of the file while count_predicate(index, line) is true"""
+        lines = []
+        block_offset = 0
+        pending = b""
+        while True:
+            data, next_offset = self.read_block(block_offset)
+            if 0 == len(data):
+                return lines
+            pending += data
+            parts = pending.split(b"\n")
+            pending = parts.pop()
+            for line in parts:
+                text = line.decode()
+                if not count_predicate(len(lines), text):
+                    return lines
+                lines.append(text)
+            block_offset = next_offset
+
+
+class TabixFile(object):
+    """bgzip compressed, tabix indexed text file supporting region queries
+
+    rename maps file column names to the names callers expect, e.g.
+    {'CHROM': 'chrom', 'POS': 'position', 'P': 'pvalue', 'SNP': 'variant'}
+    to use a summary statistics file as the pvalue_frame of the locuszoom
+    entry points. The column names come from the last header line, without its
+    leading meta character when that is punctuation such as '#' (a letter, as
+    in tabix -c C over PLINK .ld files, is part of the first name). sep is the field separator used to parse records.
+    """
+
+    def __init__(self, filename, index_filename=None, rename=None, sep="\t"):
+        if None == index_filename:
+            for suffix in [".tbi", ".csi"]:
+                if os.path.exists(filename + suffix):
+                    index_filename = filename + suffix
+                    break
+        if None == index_filename:
+            raise Exception("ERROR no .tbi or .csi index found for {f}".format(f=filename))
+
+        self.filename = filename
+        self.rename = rename or {}
+        self.sep = sep
+        self.header, self.references = read_tabix_index(index_filename)
+        self.reader = BgzfReader(filename)
+        self.columns = self._read_column_names()
+
+
+    def _read_column_names(self):
+        meta = self.header['meta']
+        skip = self.header['skip']
+        header_lines = self.reader.read_lines(lambda i, line: i < skip or line.startswith(meta))
+        if 0 == len(header_lines):
+            return None
+        names = header_lines[-1]
+        if names.startswith(meta) and not meta.isalnum():
+            names = names[len(meta):]
+        return names.split("\t") if "\t" == self.sep else names.split()
+
+
+    def reference_index(self, chromosome):
+        names = self.header['names']
+        if chromosome in names:
+            return names.index(chromosome)
+        wanted = normalize_chromosome(chromosome)
+        for i, name in enumerate(names):
+            if normalize_chromosome(name) == wanted:
+                return i
+        return None
+
+
+    def fetch_text(self, chromosome, position_min, position_max):
+        """Text of the records in the BGZF blocks that may overlap [position_min, position_max] (1-based, inclusive)"""
+        ref = self.reference_index(chromosome)
+        if None == ref:
+            return ""
+        reference = self.references[ref]
+        beg = max(0, int(position_min) - 1)
+        end = int(position_max)
+
+        chunks = [ reference['bins'][b] for b in reg2bins(beg, end, self.header['min_shift'], self.header['depth'])
+                   if b in reference['bins']]
+        if 0 == len(chunks):
+            return ""
+        chunks = np.concatenate(chunks)
+
+        linear = reference['linear']
+        if linear is not None and len(linear) > 0:
+            window = beg >> TBI_MIN_SHIFT
+            min_offset = linear[min(window, len(linear) - 1)]
+            chunks = chunks[chunks[:, 1] > min_offset]
+
+        # read each merged run of overlapping chunks once, in file order
+        chunks = chunks[np.argsort(chunks[:, 0], kind="stable")]
+        pieces = []
+        current_begin, current_end = None, None
+        for chunk_begin, chunk_end in chunks.tolist():
+            if None != current_end and chunk_begin <= current_end:
+                current_end = max(current_end, chunk_end)
+                continue
+            if None != current_begin:
+                pieces.append(self.reader.read_range(current_begin, current_end))
+            current_begin, current_end = chunk_begin, chunk_end
+        if None != current_begin:
+            pieces.append(self.reader.read_range(current_begin, current_end))
+        return b"".join(pieces).decode()
+
+
+    def region(self, chromosome, position_min, position_max):
+        """Records overlapping [position_min, position_max] on chromosome as a frame of typed NumPy columns"""
+        text = self.fetch_text(chromosome, position_min, position_max)
+        if 0 == len(text):
+            return pd.DataFrame(columns=self.columns).rename(columns=self.rename)
+        parse_sep = "\t" if "\t" == self.sep else r"\s+"
+        frame = pd.read_csv(io.StringIO(text), sep=parse_sep, header=None, names=self.columns,
+                            dtype={ self._column_name(self.header['col_seq']): str})
+
+        if len(frame) > 0:
+            seq = frame.iloc[:, self.header['col_seq'] - 1].astype(str)
+            beg = frame.iloc[:, self.header['col_beg'] - 1].to_numpy(dtype=np.int64)
+            if self.header['format'] & TABIX_ZERO_BASED:
+                beg = beg + 1
+            end = beg
+            if self.header['col_end'] > 0 and self.header['col_end'] != self.header['col_beg']:
+                end = frame.iloc[:, self.header['col_end'] - 1].to_numpy(dtype=np.int64)
+            wanted = self.header['names'][self.reference_index(chromosome)]
+            select = (seq == wanted).to_numpy() & (beg <= position_max) & (end >= position_min)
+            frame = frame[select].reset_index(drop=True)
+
+        return frame.rename(columns=self.rename)
+
+
+    def _column_name(self, column_number):
+        if None == self.columns:
+            return column_number - 1
+        return self.columns[column_number - 1]
+
+
+def has_tabix_index(filename):
+    return os.path.exists(filename + ".tbi") or os.path.exists(filename + ".csi")
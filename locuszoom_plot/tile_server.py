@@ -0,0 +1,250 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Pre-rendered, zoomable track tiles for browsing whole chromosomes
+###
+### A tile is a fixed size PNG of one track (association scatter or gene
+### track) over one slice of a chromosome at one zoom level. Tiles are kept in
+### an on-disk cache laid out as {cache_dir}/{track}/{chrom}/{z}/{x}.png and
+### served over HTTP, rendering missing tiles on demand.
+
+
+
+import http.server
+import io
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .figures import new_figure
+from .figures import release_figure
+from .plot_r2_region import ld_regime_colors
+from .plot_r2_region import select_pvalue_region
+from .plot_gene_region import load_gene_region_info
+from .plot_gene_region import gene_label_extents
+from .plot_gene_region import sort_gene_locations
+from .plot_gene_region import plot_gene_region_worker
+
+
+################################################################################
+
+TILE_TRACKS = ("association", "genes")
+
+# zoom 0 covers 2**28 bp (longer than any human chromosome) in one tile, each level halves the span
+TILE_BASE_SPAN = 2 ** 28
+TILE_MAX_ZOOM = 18
+
+TILE_WIDTH = 256
+TILE_HEIGHTS = { "association": 256, "genes": 128 }
+TILE_DPI = 100
+
+# gene rows shown in a gene track tile, at a fixed height so rows line up across tiles
+TILE_GENE_ROWS = 8
+
+_TILE_URL = re.compile(r"^/(?P<track>[a-z]+)/(?P<chrom>[A-Za-z0-9_.]+)/(?P<z>\d+)/(?P<x>\d+)\.png$")
+
+
+################################################################################
+
+
+def tile_span(z):
+    """Width in bp of a tile at zoom level z"""
+    return TILE_BASE_SPAN >> z
+
+
+def tile_window(z, x):
+    """(position_min, position_max) covered by tile x at zoom level z"""
+    span = tile_span(z)
+    return x * span, (x + 1) * span - 1
+
+
+def tiles_covering(z, position_min, position_max):
+    """Tile x indices at zoom level z overlapping [position_min, position_max]"""
+    span = tile_span(z)
+    return range(max(0, position_min) // span, position_max // span + 1)
+
+
+class TileRenderer(object):
+    """Renders and caches track tiles for one set of summary statistics and gene models
+
+    pvalue_frame is anything select_pvalue_region accepts; a PvalueStore or
+    TabixFile keeps each tile to a region read. locuszoom_gene_db is best
+    given as a GeneAnnotationIndex. The association track has a fixed
+    -log10(p) range of [0, max_log_pvalue] so tiles line up; stronger
+    signals are drawn at the top edge. The gene track is packed into rows
+    once per chromosome and zoom level, with labels sized to the tile width,
+    and every tile draws its slice of that layout in TILE_GENE_ROWS rows;
+    genes packed below them are not shown at that zoom level.
+    """
+
+    def __init__(self, cache_dir, pvalue_frame, locuszoom_gene_db, max_log_pvalue=20):
+        self.cache_dir = cache_dir
+        self.pvalue_frame = pvalue_frame
+        self.locuszoom_gene_db = locuszoom_gene_db
+        self.max_log_pvalue = max_log_pvalue
+        self._lock = threading.Lock()
+        self._rendering = {}
+        self._gene_layouts = {}
+
+
+    def tile_path(self, track, chromosome, z, x):
+        return os.path.join(self.cache_dir, track, chromosome, str(z), "{x}.png".format(x=x))
+
+
+    def tile(self, track, chromosome, z, x):
+        """PNG bytes of a tile, from the cache or rendered (once, however many threads ask) and cached"""
+        path = self.tile_path(track, chromosome, z, x)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        with self._lock:
+            tile_lock = self._rendering.setdefault(path, threading.Lock())
+        with tile_lock:
+            if not os.path.exists(path):
+                png = self.render_tile(track, chromosome, z, x)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = "{p}.{pid}.{tid}.tmp".format(p=path, pid=os.getpid(), tid=threading.get_ident())
+                with open(tmp_path, "wb") as f:
+                    f.write(png)
+                os.replace(tmp_path, path)
+        with self._lock:
+            self._rendering.pop(path, None)
+
+        with open(path, "rb") as f:
+            return f.read()
+
+
+    def render_tile(self, track, chromosome, z, x):
+        if track not in TILE_TRACKS:
+            raise Exception("ERROR unknown tile track {t}".format(t=track))
+        position_min, position_max = tile_window(z, x)
+
+        figure = new_figure(figsize=(TILE_WIDTH / TILE_DPI, TILE_HEIGHTS[track] / TILE_DPI), dpi=TILE_DPI)
+        try:
+            axes = figure.add_axes([0, 0, 1, 1])
+            if "association" == track:
+                self._draw_association(axes, chromosome, position_min, position_max)
+            else:
+                self._draw_genes(axes, chromosome, position_min, position_max, z)
+            axes.set_axis_off()
+            png = io.BytesIO()
+            figure.savefig(png, format="png", dpi=TILE_DPI)
+        finally:
+            release_figure(figure)
+        return png.getvalue()
+
+
+    def _draw_association(self, axes, chromosome, position_min, position_max):
+        frame = select_pvalue_region(self.pvalue_frame, chromosome, position_min, position_max)
+        positions = frame['position'].to_numpy(dtype=np.float64) / 1e6
+        log_pvalues = np.minimum(-np.log10(frame['pvalue'].to_numpy(dtype=np.float64)), self.max_log_pvalue)
+        axes.scatter(positions, log_pvalues, color=ld_regime_colors()[0], marker='.', s=36, linewidths=1)
+        axes.set_xlim(position_min / 1e6, position_max / 1e6)
+        axes.set_ylim(0, self.max_log_pvalue * 1.02)
+
+
+    def gene_layout(self, chromosome, z):
+        """Gene rows of the whole chromosome packed for zoom level z, as (rows, genes, left, right)
+
+        genes are the (row, gene) pairs of the first TILE_GENE_ROWS rows, and
+        left/right the extents in bp of each gene together with its label.
+        """
+        key = (chromosome, z)
+        with self._lock:
+            layout = self._gene_layouts.get(key)
+            if None == layout:
+                layout = self._gene_layouts[key] = [threading.Lock(), None]
+        with layout[0]:
+            if None == layout[1]:
+                layout[1] = self._pack_gene_layout(chromosome, z)
+        return layout[1]
+
+
+    def _pack_gene_layout(self, chromosome, z):
+        span = tile_span(z)
+        region_info = load_gene_region_info(chromosome, 0, TILE_BASE_SPAN - 1, self.locuszoom_gene_db)
+        # packing against a window of one tile sizes the labels as each tile draws them
+        gene_rows = sort_gene_locations(region_info, 0, span)[:TILE_GENE_ROWS]
+
+        genes = [ (i, gene) for i, row in enumerate(gene_rows) for gene in row]
+        frame = pd.DataFrame({ 'txStart': [ gene['txStart'] for _, gene in genes],
+                               'txEnd': [ gene['txEnd'] for _, gene in genes],
+                               'geneName': [ gene['geneName'] for _, gene in genes]})
+        label_left, label_right = gene_label_extents(frame, 0, span)
+        left = np.minimum(frame['txStart'].to_numpy(dtype=np.float64), label_left * span)
+        right = np.maximum(frame['txEnd'].to_numpy(dtype=np.float64), label_right * span)
+        return gene_rows, genes, left, right
+
+
+    def _draw_genes(self, axes, chromosome, position_min, position_max, z):
+        _, genes, left, right = self.gene_layout(chromosome, z)
+        gene_rows = [ [] for _ in range(TILE_GENE_ROWS)]
+        for k in np.flatnonzero((left <= position_max) & (right >= position_min)):
+            row, gene = genes[k]
+            gene_rows[row].append(gene)
+        # a fixed number of rows gives every tile the same ylim, and genes and labels reaching
+        # past the tile edge are drawn where the global layout puts them and cut by the canvas
+        plot_gene_region_worker(axes, gene_rows, position_min, position_max)
+
+
+    def prerender(self, chromosome, chromosome_length, zoom_levels, tracks=TILE_TRACKS):
+        """Fill the cache with every tile of chromosome at zoom_levels, returns the number of tiles"""
+        count = 0
+        for z in zoom_levels:
+            for x in tiles_covering(z, 0, chromosome_length):
+                for track in tracks:
+                    self.tile(track, chromosome, z, x)
+                    count += 1
+        return count
+
+
+class TileRequestHandler(http.server.BaseHTTPRequestHandler):
+    """GET /{track}/{chrom}/{z}/{x}.png from the server's tile_renderer"""
+
+    def do_GET(self):
+        match = _TILE_URL.match(self.path.split("?")[0])
+        if None == match or match.group('track') not in TILE_TRACKS or int(match.group('z')) > TILE_MAX_ZOOM:
+            self.send_error(404, "no such tile")
+            return
+        z = int(match.group('z'))
+        x = int(match.group('x'))
+        if x * tile_span(z) >= TILE_BASE_SPAN:
+            self.send_error(404, "no such tile")
+            return
+
+        try:
+            png = self.server.tile_renderer.tile(match.group('track'), match.group('chrom'), z, x)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        self.send_header("Cache-Control", "max-age=86400")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(png)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_tile_server(tile_renderer, host="127.0.0.1", port=8000):
+    """Threaded HTTP server for tile_renderer's tiles, call serve_forever() on it"""
+    server = http.server.ThreadingHTTPServer((host, port), TileRequestHandler)
+    server.daemon_threads = True
+    server.tile_renderer = tile_renderer
+    return server
+
+
+def serve_tiles(tile_renderer, host="127.0.0.1", port=8000):
+    server = make_tile_server(tile_renderer, host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,82 @@
+import asyncio
+import concurrent.futures
+import importlib
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def async_module():
+    return importlib.import_module("locuszoom_plot.async_locuszoom")
+
+
+class _SlowEngine(object):
+    """Stands in for generate_ld_frame, blocking until release is set, counting threads running at once"""
+
+    def __init__(self, delay=None):
+        self.delay = delay
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.started = []
+        self.active = 0
+        self.max_active = 0
+
+
+    def __call__(self, ancestry, chromosome_text, target_variant, **kwargs):
+        with self.lock:
+            self.started.append(target_variant)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            if None == self.delay:
+                self.release.wait(10)
+            else:
+                time.sleep(self.delay)
+            return pd.DataFrame({ "variant": [target_variant] })
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def _locuszoom(async_module, **kwargs):
+    return async_module.AsyncLocuszoom("/panel/{ancestry}/{chrom}", ld_engine="numpy", max_concurrency=1,
+                                       executor=concurrent.futures.ThreadPoolExecutor(4), **kwargs)
+
+
+def test_timed_out_computation_keeps_its_slot_until_its_thread_finishes(async_module, monkeypatch):
+    engine = _SlowEngine()
+    monkeypatch.setattr(async_module, "generate_ld_frame", engine)
+    locuszoom = _locuszoom(async_module, timeout=0.2)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await locuszoom.ld_frame("EUR", "1", "1:100:A:G")
+        waiting = asyncio.ensure_future(locuszoom.ld_frame("EUR", "1", "1:200:A:G"))
+        await asyncio.sleep(0.1)
+        assert ["1:100:A:G"] == engine.started  # the abandoned thread still holds the only slot
+        engine.release.set()
+        return await waiting
+
+    frame = asyncio.run(scenario())
+    assert ["1:200:A:G"] == list(frame['variant'])
+    assert 1 == engine.max_active
+
+
+def test_instance_is_usable_from_successive_event_loops(async_module, monkeypatch):
+    engine = _SlowEngine(delay=0.01)
+    monkeypatch.setattr(async_module, "generate_ld_frame", engine)
+    locuszoom = _locuszoom(async_module)
+
+    async def scenario():
+        variants = ["1:{p}:A:G".format(p=p) for p in range(100, 400, 100)]
+        frames = await asyncio.gather(*[ locuszoom.ld_frame("EUR", "1", v) for v in variants])
+        return [ frame['variant'][0] for frame in frames]
+
+    # contending for the limit binds asyncio primitives to the loop they wait in
+    first = asyncio.run(scenario())
+    second = asyncio.run(scenario())
+    assert first == second
+    assert 1 == engine.max_active
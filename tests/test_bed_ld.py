@@ -0,0 +1,35 @@
+import numpy as np
+
+from locuszoom_plot.bed_ld import ld_r2_against
+from locuszoom_plot.bed_ld import ld_r2_matrix
+
+
+def _genotypes(rows=40, samples=300, seed=7):
+    rng = np.random.default_rng(seed)
+    genotypes = rng.integers(0, 3, size=(rows, samples)).astype(np.int8)
+    genotypes[rng.random(genotypes.shape) < 0.05] = -1
+    genotypes[3] = 1  # monomorphic, r2 undefined
+    return genotypes
+
+
+def _reference_r2(a, b):
+    called = (a >= 0) & (b >= 0)
+    if called.sum() < 2:
+        return np.nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.corrcoef(a[called], b[called])[0, 1] ** 2
+
+
+def test_ld_r2_matrix_matches_pairwise_correlation():
+    genotypes = _genotypes()
+    r2 = ld_r2_matrix(genotypes[:5], genotypes)
+    expected = np.array([[_reference_r2(a, b) for b in genotypes] for a in genotypes[:5]])
+    np.testing.assert_allclose(r2, expected, rtol=1e-9, atol=1e-12, equal_nan=True)
+
+
+def test_ld_r2_against_is_a_row_of_ld_r2_matrix():
+    genotypes = _genotypes()
+    for lead in [0, 3, 11]:
+        np.testing.assert_array_equal(ld_r2_against(genotypes[lead], genotypes),
+                                      ld_r2_matrix(genotypes[lead:lead + 1], genotypes)[0])
+    assert np.isnan(ld_r2_against(genotypes[3], genotypes)).all()
@@ -0,0 +1,49 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Package level names: lazy imports and functions named like their submodules
+
+import subprocess
+import sys
+
+import pytest
+
+import locuszoom_plot
+
+
+SHADOWED = ["basic_locuszoom", "multi_ancestry_locuszoom", "plot_r2_region", "plot_gene_region"]
+
+
+def _run(code):
+    # a fresh interpreter, so no submodule is imported yet
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert 0 == result.returncode, result.stderr
+    return result.stdout.split()
+
+
+@pytest.mark.parametrize("submodule", sorted(locuszoom_plot._SUBMODULE_NAMES))
+def test_functions_survive_importing_a_submodule_first(submodule):
+    code = ("import locuszoom_plot.{s}\n"
+            "import locuszoom_plot as lzp\n"
+            "print(*[ callable(getattr(lzp, n)) for n in {names!r}])\n").format(s=submodule, names=SHADOWED)
+    assert ["True"] * len(SHADOWED) == _run(code)
+
+
+def test_functions_survive_from_submodule_import():
+    code = ("from locuszoom_plot.locus_session import LocusSession\n"
+            "import locuszoom_plot as lzp\n"
+            "print(lzp.basic_locuszoom.__name__, lzp.plot_gene_region.__name__)\n")
+    assert ["basic_locuszoom", "plot_gene_region"] == _run(code)
+
+
+def test_star_import_binds_functions():
+    code = ("import locuszoom_plot as lzp\n"
+            "lzp.LocusSession\n"
+            "from locuszoom_plot import *\n"
+            "print(*[ type(globals()[n]).__name__ for n in {names!r}])\n").format(names=SHADOWED)
+    assert ["function"] * len(SHADOWED) == _run(code)
+
+
+def test_package_import_is_lazy():
+    code = ("import sys, locuszoom_plot\n"
+            "print('matplotlib' in sys.modules, 'pandas' in sys.modules)\n")
+    assert ["False", "False"] == _run(code)
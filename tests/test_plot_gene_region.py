@@ -0,0 +1,86 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Gene database lookups and the R-tree sidecar index
+
+import importlib
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+import locuszoom_plot as lzp
+
+
+GENES = [ ("GENE1", "NM_1", "chr3", "+", 1000, 5000, 1000, 5000, 2, "1000,4000,", "2000,5000,"),
+          ("GENE2", "NM_2", "chr3", "-", 4500, 9000, 4500, 9000, 1, "4500,", "9000,"),
+          ("GENE3", "NM_3", "chr5", "+", 1000, 5000, 1000, 5000, 1, "1000,", "5000,")]
+
+
+@pytest.fixture
+def gene_db(tmp_path):
+    filename = str(tmp_path / "genes.db")
+    conn = sqlite3.connect(filename)
+    conn.execute("CREATE TABLE refFlat (geneName TEXT, name TEXT, chrom TEXT, strand TEXT, txStart INT, txEnd INT, "
+                 "cdsStart INT, cdsEnd INT, exonCount INT, exonStarts TEXT, exonEnds TEXT)")
+    conn.executemany("INSERT INTO refFlat VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", GENES)
+    conn.commit()
+    conn.close()
+    yield filename
+    lzp.close_gene_db_connections()
+
+
+@pytest.fixture
+def gene_module(monkeypatch, tmp_path):
+    module = importlib.import_module("locuszoom_plot.plot_gene_region")
+    monkeypatch.setattr(module, "_gene_region_index_failures", {})
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    return module
+
+
+def _failing_builds(monkeypatch, module, fail):
+    calls = []
+    build = module.build_gene_region_index
+
+    def failing_build(locuszoom_gene_db, index_db=None):
+        calls.append(index_db)
+        if fail(index_db):
+            raise OSError("read-only")
+        return build(locuszoom_gene_db, index_db)
+    monkeypatch.setattr(module, "build_gene_region_index", failing_build)
+    return calls
+
+
+def test_query_gene_region_builds_the_index_next_to_the_database(gene_db, gene_module):
+    records, columns = lzp.query_gene_region("chr3", 4800, 6000, gene_db)
+    assert ["GENE1", "GENE2"] == [ r[columns.index("geneName")] for r in records]
+    assert os.path.exists(gene_db + lzp.GENE_REGION_INDEX_SUFFIX)
+
+
+def test_failed_index_builds_are_not_retried(gene_db, gene_module, monkeypatch):
+    calls = _failing_builds(monkeypatch, gene_module, lambda index_db: True)
+    for _ in range(3):
+        records, columns = lzp.query_gene_region("chr3", 4800, 6000, gene_db)
+        assert ["GENE1", "GENE2"] == [ r[columns.index("geneName")] for r in records]
+    # once next to the database and once in the temp directory
+    assert 2 == len(calls)
+
+    # a changed database is worth another try
+    conn = sqlite3.connect(gene_db)
+    conn.execute("DELETE FROM refFlat WHERE geneName = 'GENE2'")
+    conn.commit()
+    conn.close()
+    os.utime(gene_db, ns=(0, 0))
+    records, columns = lzp.query_gene_region("chr3", 4800, 6000, gene_db)
+    assert ["GENE1"] == [ r[columns.index("geneName")] for r in records]
+    assert 4 == len(calls)
+
+
+def test_index_goes_to_the_temp_directory_beside_a_read_only_database(gene_db, gene_module, monkeypatch):
+    calls = _failing_builds(monkeypatch, gene_module, lambda index_db: index_db.startswith(gene_db))
+    for _ in range(3):
+        records, columns = lzp.query_gene_region("chr5", 0, 10000, gene_db)
+        assert ["GENE3"] == [ r[columns.index("geneName")] for r in records]
+    assert 2 == len(calls)
+    assert calls[1].startswith(tempfile.gettempdir())
+    assert os.path.exists(calls[1])
@@ -0,0 +1,66 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### p-value windows and the association scatter
+
+import numpy as np
+import pandas as pd
+
+import locuszoom_plot as lzp
+
+
+def test_select_pvalue_region_keeps_only_the_chromosome():
+    frame = pd.DataFrame({ "chrom": [3, 3, 5, 5, 3],
+                           "position": [100, 200, 150, 250, 900],
+                           "variant": ["chr3:100", "chr3:200", "chr5:150", "chr5:250", "chr3:900"],
+                           "pvalue": [0.1, 0.2, 0.3, 0.4, 0.5]})
+    for chromosome in ["chr3", "3", 3]:
+        region = lzp.select_pvalue_region(frame, chromosome, 100, 300)
+        assert ["chr3:100", "chr3:200"] == region['variant'].tolist()
+    assert ["chr5:150"] == lzp.select_pvalue_region(frame, "chr5", 120, 200)['variant'].tolist()
+    assert 0 == len(lzp.select_pvalue_region(frame, "chr7", 0, 1000))
+
+
+def test_select_pvalue_region_without_chrom_column():
+    frame = pd.DataFrame({ "position": [100, 200, 300], "pvalue": [0.1, 0.2, 0.3]})
+    assert [200, 300] == lzp.select_pvalue_region(frame, "chr3", 150, 300)['position'].tolist()
+
+
+def _dense_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = np.sort(rng.uniform(0, 1e6, n))
+    log_pvalues = rng.exponential(1.0, n)
+    ld_bins = rng.integers(0, len(lzp.LD_REGIMES) + 1, n).astype(np.int64)
+    return positions, log_pvalues, ld_bins, 5e5, 3.0
+
+
+def _scatter(decimate, r2_points):
+    figure = lzp.new_figure(figsize=(8, 6), dpi=150)
+    try:
+        axes = figure.add_subplot(1, 1, 1)
+        return lzp.plot_r2_points_worker(axes, r2_points, 0, 1e6, "lead", decimate=decimate)
+    finally:
+        lzp.release_figure(figure)
+
+
+def test_decimation_reduces_a_dense_region():
+    n_rendered, n_input = _scatter(True, _dense_points(200000))
+    assert 200001 == n_input
+    assert n_rendered < 0.3 * n_input
+    assert (200001, 200001) == _scatter(False, _dense_points(200000))
+
+
+def test_decimation_keeps_column_maxima_and_strong_points():
+    positions, log_pvalues, ld_bins, target_pos, target_y = _dense_points(50000, seed=1)
+    log_pvalues[[10, 20]] = [np.inf, 9.0]
+    kept = lzp.decimate_r2_points((positions, log_pvalues, ld_bins, target_pos, target_y), 0, 1e6, 800, 400,
+                                  keep_log_pvalue=8, cell_pixels=3)
+    assert len(kept[0]) < len(positions)
+    assert np.isinf(kept[1]).sum() == 1 and 9.0 in kept[1]
+
+    # the highest point of each cell column and LD bin survives
+    columns = np.floor(positions / 1e6 * np.ceil(800 / 3)).astype(np.int64)
+    kept_columns = np.floor(kept[0] / 1e6 * np.ceil(800 / 3)).astype(np.int64)
+    finite = np.isfinite(log_pvalues)
+    expected = pd.Series(log_pvalues[finite]).groupby([columns[finite], ld_bins[finite]]).max()
+    got = pd.Series(kept[1]).groupby([kept_columns, kept[2]]).max()
+    assert np.all(got.reindex(expected.index).to_numpy() >= expected.to_numpy())
@@ -0,0 +1,185 @@
+# Copyright 2019 Fred Hutchinson Cancer Research Center
+################################################################################
+### Region reads of bgzip compressed, tabix indexed files
+
+import gzip
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import locuszoom_plot as lzp
+
+
+################################################################################
+### Minimal bgzip and tabix writers, so the tests need neither htslib nor pysam
+
+
+def _bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+    return header + compressed + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def _bgzip(data, block_size):
+    """BGZF blocks of block_size uncompressed bytes each, cutting lines anywhere, and the virtual offset function"""
+    blocks = [ _bgzf_block(data[i:i + block_size]) for i in range(0, len(data), block_size)]
+    block_offsets = np.cumsum([0] + [ len(b) for b in blocks]).tolist()
+
+    def virtual_offset(position):
+        return (block_offsets[position // block_size] << 16) | (position % block_size)
+
+    return b"".join(blocks) + _bgzf_block(b""), virtual_offset
+
+
+def _reg2bin(beg, end, min_shift, depth):
+    end -= 1
+    shift = min_shift
+    first_bin = ((1 << depth * 3) - 1) // 7
+    for level in range(depth, 0, -1):
+        if beg >> shift == end >> shift:
+            return first_bin + (beg >> shift)
+        shift += 3
+        first_bin -= 1 << ((level - 1) * 3)
+    return 0
+
+
+def _write_tabix_file(filename, header_lines, records, col_seq, col_pos, csi=False, min_shift=14, depth=5,
+                      block_size=65280, meta="#", skip=0):
+    """Write tab separated records (lists of fields, sorted) bgzipped with a .tbi or .csi index on col_seq/col_pos"""
+    data = b""
+    spans = []
+    for line in header_lines:
+        data += (line + "\n").encode()
+    for fields in records:
+        begin = len(data)
+        data += ("\t".join(str(f) for f in fields) + "\n").encode()
+        spans.append((str(fields[col_seq - 1]), int(fields[col_pos - 1]) - 1, begin, len(data)))
+    compressed, virtual_offset = _bgzip(data, block_size)
+    with open(filename, "wb") as f:
+        f.write(compressed)
+
+    names = []
+    references = {}
+    for seq, beg, begin, end in spans:
+        if seq not in references:
+            names.append(seq)
+            references[seq] = { 'bins': {}, 'linear': {}}
+        reference = references[seq]
+        chunks = reference['bins'].setdefault(_reg2bin(beg, beg + 1, min_shift, depth), [])
+        if len(chunks) > 0 and chunks[-1][1] == virtual_offset(begin):
+            chunks[-1][1] = virtual_offset(end)
+        else:
+            chunks.append([virtual_offset(begin), virtual_offset(end)])
+        reference['linear'].setdefault(beg >> 14, virtual_offset(begin))
+
+    packed_names = b"".join(n.encode() + b"\0" for n in names)
+    header = struct.pack("<7i", 0, col_seq, col_pos, col_pos, ord(meta), skip, len(packed_names)) + packed_names
+    if csi:
+        index = b"CSI\1" + struct.pack("<3i", min_shift, depth, len(header)) + header + struct.pack("<i", len(names))
+    else:
+        index = b"TBI\1" + struct.pack("<i", len(names)) + header
+    for seq in names:
+        reference = references[seq]
+        index += struct.pack("<i", len(reference['bins']))
+        for bin_id, chunks in reference['bins'].items():
+            index += struct.pack("<IQi", bin_id, 0, len(chunks)) if csi else struct.pack("<Ii", bin_id, len(chunks))
+            index += b"".join(struct.pack("<QQ", begin, end) for begin, end in chunks)
+        if not csi:
+            linear = []
+            for window in range(max(reference['linear']) + 1):
+                linear.append(reference['linear'].get(window, linear[-1] if len(linear) > 0 else 0))
+            index += struct.pack("<i", len(linear)) + b"".join(struct.pack("<Q", o) for o in linear)
+    with open(filename + (".csi" if csi else ".tbi"), "wb") as f:
+        f.write(gzip.compress(index))
+
+
+################################################################################
+
+
+PLINK_LD_HEADER = ["CHR_A", "BP_A", "SNP_A", "CHR_B", "BP_B", "SNP_B", "R2"]
+
+INDEXES = { "tbi": {},
+            "csi": { 'csi': True},
+            "csi_wide_bins": { 'csi': True, 'min_shift': 10, 'depth': 7}}
+
+
+def _plink_ld_records():
+    rng = np.random.default_rng(11)
+    records = []
+    for chrom, lead_position in [("3", 49500000), ("5", 48000000)]:
+        lead = "{c}:{p}:A:G".format(c=chrom, p=lead_position)
+        positions = np.unique(rng.integers(lead_position - 300000, lead_position + 300000, 400))
+        for position in positions.tolist():
+            records.append([chrom, lead_position, lead, chrom, position, "{c}:{p}:C:T".format(c=chrom, p=position),
+                            round(float(rng.uniform()), 6)])
+    return records
+
+
+def _expected_ld(records, chromosome, position_min, position_max):
+    return [ r for r in records if r[3] == lzp.normalize_chromosome(chromosome) and
+             position_min <= r[4] <= position_max]
+
+
+@pytest.mark.parametrize("index", list(INDEXES))
+@pytest.mark.parametrize("block_size", [65280, 97])
+def test_plink_ld_file_region_matches_a_full_scan(tmp_path, index, block_size):
+    records = _plink_ld_records()
+    filename = str(tmp_path / "ld.ld.gz")
+    # as indexed by tabix -S 1 -s 4 -b 5 -e 5; block_size 97 cuts most records across BGZF blocks
+    _write_tabix_file(filename, ["\t".join(PLINK_LD_HEADER)], records, 4, 5, block_size=block_size,
+                      skip=1, **INDEXES[index])
+    assert lzp.has_tabix_index(filename)
+
+    for chromosome, position_min, position_max in [("3", 49400000, 49600000), ("chr5", 47950000, 47960000),
+                                                   ("5", 47700000, 48300000), ("3", 49500000, 49500000)]:
+        frame = lzp.load_plink_r2_results_file(filename, position_min=position_min, position_max=position_max,
+                                               chromosome=chromosome)
+        expected = _expected_ld(records, chromosome, position_min, position_max)
+        assert [ r[5] for r in expected] == frame['variant'].tolist()
+        np.testing.assert_allclose([ r[6] for r in expected], frame['ld_r2'], rtol=1e-6)
+
+
+@pytest.mark.parametrize("index", list(INDEXES))
+def test_chromosome_missing_from_the_index_reads_nothing(tmp_path, index):
+    records = _plink_ld_records()
+    filename = str(tmp_path / "ld.ld.gz")
+    # as indexed by tabix -c C -s 4 -b 5 -e 5, the header is a meta line starting with C
+    _write_tabix_file(filename, ["\t".join(PLINK_LD_HEADER)], records, 4, 5, meta="C", **INDEXES[index])
+
+    tabix_file = lzp.TabixFile(filename)
+    assert None == tabix_file.reference_index("chr7")
+    assert "" == tabix_file.fetch_text("7", 1, 250000000)
+    region = tabix_file.region("7", 1, 250000000)
+    assert 0 == len(region) and PLINK_LD_HEADER == list(region.columns)
+    assert 0 == len(lzp.load_plink_r2_results_file(filename, position_min=1, position_max=250000000,
+                                                   chromosome="7"))
+
+
+SUMMARY_RECORDS = [ ["3", "3:{p}:A:G".format(p=p), p, 10.0 ** -(p % 9)] for p in range(1000, 200000, 1500)]
+
+
+@pytest.mark.parametrize("header_lines, meta, skip", [
+    (["##source=test", "##build=GRCh37", "#chrom\tvariant\tposition\tpvalue"], "#", 0),
+    (["produced by test 1.0", "chrom\tvariant\tposition\tpvalue"], "#", 2),
+    (["produced by test 1.0", "##build=GRCh37", "#chrom\tvariant\tposition\tpvalue"], "#", 1)])
+def test_header_meta_and_skip_lines(tmp_path, header_lines, meta, skip):
+    filename = str(tmp_path / "summary.tsv.gz")
+    _write_tabix_file(filename, header_lines, SUMMARY_RECORDS, 1, 3, block_size=211, meta=meta, skip=skip)
+
+    tabix_file = lzp.TabixFile(filename)
+    assert ["chrom", "variant", "position", "pvalue"] == tabix_file.columns
+    region = tabix_file.region("chr3", 10000, 40000)
+    expected = [ r for r in SUMMARY_RECORDS if 10000 <= r[2] <= 40000]
+    assert [ r[1] for r in expected] == region['variant'].tolist()
+    assert [ r[2] for r in expected] == region['position'].tolist()
+    assert "3" == region['chrom'][0]
+    np.testing.assert_allclose([ r[3] for r in expected], region['pvalue'])
+
+    # whole-chromosome reads never return header lines as records
+    everything = tabix_file.region("3", 1, 1 << 28)
+    assert len(SUMMARY_RECORDS) == len(everything)
+    assert pd.api.types.is_integer_dtype(everything['position'])